@@ -1,13 +1,49 @@
 from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
 
-import pyramid.config
+if TYPE_CHECKING:
+    import pyramid.config
+
+
+def _prepare(config: "pyramid.config.Configurator", mapped_class: Any, geom_attr: str | None) -> None:
+    """
+    Precompute at configuration time what the requests on a mapped class need.
+
+    The mappers are configured, the serialization plan of ``GeoInterface``
+    classes and the column metadata used by the protocol are computed, and
+    the XSD documents are generated by the registered XSD renderers. This
+    is done when the configuration is committed, once the related mapped
+    classes are imported and the renderers are registered.
+    """
+
+    def prepare() -> None:
+        import sqlalchemy.orm
+        from pyramid.interfaces import IRendererFactory
+
+        from papyrus.geo_interface import GeoInterface, _get_plan
+        from papyrus.protocol import _get_col_epsg, _get_column_keys
+        from papyrus.renderers import XSD
+
+        sqlalchemy.orm.configure_mappers()
+        if issubclass(mapped_class, GeoInterface):
+            _get_plan(mapped_class)
+        _get_column_keys(mapped_class)
+        if geom_attr is not None:
+            _get_col_epsg(mapped_class, geom_attr)
+        for _, factory in config.registry.getUtilitiesFor(IRendererFactory):
+            if isinstance(factory, XSD):
+                factory.get_xsd(mapped_class)
+
+    config.action(None, prepare)
 
 
 def add_papyrus_handler(
-    self: pyramid.config.Configurator,
+    self: "pyramid.config.Configurator",
     route_name_prefix: str,
     base_url: str,
     handler: Callable[[], str],
+    mapped_class: Any = None,
+    geom_attr: str | None = None,
 ) -> None:
     """
     Add a Papyrus handler, i.e. a handler defining the MapFish HTTP interface.
@@ -30,8 +66,16 @@ def add_papyrus_handler(
     handler:
         a dotted name or a reference to a handler class,
         e.g. ``'mypackage.handlers.MyHandler'``.
+    mapped_class:
+        the SQLAlchemy mapped class of the web service, optional. If set,
+        the mapper introspection and the XSD document are done at
+        configuration time rather than on the first requests.
+    geom_attr:
+        the key of the geometry property of the mapped class, optional.
 
     """
+    if mapped_class is not None:
+        _prepare(self, mapped_class, geom_attr)
     route_name = route_name_prefix + "_read_many"
     self.add_handler(route_name, base_url, handler, action="read_many", request_method="GET")
     route_name = route_name_prefix + "_read_one"
@@ -46,7 +90,13 @@ def add_papyrus_handler(
     self.add_handler(route_name, base_url + "/{id}", handler, action="delete", request_method="DELETE")
 
 
-def add_papyrus_routes(self: pyramid.config.Configurator, route_name_prefix: str, base_url: str) -> None:
+def add_papyrus_routes(
+    self: "pyramid.config.Configurator",
+    route_name_prefix: str,
+    base_url: str,
+    mapped_class: Any = None,
+    geom_attr: str | None = None,
+) -> None:
     """
     Add Papyrus routes, i.e. routes defining the MapFish HTTP interface.
 
@@ -68,8 +118,16 @@ def add_papyrus_routes(self: pyramid.config.Configurator, route_name_prefix: str
     base_url:
         The web service's base URL, e.g. ``/spots``. No
         trailing slash!
+    mapped_class:
+        the SQLAlchemy mapped class of the web service, optional. If set,
+        the mapper introspection and the XSD document are done at
+        configuration time rather than on the first requests.
+    geom_attr:
+        the key of the geometry property of the mapped class, optional.
 
     """
+    if mapped_class is not None:
+        _prepare(self, mapped_class, geom_attr)
     route_name = route_name_prefix + "_read_many"
     self.add_route(route_name, base_url, request_method="GET")
     route_name = route_name_prefix + "_read_one"
@@ -84,7 +142,7 @@ def add_papyrus_routes(self: pyramid.config.Configurator, route_name_prefix: str
     self.add_route(route_name, base_url + "/{id}", request_method="DELETE")
 
 
-def includeme(config: pyramid.config.Configurator) -> None:
+def includeme(config: "pyramid.config.Configurator") -> None:
     """
     Initialize the Pyramid application with the Papyrus handlers.
 
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+StatementCallback = Callable[[Any, float, str, Any, bool], None]
+"""Called with the connection, the duration in seconds, the statement, its parameters and ``executemany``."""
+
+_STARTS_KEY = "papyrus_starts"
+
+_callbacks: tuple[StatementCallback, ...] = ()
+_lock = threading.Lock()
+
+
+def on_statement(callback: StatementCallback) -> None:
+    """
+    Call ``callback`` after the execution of each SQL statement, of all the engines.
+
+    The listeners are only registered on the engines on the first call, and
+    a callback is only added once.
+    """
+    global _callbacks  # pylint: disable=global-statement
+    with _lock:
+        if callback in _callbacks:
+            return
+        if not _callbacks:
+            import sqlalchemy.engine
+            import sqlalchemy.event
+
+            sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", _before_cursor_execute)
+            sqlalchemy.event.listen(sqlalchemy.engine.Engine, "after_cursor_execute", _after_cursor_execute)
+            sqlalchemy.event.listen(sqlalchemy.engine.Engine, "handle_error", _handle_error)
+        _callbacks = (*_callbacks, callback)
+
+
+def _before_cursor_execute(conn: Any, *args: Any) -> None:
+    del args  # Unused
+    conn.info.setdefault(_STARTS_KEY, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(
+    conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool
+) -> None:
+    del cursor, context  # Unused
+    starts = conn.info.get(_STARTS_KEY)
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    for callback in _callbacks:
+        callback(conn, elapsed, statement, parameters, executemany)
+
+
+def _handle_error(context: Any) -> None:
+    # The statement failed, after_cursor_execute is not called
+    starts = context.connection.info.get(_STARTS_KEY) if context.connection is not None else None
+    if starts:
+        starts.pop()
@@ -0,0 +1,161 @@
+import codecs
+import json
+from collections.abc import Iterator
+from typing import IO, Any
+
+import geojson
+from geojson import Feature, GeoJSON
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """Incremental reader of JSON values from a binary file object."""
+
+    def __init__(self, fp: IO[bytes], chunk_size: int) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(object_hook=GeoJSON.to_instance)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> None:
+        if self.eof:
+            raise ValueError("Unexpected end of the GeoJSON document")
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+        # Read at least as much as what is already buffered, for values larger
+        # than the chunk size not to be parsed again and again.
+        data = self.fp.read(max(self.chunk_size, len(self.buffer)))
+        self.eof = not data
+        self.buffer += self.text_decoder.decode(data, final=self.eof)
+
+    def peek(self) -> str:
+        """Return the next non whitespace character, without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def expect(self, char: str) -> None:
+        """Consume the given character."""
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at position {self.pos}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self.buffer) and not self.eof:
+                # a number may be truncated at the end of the buffer
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(fp: IO[bytes], chunk_size: int = 65536) -> Iterator[geojson.Feature]:
+    """
+    Read the features of a GeoJSON feature collection from a binary file object.
+
+    The features are decoded and yielded one by one while the document is
+    read, so the whole document is never loaded in memory. Raise a
+    ``ValueError`` if the document is not a valid feature collection.
+    """
+    reader = _Reader(fp, chunk_size)
+    type_ = None
+    reader.expect("{")
+    if reader.peek() == "}":
+        raise ValueError("Not a FeatureCollection")
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError("Invalid GeoJSON document")  # noqa: TRY004
+        reader.expect(":")
+        if key == "features":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    feature = reader.value()
+                    if not isinstance(feature, Feature):
+                        raise ValueError("Not a Feature")  # noqa: TRY004
+                    yield feature
+                    if reader.peek() == "]":
+                        reader.expect("]")
+                        break
+                    reader.expect(",")
+        else:
+            value = reader.value()
+            if key == "type":
+                type_ = value
+                if type_ != "FeatureCollection":
+                    raise ValueError("Not a FeatureCollection")
+        if reader.peek() == "}":
+            reader.expect("}")
+            break
+        reader.expect(",")
+    if type_ != "FeatureCollection":
+        raise ValueError("Not a FeatureCollection")
+
+
+SEQ_SEPARATORS = {"application/geo+json-seq": b"\x1e", "application/x-ndjson": b"\n"}
+"""The record separators of the GeoJSON text sequences, by content type."""
+
+SEQ_CONTENT_TYPES = tuple(SEQ_SEPARATORS)
+"""The content types of the GeoJSON text sequences."""
+
+
+def _load_record(record: bytes) -> geojson.Feature | None:
+    """Load the feature of a text sequence record, ``None`` if the record is empty."""
+    if not record.strip():
+        return None
+    feature = json.loads(record, object_hook=GeoJSON.to_instance)
+    if not isinstance(feature, Feature):
+        raise ValueError("Not a Feature")  # noqa: TRY004
+    return feature  # type: ignore[no-any-return]
+
+
+def iter_seq_features(
+    fp: IO[bytes], separator: bytes = b"\x1e", chunk_size: int = 65536
+) -> Iterator[geojson.Feature]:
+    """
+    Read the features of a GeoJSON text sequence from a binary file object.
+
+    The records are delimited by ``separator``: the record separator for RFC
+    8142 sequences, where a record may span several lines, or a newline for
+    newline-delimited features. Raise a ``ValueError`` if a record is not a
+    valid feature.
+    """
+    # The start of the current record, as a list of chunks not to copy the
+    # buffer on each read when a record is larger than a chunk
+    pending: list[bytes] = []
+    while chunk := fp.read(chunk_size):
+        parts = chunk.split(separator)
+        if len(parts) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(parts[0])
+        for record in (b"".join(pending), *parts[1:-1]):
+            feature = _load_record(record)
+            if feature is not None:
+                yield feature
+        pending = [parts[-1]]
+    feature = _load_record(b"".join(pending))
+    if feature is not None:
+        yield feature
@@ -1,3 +1,6 @@
+import functools
+from typing import Any
+
 import geojson
 from geoalchemy2.shape import from_shape, to_shape
 from geoalchemy2.types import Geometry
@@ -7,6 +10,45 @@ from sqlalchemy.orm.util import class_mapper
 from papyrus._shapely_utils import asShape
 
 
+class _Plan:
+    """The column properties of a mapped class, as read and written by :py:class:`GeoInterface`."""
+
+    def __init__(self, cls: type[Any]) -> None:
+        self.primary_key: str | None = None
+        self.geometries: list[tuple[str, int]] = []
+        self.properties: list[str] = []
+        self.read_geometries: list[str] = []
+        self.read_properties: list[str] = []
+        self.readable = True
+        for p in class_mapper(cls).iterate_properties:
+            if not isinstance(p, ColumnProperty):
+                continue
+            if len(p.columns) != 1:
+                self.readable = False
+            col = p.columns[0]
+            if col.primary_key:
+                self.primary_key = p.key
+            if isinstance(col.type, Geometry):
+                self.geometries.append((p.key, col.type.srid))
+                if not col.primary_key:
+                    self.read_geometries.append(p.key)
+            elif not col.primary_key:
+                self.properties.append(p.key)
+                if not col.foreign_keys:
+                    self.read_properties.append(p.key)
+
+
+@functools.cache
+def _get_plan(cls: type[Any]) -> _Plan:
+    """
+    Get the plan used to read and write the objects of a mapped class.
+
+    The mapper of the class is inspected on the first call only, see the
+    ``mapped_class`` argument of the Papyrus directives.
+    """
+    return _Plan(cls)
+
+
 class GeoInterface:
     """
     Interface for SQLAlchemy/GeoAlchemy mapped classes.
@@ -72,12 +114,7 @@ class GeoInterface:
 
         """
         if feature:
-            primary_key = None
-            for p in class_mapper(self.__class__).iterate_properties:
-                if not isinstance(p, ColumnProperty):
-                    continue
-                if p.columns[0].primary_key:
-                    primary_key = p.key
+            primary_key = _get_plan(self.__class__).primary_key
             if hasattr(feature, "id") and feature.id is not None:
                 assert primary_key is not None
                 setattr(self, primary_key, feature.id)
@@ -94,20 +131,16 @@ class GeoInterface:
         feature: The GeoJSON feature as received from the client.
 
         """
-        for p in class_mapper(self.__class__).iterate_properties:
-            if not isinstance(p, ColumnProperty):
-                continue
-            col = p.columns[0]
-            if isinstance(col.type, Geometry):
-                geom = feature.geometry
-                if geom and not isinstance(geom, geojson.geometry.Default):
-                    srid = col.type.srid
-                    shape = asShape(geom)
-                    setattr(self, p.key, from_shape(shape, srid=srid))
-                    self._shape = shape
-            elif not col.primary_key:
-                if p.key in feature.properties:
-                    setattr(self, p.key, feature.properties[p.key])
+        plan = _get_plan(self.__class__)
+        geom = feature.geometry
+        if geom and not isinstance(geom, geojson.geometry.Default):
+            for key, srid in plan.geometries:
+                shape = asShape(geom)
+                setattr(self, key, from_shape(shape, srid=srid))
+                self._shape = shape
+        for key in plan.properties:
+            if key in feature.properties:
+                setattr(self, key, feature.properties[key])
 
         if self.__add_properties__:
             for k in self.__add_properties__:  # pylint: disable=not-an-iterable
@@ -119,25 +152,18 @@ class GeoInterface:
 
         Called by :py:attr:`.__geo_interface__`.
         """
-        id = None  # pylint: disable=redefined-builtin
+        plan = _get_plan(self.__class__)
+        if not plan.readable:  # pragma: no cover
+            raise NotImplementedError
+        id = getattr(self, plan.primary_key) if plan.primary_key is not None else None  # pylint: disable=redefined-builtin
         geom = None
-        properties = {}
-
-        for p in class_mapper(self.__class__).iterate_properties:
-            if isinstance(p, ColumnProperty):
-                if len(p.columns) != 1:  # pragma: no cover
-                    raise NotImplementedError
-                col = p.columns[0]
-                val = getattr(self, p.key)
-                if col.primary_key:
-                    id = val
-                elif isinstance(col.type, Geometry):
-                    if hasattr(self, "_shape"):
-                        geom = self._shape
-                    elif val is not None:
-                        geom = to_shape(val)
-                elif not col.foreign_keys:
-                    properties[p.key] = val
+        for key in plan.read_geometries:
+            val = getattr(self, key)
+            if hasattr(self, "_shape"):
+                geom = self._shape
+            elif val is not None:
+                geom = to_shape(val)
+        properties = {key: getattr(self, key) for key in plan.read_properties}
 
         if self.__add_properties__:
             for k in self.__add_properties__:  # pylint: disable=not-an-iterable
@@ -1,11 +1,14 @@
 import datetime
 import decimal
 import functools
+import sys
+import threading
+from collections.abc import Callable
 from typing import Any
 
+from geojson import FeatureCollection
 from geojson import dumps as _dumps
 from geojson.codec import PyGFPEncoder
-from sqlalchemy.ext.associationproxy import _AssociationList
 
 
 class GeoJSONEncoder(PyGFPEncoder):  # type: ignore[misc]
@@ -22,8 +25,12 @@ class GeoJSONEncoder(PyGFPEncoder):  # type: ignore[misc]
         """Get the default value for an object."""
         if isinstance(obj, datetime.date | datetime.datetime | datetime.time):
             return obj.isoformat()
-        if isinstance(obj, _AssociationList):
-            return list(obj)
+        # SQLAlchemy is only imported if it is already used by the application
+        if "sqlalchemy" in sys.modules:
+            from sqlalchemy.ext.associationproxy import _AssociationList
+
+            if isinstance(obj, _AssociationList):
+                return list(obj)
         if isinstance(obj, decimal.Decimal):
             # The decimal is converted to a lossy float
             return float(obj)
@@ -35,3 +42,27 @@ dumps = functools.partial(_dumps, cls=GeoJSONEncoder)
 A partial function for ``geojson.dumps`` that sets ``cls`` to
 :class:`GeoJSONEncoder`.
 """
+
+
+class SharedFeatureCollection(FeatureCollection):  # type: ignore[misc]
+    """
+    A feature collection shared by concurrent requests, and encoded once.
+
+    Returned by the coalesced reads of the MapFish protocol, see the
+    ``coalesce`` argument of :class:`papyrus.protocol.Protocol`.
+    """
+
+    type = "FeatureCollection"
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # Not set as items, the GeoJSON objects store their attributes as items
+        object.__setattr__(self, "_encoded", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def encode(self, encoder: Callable[[Any], str]) -> str:
+        """Encode the collection with the encoder on the first call, and return the same text afterwards."""
+        with self.__dict__["_lock"]:
+            if self.__dict__["_encoded"] is None:
+                object.__setattr__(self, "_encoded", encoder(self))
+            return self.__dict__["_encoded"]  # type: ignore[no-any-return]
@@ -0,0 +1,131 @@
+import contextlib
+import threading
+import time
+from collections.abc import Iterator
+
+from pyramid.httpexceptions import HTTPTooManyRequests
+
+
+class _Slot:
+    """The state of the concurrency limit of a layer action."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+class ConcurrencyLimiter:
+    """
+    Limit the number of concurrent actions per layer, for a heavy layer not to starve the others.
+
+    Each action (``read``, ``count``, ``cluster``, ``aggregate``, ``create``,
+    ``update``, ``delete``) of each layer has its own limit. The requests
+    exceeding it wait in a bounded queue, and the requests which cannot be
+    queued, or which wait longer than ``timeout``, get an
+    ``HTTPTooManyRequests`` exception with a ``Retry-After`` header.
+
+    Arguments:
+
+    limit
+        the maximum number of concurrent actions per layer. Either a number,
+        or a dict of numbers per action, the actions missing from the dict
+        are not limited.
+
+    queue_size
+        the maximum number of requests waiting per layer action. Default is
+        ``0`` (the excess requests are rejected immediately).
+
+    timeout
+        the maximum waiting time of the queued requests, in seconds. Default
+        is ``None`` (no limit).
+
+    retry_after
+        the value of the ``Retry-After`` header of the rejected requests, in
+        seconds. Default is ``1``.
+    """
+
+    def __init__(
+        self,
+        limit: int | dict[str, int],
+        queue_size: int = 0,
+        timeout: float | None = None,
+        retry_after: int = 1,
+    ) -> None:
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots: dict[tuple[str, str], _Slot | None] = {}
+        self._lock = threading.Lock()
+
+    def _get_slot(self, layer: str, action: str) -> _Slot | None:
+        key = (layer, action)
+        with self._lock:
+            if key not in self._slots:
+                limit = self.limit.get(action) if isinstance(self.limit, dict) else self.limit
+                self._slots[key] = None if limit is None else _Slot(limit)
+            return self._slots[key]
+
+    def _reject(self, slot: _Slot) -> HTTPTooManyRequests:
+        slot.rejected += 1
+        return HTTPTooManyRequests(headers={"Retry-After": str(self.retry_after)})
+
+    @contextlib.contextmanager
+    def acquire(self, layer: str, action: str) -> Iterator[None]:
+        """Run an action of a layer within the limit, waiting in the queue if needed."""
+        slot = self._get_slot(layer, action)
+        if slot is None:
+            yield
+            return
+        with slot.condition:
+            if slot.active >= slot.limit:
+                if slot.waiting >= self.queue_size:
+                    raise self._reject(slot)
+                start = time.perf_counter()
+                slot.waiting += 1
+                try:
+                    admitted = slot.condition.wait_for(lambda: slot.active < slot.limit, self.timeout)
+                finally:
+                    slot.waiting -= 1
+                wait_time = time.perf_counter() - start
+                slot.wait_time += wait_time
+                slot.max_wait_time = max(slot.max_wait_time, wait_time)
+                if not admitted:
+                    raise self._reject(slot)
+            slot.active += 1
+            slot.admitted += 1
+        try:
+            yield
+        finally:
+            with slot.condition:
+                slot.active -= 1
+                slot.condition.notify()
+
+    def stats(self) -> dict[tuple[str, str], dict[str, float]]:
+        """
+        Get the statistics of the limited layer actions.
+
+        Return a dict by ``(layer, action)``, with the numbers of ``active``,
+        ``waiting``, ``admitted`` and ``rejected`` requests, and the total and
+        maximum waiting times in seconds (``wait_time``, ``max_wait_time``).
+        """
+        with self._lock:
+            slots = [(key, slot) for key, slot in self._slots.items() if slot is not None]
+        stats = {}
+        for key, slot in slots:
+            with slot.condition:
+                stats[key] = {
+                    "active": slot.active,
+                    "waiting": slot.waiting,
+                    "admitted": slot.admitted,
+                    "rejected": slot.rejected,
+                    "wait_time": slot.wait_time,
+                    "max_wait_time": slot.max_wait_time,
+                }
+        return stats
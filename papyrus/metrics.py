@@ -0,0 +1,179 @@
+import threading
+from collections.abc import Iterable, Iterator, Sequence
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pyramid.request
+    import pyramid.response
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""The default upper bounds of the buckets of the duration histograms, in seconds."""
+
+METRICS_KEY = "papyrus.metrics"
+"""The key of the registry and the layer of a measured request in its WSGI environment."""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""The content type of the Prometheus text format."""
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped, strict=True)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """A counter, with one value per combination of the label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, value: float = 1) -> None:
+        """Increment the counter of the label values."""
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """Get the samples, as ``(name, labels, value)`` tuples."""
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """A histogram, with one set of buckets per combination of the label values."""
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # The counts per bucket (the last one is +Inf), and the sum of the observed values
+        self.values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels: str, value: float) -> None:
+        """Add an observed value to the histogram of the label values."""
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self.values.get(labels) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """Get the samples, as ``(name, labels, value)`` tuples, with cumulative bucket counts."""
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        names = (*self.labelnames, "le")
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                le = bound if isinstance(bound, str) else _format_value(bound)
+                yield f"{self.name}_bucket", _format_labels(names, (*labels, le)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+
+class MetricsRegistry:
+    """
+    In-process metrics of the MapFish protocols, per layer and action.
+
+    Pass the registry to the protocols with their ``metrics`` argument. The
+    metrics can be polled with :py:meth:`collect`, or scraped in the
+    Prometheus text format with :py:meth:`render` or the :py:meth:`view`
+    view callable.
+
+    Arguments:
+
+    buckets
+        the upper bounds of the buckets of the request durations histogram,
+        in seconds. Default is :py:data:`DEFAULT_BUCKETS`.
+
+    prefix
+        the prefix of the metric names. Default is ``papyrus``.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS, prefix: str = "papyrus") -> None:
+        self.requests = Counter(
+            f"{prefix}_requests_total", "The number of requests.", ("layer", "action", "status")
+        )
+        self.duration = Histogram(
+            f"{prefix}_request_duration_seconds",
+            "The duration of the requests, in seconds.",
+            ("layer", "action"),
+            buckets,
+        )
+        self.rows_returned = Counter(
+            f"{prefix}_rows_returned_total", "The number of features returned.", ("layer", "action")
+        )
+        self.rows_written = Counter(
+            f"{prefix}_rows_written_total",
+            "The number of features inserted, updated or deleted.",
+            ("layer", "action"),
+        )
+        self.bytes_rendered = Counter(
+            f"{prefix}_rendered_bytes_total", "The number of bytes encoded by the renderers.", ("layer",)
+        )
+        self.cache_hits = Counter(
+            f"{prefix}_cache_hits_total",
+            "The number of requests served without their own query.",
+            ("layer", "cache"),
+        )
+        self.metrics: list[Counter | Histogram] = [
+            self.requests,
+            self.duration,
+            self.rows_returned,
+            self.rows_written,
+            self.bytes_rendered,
+            self.cache_hits,
+        ]
+
+    def collect(self) -> dict[str, dict[str, float]]:
+        """Get the values of the samples, by metric name and formatted labels."""
+        samples: dict[str, dict[str, float]] = {}
+        for metric in self.metrics:
+            for name, labels, value in metric.samples():
+                samples.setdefault(name, {})[labels] = value
+        return samples
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def view(self, request: "pyramid.request.Request") -> "pyramid.response.Response":
+        """A view callable returning the metrics in the Prometheus text format."""
+        from pyramid.response import Response
+
+        del request  # Unused
+        response = Response(self.render().encode())
+        response.headers["Content-Type"] = CONTENT_TYPE
+        return response
+
+
+def count_bytes(chunks: Iterable[bytes], counter: Counter, *labels: str) -> Iterator[bytes]:
+    """Count the bytes of the chunks of a streamed response, as they are sent."""
+    for chunk in chunks:
+        counter.inc(*labels, value=len(chunk))
+        yield chunk
@@ -22,28 +22,61 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-from collections.abc import Callable
-from typing import Any
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import json
+import operator
+import queue
+import re
+import threading
+import time
+import types
+import weakref
+from collections.abc import AsyncIterator, Callable, Generator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, TypeVar
 
 import geojson
 import pyramid.request
 import pyramid.response
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.orm
 import sqlalchemy.orm.session
 import sqlalchemy.sql.expression
-from geoalchemy2.shape import from_shape
 from geojson import Feature, FeatureCollection, GeoJSON, loads
-from pyramid.httpexceptions import HTTPBadRequest, HTTPMethodNotAllowed, HTTPNotFound
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPException,
+    HTTPMethodNotAllowed,
+    HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+    HTTPServiceUnavailable,
+)
 from pyramid.response import Response
-from shapely.geometry.point import Point
-from shapely.geometry.polygon import Polygon
+from sqlalchemy import Row, column, select, type_coerce
+from sqlalchemy.ext.asyncio import async_scoped_session
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm.util import class_mapper
 from sqlalchemy.sql import and_, asc, desc, func
+from sqlalchemy.types import NullType
 
-from papyrus._shapely_utils import asShape
+from papyrus._geojson_stream import SEQ_SEPARATORS, iter_features, iter_seq_features
+from papyrus.geojsonencoder import SharedFeatureCollection
+from papyrus.limiter import ConcurrencyLimiter
+from papyrus.metrics import METRICS_KEY, MetricsRegistry
+from papyrus.slowlog import watch
+from papyrus.timing import Timings, get_timings, phase
+from papyrus.tracing import TRACER_KEY, start_span
 
+_F = TypeVar("_F", bound=Callable[..., Any])
 
+
+@functools.cache
 def _get_col_epsg(mapped_class: Any, geom_attr: str) -> int:
     """
     Get the EPSG code associated with a geometry attribute.
@@ -61,15 +94,81 @@ def _get_col_epsg(mapped_class: Any, geom_attr: str) -> int:
     return col.type.srid  # type: ignore[no-any-return]
 
 
+def _has_filter_shape(request: pyramid.request.Request) -> bool:
+    """Return whether the request params define the filter geometry directly."""
+    return (
+        "bbox" in request.params
+        or ("lon" in request.params and "lat" in request.params)
+        or "geometry" in request.params
+    )
+
+
+def _create_filter_shape(
+    request: pyramid.request.Request,
+    tolerance: float,
+    max_vertices: int | None = None,
+    simplify: bool = False,
+) -> Any | None:
+    """
+    Create the shape of the geometry filter from the ``bbox``, ``lon``/``lat`` or ``geometry`` params.
+
+    Return ``None`` if there is no such param, or for a nearest neighbours
+    query. See ``create_geom_filter()`` for the other arguments.
+    """
+    import shapely
+    from shapely.geometry.point import Point
+    from shapely.geometry.polygon import Polygon
+
+    from papyrus._shapely_utils import asShape
+
+    box = request.params.get("bbox")
+    shape = None
+    if box is not None:
+        box = [float(x) for x in box.split(",")]
+        shape = Polygon(
+            ((box[0], box[1]), (box[0], box[3]), (box[2], box[3]), (box[2], box[1]), (box[0], box[1])),
+        )
+    elif "lon" in request.params and "lat" in request.params:
+        if "nearest" in request.params:
+            # The features are ordered by distance to the point instead,
+            # see Protocol.
+            return None
+        shape = Point(float(request.params["lon"]), float(request.params["lat"]))
+    elif "geometry" in request.params:
+        shape = loads(request.params["geometry"], object_hook=GeoJSON.to_instance)
+        shape = asShape(shape)
+    if shape is None:
+        return None
+    if simplify and tolerance > 0:
+        shape = shape.simplify(tolerance, preserve_topology=True)
+    if max_vertices is not None and shapely.get_num_coordinates(shape) > max_vertices:
+        raise HTTPBadRequest(f"The filter geometry has more than {max_vertices} vertices")
+    return shape
+
+
+@functools.cache
+def _get_column_keys(mapped_class: Any) -> frozenset[str]:
+    """Get the keys of the column properties of a mapped class."""
+    return frozenset(p.key for p in class_mapper(mapped_class).column_attrs)
+
+
 def create_geom_filter(
     request: pyramid.request.Request,
     mapped_class: Any,
     geom_attr: str,
+    max_vertices: int | None = None,
+    simplify: bool = False,
+    subdivide: int | None = None,
 ) -> sqlalchemy.sql.expression.ColumnElement[bool] | None:
     """
     Create MapFish geometry filter based on the request params.
 
     Either a box or within or geometry filter, depending on the request params.
+    The geometry can also be the one of a feature of a layer registered with
+    :py:func:`register_layer`, using the ``geometry_ref`` param. With the
+    ``nearest`` param, the ``lon``/``lat`` params define no filter: the
+    query is to be ordered by distance to the point and limited to
+    ``nearest`` features instead, as ``Protocol`` does.
     Additional named arguments are passed to the spatial filter.
 
     Arguments:
@@ -80,34 +179,123 @@ def create_geom_filter(
         the key of the geometry property as defined in the SQLAlchemy
         mapper. If you use ``declarative_base`` this is the name of
         the geometry attribute as defined in the mapped class.
+    max_vertices:
+        the maximum number of vertices of the filter geometry, an
+        ``HTTPBadRequest`` is raised for larger geometries.
+    simplify:
+        simplify the filter geometry within the ``tolerance`` before
+        checking its number of vertices.
+    subdivide:
+        split the filter geometry with ``ST_Subdivide`` in parts with at
+        most this number of vertices (at least 5), each part is then
+        matched with the spatial index. Ignored for the mapped classes
+        with a composite primary key.
 
     """
+    import shapely
+    from geoalchemy2.shape import from_shape
+
+    if subdivide is not None and subdivide < 5:
+        raise ValueError(f"ST_Subdivide needs at least 5 vertices, got {subdivide}")
     tolerance = float(request.params.get("tolerance", 0.0))
     epsg = None
     if "epsg" in request.params:
         epsg = int(request.params["epsg"])
-    box = request.params.get("bbox")
-    shape = None
-    if box is not None:
-        box = [float(x) for x in box.split(",")]
-        shape = Polygon(
-            ((box[0], box[1]), (box[0], box[3]), (box[2], box[3]), (box[2], box[1]), (box[0], box[1])),
-        )
-    elif "lon" in request.params and "lat" in request.params:
-        shape = Point(float(request.params["lon"]), float(request.params["lat"]))
-    elif "geometry" in request.params:
-        shape = loads(request.params["geometry"], object_hook=GeoJSON.to_instance)
-        shape = asShape(shape)
+    shape = _create_filter_shape(request, tolerance, max_vertices, simplify)
     if shape is None:
+        if "geometry_ref" in request.params and not _has_filter_shape(request):
+            return _create_geom_ref_filter(request, mapped_class, geom_attr, tolerance, epsg)
         return None
     column_epsg = _get_col_epsg(mapped_class, geom_attr)
-    geom_attr = getattr(mapped_class, geom_attr)
     epsg = column_epsg if epsg is None else epsg
-    geom_column = func.ST_Transform(geom_attr, epsg) if epsg != column_epsg else geom_attr
     geometry = from_shape(shape, srid=epsg)
+    mapper = class_mapper(mapped_class)
+    if (
+        subdivide is not None
+        and len(mapper.primary_key) == 1
+        and shapely.get_num_coordinates(shape) > subdivide
+    ):
+        # Not correlated, for the parts to drive the index scans of the table
+        table = sqlalchemy.orm.aliased(mapped_class)
+        parts = func.ST_Subdivide(geometry, subdivide).table_valued("geom").render_derived(name="part")
+        pk_key = mapper.get_property_by_column(mapper.primary_key[0]).key
+        matching = select(getattr(table, pk_key)).join(
+            parts,
+            func.ST_DWithin(
+                _transform(getattr(table, geom_attr), column_epsg, epsg), parts.c.geom, tolerance
+            ),
+        )
+        return getattr(mapped_class, pk_key).in_(matching)
+    return func.ST_DWithin(
+        _transform(getattr(mapped_class, geom_attr), column_epsg, epsg), geometry, tolerance
+    )
+
+
+def _transform(geom_column: Any, column_epsg: int, epsg: int) -> Any:
+    """Transform a geometry column to ``epsg``, if needed."""
+    return func.ST_Transform(geom_column, epsg) if epsg != column_epsg else geom_column
+
+
+def _create_geom_ref_filter(
+    request: pyramid.request.Request,
+    mapped_class: Any,
+    geom_attr: str,
+    tolerance: float,
+    epsg: int | None,
+) -> sqlalchemy.sql.expression.ColumnElement[bool]:
+    """
+    Create a geometry filter on the geometry of a feature of a registered layer.
+
+    The ``geometry_ref`` param has the form ``layer:id``, the geometry of the
+    referenced feature is read by a subquery, within the database.
+    """
+    name, _, id = request.params["geometry_ref"].partition(":")  # pylint: disable=redefined-builtin
+    if name not in _layers or not id:
+        raise HTTPBadRequest(f"Unknown geometry reference: {request.params['geometry_ref']}")
+    ref_class, ref_geom_attr = _layers[name]
+    primary_key = class_mapper(ref_class).primary_key
+    if len(primary_key) != 1:
+        raise HTTPBadRequest(
+            f"The features of {name} have a composite primary key, they cannot be referenced"
+        )
+    # Coerce the type for the geometry not to be selected as EWKB
+    ref_geom = type_coerce(getattr(ref_class, ref_geom_attr), NullType())
+    geometry = select(ref_geom).filter(primary_key[0] == id).scalar_subquery()
+    column_epsg = _get_col_epsg(mapped_class, geom_attr)
+    geom_column = getattr(mapped_class, geom_attr)
+    epsg = column_epsg if epsg is None else epsg
+    if epsg != column_epsg:
+        geom_column = func.ST_Transform(geom_column, epsg)
+    if epsg != _get_col_epsg(ref_class, ref_geom_attr):
+        geometry = func.ST_Transform(geometry, epsg)
     return func.ST_DWithin(geom_column, geometry, tolerance)
 
 
+_layers: dict[str, tuple[Any, str]] = {}
+
+
+def register_layer(name: str, mapped_class: Any, geom_attr: str) -> None:
+    """
+    Register a mapped class as a layer that can be referenced in the filters.
+
+    With this, the ``geometry_ref=name:id`` request param filters the
+    features according to the geometry of the ``id`` feature of the layer,
+    without the geometry leaving the database. The features of a mapped
+    class with a composite primary key cannot be referenced, the requests
+    referencing them get an ``HTTPBadRequest``.
+
+    Arguments:
+    ---------
+    name: the name of the layer.
+    mapped_class: the SQLAlchemy mapped class.
+    geom_attr:
+        the key of the geometry property as defined in the SQLAlchemy
+        mapper.
+
+    """
+    _layers[name] = (mapped_class, geom_attr)
+
+
 def create_attr_filter(
     request: pyramid.request.Request,
     mapped_class: type[str],
@@ -179,6 +367,281 @@ def create_filter(
     return and_(geom_filter, attr_filter)
 
 
+AGGREGATE_FUNCTIONS = ("sum", "avg", "min", "max")
+"""The SQL functions that can be used to aggregate attributes."""
+
+GRID_FUNCTIONS = {"square": "ST_SquareGrid", "hexagon": "ST_HexagonGrid"}
+"""The PostGIS functions generating the grids of the ``aggregate`` action."""
+
+OUTPUT_GEOM_LABEL = "papyrus_output_geom"
+"""The label of the reprojected geometry column."""
+
+FILTER_PARAMS = ("bbox", "lon", "geometry", "geometry_ref", "nearest", "queryable")
+"""The request params defining the default filter, reported by the tracing spans."""
+
+WRITE_COOKIE_NAME = "papyrus_write"
+"""The name of the cookie set after the writes, see the ``read_your_writes`` argument of ``Protocol``."""
+
+CREATE_BATCH_SIZE = 1000
+"""The number of features created per batch from a text sequence, if ``batch_size`` is not set."""
+
+QUERY_CANCELED = "57014"
+"""The SQLSTATE of the queries canceled by the ``statement_timeout``."""
+
+
+class _Explain(sqlalchemy.sql.expression.Executable, sqlalchemy.sql.expression.ClauseElement):
+    """An ``EXPLAIN`` statement, giving the estimated plan of a statement without running it."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: Any) -> None:
+        self.statement = statement
+
+
+@compiles(_Explain)
+def _compile_explain(element: _Explain, compiler: Any, **kwargs: Any) -> str:
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kwargs)
+
+
+def _get_plan_cost(plan: Any) -> float:
+    """Get the estimated total cost from the result of an ``EXPLAIN (FORMAT JSON)``."""
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return float(plan[0]["Plan"]["Total Cost"])
+
+
+def _get_filter_kind(
+    request: pyramid.request.Request,
+    filter: sqlalchemy.sql.expression.ColumnElement[bool] | None,  # pylint: disable=redefined-builtin
+) -> str:
+    """Get the kind of filter of a query, ``custom``, ``none`` or the filter params of the request."""
+    if filter is not None:
+        return "custom"
+    return ",".join(param for param in FILTER_PARAMS if param in request.params) or "none"
+
+
+def _get_budget(budget: Any, action: str) -> Any:
+    """Get the budget of an action, from a value or a dict of values per action."""
+    if isinstance(budget, dict):
+        return budget.get(action)
+    return budget
+
+
+_CURRENT_STATEMENT_TIMEOUT = select(func.current_setting("statement_timeout"))
+
+
+def _restore_statement_timeout(value: str) -> Any:
+    """Get the statement setting the statement timeout back to its value, until the end of the transaction."""
+    return select(func.set_config("statement_timeout", value, True))
+
+
+@contextlib.contextmanager
+def _raise_canceled() -> Iterator[None]:
+    """Turn the queries canceled by the database in ``HTTPServiceUnavailable`` exceptions."""
+    try:
+        yield
+    except sqlalchemy.exc.DBAPIError as e:
+        if QUERY_CANCELED not in (getattr(e.orig, "pgcode", None), getattr(e.orig, "sqlstate", None)):
+            raise
+        raise HTTPServiceUnavailable("The query was canceled by the statement timeout") from e
+
+
+def _closing(features: Iterator[Any], stack: contextlib.ExitStack) -> Iterator[Any]:
+    """Yield the streamed features, and exit the contexts of the stack once they are consumed."""
+
+    def iterate() -> Iterator[Any]:
+        with stack:
+            yield from features
+
+    iterator = iterate()
+    # Also when the iterator is dropped without being iterated
+    weakref.finalize(iterator, stack.close)
+    return iterator
+
+
+def _limited(action: str) -> Callable[[_F], _F]:
+    """Run a method of the protocol within the concurrency limit of its layer, see the ``limiter`` argument."""
+
+    def decorator(method: _F) -> _F:
+        @functools.wraps(method)
+        def wrapper(self: "Protocol", request: pyramid.request.Request, *args: Any, **kwargs: Any) -> Any:
+            if self.limiter is None:
+                return method(self, request, *args, **kwargs)
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(self.limiter.acquire(self._get_layer_name(), action))
+                result = method(self, request, *args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    # The slot is kept until the streamed features are consumed
+                    return _closing(result, stack.pop_all())
+                return result
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+_measuring: contextvars.ContextVar["Protocol | None"] = contextvars.ContextVar(
+    "papyrus_measuring", default=None
+)
+
+
+def _count_rows(result: Any) -> int:
+    """Get the number of features of the result of a method of the protocol."""
+    if isinstance(result, FeatureCollection):
+        return len(result["features"])
+    if isinstance(result, Response):
+        # The batched creations return the number of created features
+        return int(result.json_body["count"]) if result.content_type == "application/json" else 0
+    return 0 if result is None or isinstance(result, int) else 1
+
+
+def _measure_stream(
+    metrics: MetricsRegistry, layer: str, action: str, start: float, features: Generator[Any, None, None]
+) -> Iterator[Any]:
+    """Yield the streamed features, and record the duration and the number of features once they are consumed."""
+    rows = 0
+    try:
+        for feature in features:
+            rows += 1
+            yield feature
+    finally:
+        features.close()
+        metrics.duration.observe(layer, action, value=time.perf_counter() - start)
+        metrics.rows_returned.inc(layer, action, value=rows)
+
+
+def _measured(action: str) -> Callable[[_F], _F]:
+    """Record the metrics of a method of the protocol, see the ``metrics`` argument."""
+
+    def decorator(method: _F) -> _F:
+        @functools.wraps(method)
+        def wrapper(self: "Protocol", request: pyramid.request.Request, *args: Any, **kwargs: Any) -> Any:
+            # Not measured twice when a subclass calls the method of its parent
+            if self.metrics is None or _measuring.get() is self:
+                return method(self, request, *args, **kwargs)
+            metrics = self.metrics
+            layer = self._get_layer_name()
+            request.environ[METRICS_KEY] = (metrics, layer)
+            token = _measuring.set(self)
+            start = time.perf_counter()
+            status = 500
+            result = None
+            try:
+                result = method(self, request, *args, **kwargs)
+                status = result.status_int if isinstance(result, Response) else request.response.status_int
+            except HTTPException as e:
+                status = e.status_int
+                raise
+            finally:
+                _measuring.reset(token)
+                metrics.requests.inc(layer, action, str(status))
+                if not isinstance(result, types.GeneratorType):
+                    metrics.duration.observe(layer, action, value=time.perf_counter() - start)
+            if isinstance(result, types.GeneratorType):
+                return _measure_stream(metrics, layer, action, start, result)
+            if action == "read":
+                metrics.rows_returned.inc(layer, action, value=_count_rows(result))
+            elif action in ("create", "update", "delete") and 200 <= status < 300:
+                metrics.rows_written.inc(
+                    layer, action, value=1 if action == "delete" else _count_rows(result)
+                )
+            return result
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def _slow_logged(method: _F) -> _F:
+    """Log the slow queries of a method of the protocol, see the ``slow_query_threshold`` argument."""
+
+    @functools.wraps(method)
+    def wrapper(self: "Protocol", request: pyramid.request.Request, *args: Any, **kwargs: Any) -> Any:
+        with self._watch_slow_queries(request):
+            return method(self, request, *args, **kwargs)
+
+    return wrapper  # type: ignore[return-value]
+
+
+class _Call:
+    """A call in flight, whose result is shared with the identical concurrent calls."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class _SingleFlight:
+    """Run the identical concurrent calls once, the later calls waiting for the result of the first one."""
+
+    def __init__(self) -> None:
+        self._calls: dict[Any, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, function: Callable[[], Any]) -> tuple[Any, bool]:
+        """
+        Call the function, or wait for the result of the call in flight with the same key.
+
+        Return the result, and whether it is shared with the call in flight.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+def _coalesced(action: str) -> Callable[[_F], _F]:
+    """Share the result of a read method between identical concurrent requests, see the ``coalesce`` argument."""
+
+    def decorator(method: _F) -> _F:
+        @functools.wraps(method)
+        def wrapper(
+            self: "Protocol",
+            request: pyramid.request.Request,
+            filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+            *args: Any,
+            **kwargs: Any,
+        ) -> Any:
+            if not self.coalesce or any(a is not None for a in (filter, *args, *kwargs.values())):
+                return method(self, request, filter, *args, **kwargs)
+
+            def call() -> Any:
+                result = method(self, request)
+                if isinstance(result, FeatureCollection):
+                    extra = {k: v for k, v in result.items() if k not in ("type", "features")}
+                    result = SharedFeatureCollection(result["features"], **extra)
+                return result
+
+            params = tuple(sorted(request.params.items()))
+            result, shared = self._single_flight.do(
+                (action, self._get_read_session_factory(request), params), call
+            )
+            if shared:
+                self._count_cache_hit("coalesce")
+            return result
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
 def asbool(val: str) -> bool:
     r"""Convert the passed value to a boolean."""
     if isinstance(val, str):
@@ -207,6 +670,18 @@ class Protocol:
         will set 405 (Method Not Allowed) as the response status and
         return right away.
 
+    The geometries returned by ``read()`` can be reprojected by the
+    database, using the ``output_epsg`` request parameter. With the
+    ``clip`` request parameter, they are also clipped to the ``bbox``, so
+    the size of the response depends on the viewport rather than on the
+    size of the features.
+
+    With the ``nearest`` request parameter, ``read()`` returns the
+    ``nearest`` features closest to the ``lon``/``lat`` point, using the
+    ``<->`` index distance operator, rather than the features within
+    ``tolerance`` of the point. The features then include a ``distance``
+    property, and ``count()`` returns at most ``nearest``.
+
     \\**kwargs
         before_create
           a callback function called before a feature is inserted
@@ -232,6 +707,160 @@ class Protocol:
           a callback function called before a feature is deleted
           in the database table, the function receives the request
           and the database object about to be deleted.
+
+        partitions
+          the number of partitions used by ``read()`` for large result
+          sets. If greater than 1 the filtered rows are split into
+          ranges of the (integer) primary key, and the ranges are read
+          in parallel, each one in its own thread and with its own
+          session, so on its own pooled connection. The results are
+          merged according to the ``sort`` parameter, or yielded as the
+          partitions complete if there is no ``sort`` parameter. The
+          threads are started on the first partitioned read, and stopped
+          by ``close()``. Default is ``1`` (no partitioning).
+
+        partition_threshold
+          the minimum number of matching rows for the partitioning to
+          be used, smaller result sets are read with a single query.
+          Default is ``10000``.
+
+        batch_size
+          if set, ``create()`` parses the GeoJSON document incrementally
+          from the request body file, and creates the objects by batches
+          of ``batch_size`` features, flushing the session after each
+          batch. With this, the whole document and its object graph are
+          never loaded in memory: the objects are also expunged from the
+          session once flushed, and the response is a ``201`` response
+          with the number of created features as JSON body (``{"count":
+          1234}``) rather than the created features. As previous batches
+          may already be flushed, an invalid document results in an
+          ``HTTPBadRequest`` exception being raised, for the transaction to
+          be aborted. The text sequences are always created by batches, of
+          :py:data:`CREATE_BATCH_SIZE` features if ``batch_size`` is not
+          set. Default is ``None`` (the whole document is parsed at once).
+
+        name
+          the name of the layer. If set, the mapped class is registered
+          with :py:func:`register_layer`, so other protocols can filter
+          their features with ``geometry_ref=name:id``.
+
+        max_filter_vertices
+          the maximum number of vertices of the ``geometry`` filter
+          param, larger geometries are rejected with an
+          ``HTTPBadRequest``. Default is ``None`` (no limit).
+
+        simplify_filter
+          if ``True``, the ``geometry`` filter param is simplified within
+          the ``tolerance`` before its vertices are counted. Default is
+          ``False``.
+
+        subdivide_filter
+          if set, the ``geometry`` filter param is split by
+          ``ST_Subdivide`` in parts with at most this number of vertices
+          (at least 5), for each part to be matched with the spatial
+          index. Default is ``None`` (no splitting).
+
+        ReadSession
+          a session factory used for the reads (``read()``, ``count()``,
+          ``cluster()``, ``aggregate()``), for example bound to a pool of
+          read replicas, while ``Session`` is used for the writes. The
+          reader session is created once per request, and closed when the
+          request is finished. Default is ``None`` (``Session`` is used for
+          all the queries).
+
+        read_your_writes
+          a duration in seconds. If set, the responses to the writes set a
+          cookie with this lifetime, and the reads of the clients with this
+          cookie use ``Session`` rather than ``ReadSession``, for the
+          clients to read their own writes despite the replication lag.
+          Default is ``None``.
+
+        statement_timeout
+          the maximum duration of the read queries, in milliseconds, set
+          with ``SET LOCAL statement_timeout`` in the transaction of the
+          reader session, and restored after the read if it is the
+          transaction of the writes. Either a number, or a dict of numbers per
+          action (``read``, ``count``, ``cluster``, ``aggregate``). The
+          requests with canceled queries get an
+          ``HTTPServiceUnavailable`` exception. Default is ``None`` (the
+          timeout of the database).
+
+        max_limit
+          the maximum number of features returned by ``read()``. It is
+          used as the ``limit`` if the request has none, and the requests
+          with a larger ``limit`` or ``maxfeatures`` get an
+          ``HTTPRequestEntityTooLarge`` exception. Default is ``None``
+          (no limit).
+
+        max_cost
+          the maximum estimated cost of the read queries, checked with
+          ``EXPLAIN`` before they are run. Either a number, or a dict of
+          numbers per action, as for ``statement_timeout``. The requests
+          with more expensive queries get an ``HTTPRequestEntityTooLarge``
+          exception. Default is ``None`` (no check).
+
+        limiter
+          a :py:class:`papyrus.limiter.ConcurrencyLimiter`, limiting the
+          number of concurrent actions of the layer, named ``name`` or after
+          the mapped class. A limiter can be shared by several protocols,
+          each layer has its own limits. Default is ``None`` (no limit).
+
+        coalesce
+          if ``True``, the concurrent calls of ``read()`` and ``count()``
+          with the same request params, and without ``filter`` or ``id``
+          arguments, are coalesced: the first call runs the query, and the
+          others wait for its result. The feature collection is shared,
+          and only encoded once by the GeoJSON renderer, so it must not be
+          modified by the views. Default is ``False``.
+
+        stream_batch_size
+          the number of rows fetched at once by ``stream()``. Default is
+          ``1000``.
+
+        stream_queue_size
+          the maximum number of batches fetched by ``stream()`` ahead of
+          their conversion, bounding the memory used. Default is ``4``.
+
+        server_timing
+          if ``True``, the durations of the phases of the requests (``filter``,
+          ``sql``, ``orm``, ``geo``, ``attrs`` and ``dumps`` for the GeoJSON
+          renderer) are measured, and returned in a ``Server-Timing`` header.
+          Default is ``False``.
+
+        timing_callback
+          a callable receiving the request and the
+          :class:`papyrus.timing.Timings` of the phases once the response is
+          rendered, for example to record them in a monitoring system. The
+          phases are measured if it is set, even without ``server_timing``.
+          Default is ``None``.
+
+        metrics
+          a :py:class:`papyrus.metrics.MetricsRegistry`, recording the
+          number of requests, their durations, the numbers of features
+          returned and written, the number of bytes encoded by the GeoJSON
+          renderer, and the cache hits, per layer and action. A registry
+          can be shared by several protocols. Default is ``None``.
+
+        tracer
+          an OpenTelemetry compatible tracer, for example
+          ``opentelemetry.trace.get_tracer("papyrus")``, used to create
+          spans for the queries (``papyrus.query``, ``papyrus.count``), the
+          conversion of the objects into features and of the request bodies
+          (``papyrus.decode``), the writes (``papyrus.flush``,
+          ``papyrus.delete``) and the encoding by the GeoJSON renderer
+          (``papyrus.encode``). Default is ``None`` (no spans).
+
+        slow_query_threshold
+          the duration, in seconds, above which the SQL statements are logged
+          as slow queries, with their parameters and the params of the
+          request, on the ``papyrus.slowlog`` logger. Default is ``None`` (no
+          log).
+
+        explain_slow_queries
+          if ``True`` the ``EXPLAIN (ANALYZE, BUFFERS)`` output of the slow
+          PostgreSQL ``SELECT`` statements is logged too. The statements are
+          executed again, in a read only transaction of a background thread.
+          Default is ``False``.
     """
 
     def __init__(
@@ -246,15 +875,66 @@ class Protocol:
         before_update: Callable[[pyramid.request.Request, geojson.Feature, Any], Any] | None = None,
         before_delete: Callable[[pyramid.request.Request, Any], Any] | None = None,
         before_insert: Callable[[pyramid.request.Request, geojson.Feature, Any], Any] | None = None,
+        partitions: int = 1,
+        partition_threshold: int = 10000,
+        batch_size: int | None = None,
+        name: str | None = None,
+        max_filter_vertices: int | None = None,
+        simplify_filter: bool = False,
+        subdivide_filter: int | None = None,
+        ReadSession: Callable[[], Any] | None = None,  # pylint: disable=invalid-name
+        read_your_writes: float | None = None,
+        statement_timeout: float | dict[str, float] | None = None,
+        max_limit: int | None = None,
+        max_cost: float | dict[str, float] | None = None,
+        limiter: ConcurrencyLimiter | None = None,
+        coalesce: bool = False,
+        stream_batch_size: int = 1000,
+        stream_queue_size: int = 4,
+        server_timing: bool = False,
+        timing_callback: Callable[[pyramid.request.Request, Timings], Any] | None = None,
+        metrics: MetricsRegistry | None = None,
+        tracer: Any = None,
+        slow_query_threshold: float | None = None,
+        explain_slow_queries: bool = False,
     ) -> None:
         self.Session = Session  # pylint: disable=invalid-name
         self.mapped_class = mapped_class
         self.geom_attr = geom_attr
         self.readonly = readonly
+        self.name = name
+        if name is not None:
+            register_layer(name, mapped_class, geom_attr)
         self.before_create = before_create
         self.before_update = before_update
         self.before_delete = before_delete
         self.before_insert = before_insert
+        self.partitions = partitions
+        self.partition_threshold = partition_threshold
+        self.batch_size = batch_size
+        self.max_filter_vertices = max_filter_vertices
+        self.simplify_filter = simplify_filter
+        if subdivide_filter is not None and subdivide_filter < 5:
+            raise ValueError(f"subdivide_filter must be at least 5, got {subdivide_filter}")
+        self.subdivide_filter = subdivide_filter
+        self.ReadSession = ReadSession  # pylint: disable=invalid-name
+        self.read_your_writes = read_your_writes
+        self.statement_timeout = statement_timeout
+        self.max_limit = max_limit
+        self.max_cost = max_cost
+        self.limiter = limiter
+        self.coalesce = coalesce
+        self._single_flight = _SingleFlight()
+        self.stream_batch_size = stream_batch_size
+        self.stream_queue_size = stream_queue_size
+        self.server_timing = server_timing
+        self.timing_callback = timing_callback
+        self.metrics = metrics
+        self.tracer = tracer
+        self.slow_query_threshold = slow_query_threshold
+        self.explain_slow_queries = explain_slow_queries
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
 
     def _filter_attrs(self, feature: geojson.Feature, request: pyramid.request.Request) -> geojson.Feature:
         """
@@ -276,6 +956,151 @@ class Protocol:
             feature.geometry = None
         return feature
 
+    def _get_read_session_factory(self, request: pyramid.request.Request) -> Callable[[], Any]:
+        """
+        Get the session factory used for the reads of the request.
+
+        ``Session`` is used if there is no ``ReadSession``, or if the client
+        recently wrote, see ``read_your_writes``.
+        """
+        if self.ReadSession is None or (
+            self.read_your_writes is not None and WRITE_COOKIE_NAME in getattr(request, "cookies", {})
+        ):
+            return self.Session
+        return self.ReadSession
+
+    def _get_read_session(self, request: pyramid.request.Request) -> Any:
+        """Get the session used for the reads of the request, created once per request."""
+        factory = self._get_read_session_factory(request)
+        if factory is self.Session:
+            return self.Session()
+        sessions = request.environ.setdefault("papyrus.read_sessions", {})
+        session = sessions.get(factory)
+        if session is None:
+            session = sessions[factory] = factory()
+            if hasattr(request, "add_finished_callback"):
+                request.add_finished_callback(lambda request: session.close())
+        return session
+
+    def _set_write_cookie(self, response: pyramid.response.Response) -> None:
+        """Set the cookie routing the next reads of the client to ``Session``, see ``read_your_writes``."""
+        if self.read_your_writes is not None:
+            response.set_cookie(
+                WRITE_COOKIE_NAME, "1", max_age=int(self.read_your_writes), httponly=True, samesite="Lax"
+            )
+
+    def _get_budget_statements(self, query: Any, action: str) -> list[tuple[Any, float | None]]:
+        """
+        Get the statements to run before a read query, with the maximum cost of their result.
+
+        The query can either be an ORM ``Query`` or a ``Select`` statement, its
+        estimated cost is not checked if it is ``None``.
+        """
+        statements: list[tuple[Any, float | None]] = []
+        timeout = _get_budget(self.statement_timeout, action)
+        if timeout is not None:
+            statements.append((sqlalchemy.text(f"SET LOCAL statement_timeout = {int(timeout)}"), None))
+        max_cost = _get_budget(self.max_cost, action)
+        if max_cost is not None and query is not None:
+            statements.append((_Explain(getattr(query, "statement", query)), max_cost))
+        return statements
+
+    def _apply_budget(self, session: Any, query: Any, action: str) -> None:
+        """Set the statement timeout, and check the estimated cost of a read query."""
+        for budget_statement, max_cost in self._get_budget_statements(query, action):
+            result = session.execute(budget_statement)
+            if max_cost is not None:
+                self._check_cost(result.scalar(), max_cost)
+
+    def _shares_write_transaction(self, request: pyramid.request.Request) -> bool:
+        """Return whether the reads of the request are done in the transaction of the writes."""
+        return self._get_read_session_factory(request) is self.Session
+
+    @contextlib.contextmanager
+    def _budget(
+        self, request: pyramid.request.Request, session: Any, query: Any, action: str
+    ) -> Iterator[None]:
+        """
+        Run a read query within its budget, see ``_apply_budget``.
+
+        If the read is done in the transaction of the writes, the statement
+        timeout is restored after the read, not to apply to the next writes.
+        """
+        previous = None
+        if _get_budget(self.statement_timeout, action) is not None and self._shares_write_transaction(
+            request
+        ):
+            previous = session.execute(_CURRENT_STATEMENT_TIMEOUT).scalar()
+        try:
+            self._apply_budget(session, query, action)
+            yield
+        except sqlalchemy.exc.DBAPIError:
+            # The transaction is aborted, and its statement timeout with it
+            previous = None
+            raise
+        finally:
+            if previous is not None:
+                session.execute(_restore_statement_timeout(previous))
+
+    def _check_cost(self, plan: Any, max_cost: float) -> None:
+        cost = _get_plan_cost(plan)
+        if cost > max_cost:
+            raise HTTPRequestEntityTooLarge(f"The estimated cost of the query ({cost}) exceeds {max_cost}")
+
+    def _get_layer_name(self) -> str:
+        """Get the name of the layer, used by the limiter and the metrics."""
+        return self.name or self.mapped_class.__name__  # type: ignore[no-any-return]
+
+    def _start_span(
+        self, request: pyramid.request.Request, name: str, attributes: dict[str, Any] | None = None
+    ) -> contextlib.AbstractContextManager[Any]:
+        """Start a tracing span, with the layer name and the SRID as attributes, see ``tracer``."""
+        if self.tracer is None:
+            return start_span(None, name)
+        request.environ[TRACER_KEY] = self.tracer
+        return start_span(
+            self.tracer,
+            name,
+            {
+                "papyrus.layer": self._get_layer_name(),
+                "papyrus.srid": _get_col_epsg(self.mapped_class, self.geom_attr),
+                **(attributes or {}),
+            },
+        )
+
+    def _watch_slow_queries(
+        self, request: pyramid.request.Request
+    ) -> contextlib.AbstractContextManager[None]:
+        """Log the slow queries executed within the block, see ``slow_query_threshold``."""
+        if self.slow_query_threshold is None:
+            return contextlib.nullcontext()
+        return watch(request, self._get_layer_name(), self.slow_query_threshold, self.explain_slow_queries)
+
+    def _count_cache_hit(self, cache: str) -> None:
+        """Count a request served without its own query, see ``metrics``."""
+        if self.metrics is not None:
+            self.metrics.cache_hits.inc(self._get_layer_name(), cache)
+
+    def _get_timings(self, request: pyramid.request.Request) -> Timings | None:
+        """Get the timings of the phases of the request, if enabled, see ``server_timing``."""
+        if not self.server_timing and self.timing_callback is None:
+            return None
+        return get_timings(request, header=self.server_timing, callback=self.timing_callback)
+
+    def _create_filter(
+        self, request: pyramid.request.Request
+    ) -> sqlalchemy.sql.expression.ColumnElement[bool] | None:
+        """Create the default filter, with the filter geometry options of the protocol."""
+        with phase(self._get_timings(request), "filter"):
+            return create_filter(
+                request,
+                self.mapped_class,
+                self.geom_attr,
+                max_vertices=self.max_filter_vertices,
+                simplify=self.simplify_filter,
+                subdivide=self.subdivide_filter,
+            )
+
     def _get_order_by(
         self,
         request: pyramid.request.Request,
@@ -288,16 +1113,123 @@ class Protocol:
             return desc(getattr(self.mapped_class, attr))
         return asc(getattr(self.mapped_class, attr))
 
-    def _query(
+    def _get_output_geom(
+        self, request: pyramid.request.Request
+    ) -> sqlalchemy.sql.expression.ColumnElement[Any] | None:
+        """
+        Get the expression of the geometry to return, based on the request params.
+
+        The geometries are clipped to the ``bbox`` (expanded by the
+        ``tolerance``) with the ``clip`` param, and reprojected with the
+        ``output_epsg`` param. Return ``None`` if the geometry column can be
+        returned as it is.
+        """
+        if asbool(request.params.get("no_geom", False)):
+            return None
+        column_epsg = _get_col_epsg(self.mapped_class, self.geom_attr)
+        geom = getattr(self.mapped_class, self.geom_attr)
+        clip = asbool(request.params.get("clip", False)) and "bbox" in request.params
+        if clip:
+            box = [float(x) for x in request.params["bbox"].split(",")]
+            epsg = int(request.params.get("epsg", column_epsg))
+            envelope = func.ST_MakeEnvelope(*box, epsg)
+            tolerance = float(request.params.get("tolerance", 0.0))
+            if tolerance > 0:
+                envelope = func.ST_Expand(envelope, tolerance)
+            # Transform the box rather than the geometries, the clipping box
+            # is then the extent of the transformed box
+            if epsg != column_epsg:
+                envelope = func.ST_Transform(envelope, column_epsg)
+            geom = func.ST_ClipByBox2D(geom, envelope)
+        output_epsg = int(request.params.get("output_epsg", column_epsg))
+        if output_epsg != column_epsg:
+            return func.ST_Transform(geom, output_epsg)
+        return geom if clip else None
+
+    def _get_nearest(
         self,
         request: pyramid.request.Request,
-        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
-    ) -> list[Any]:
+    ) -> tuple[Any, sqlalchemy.sql.expression.ColumnElement[Any]] | None:
         """
-        Build a query based on the filter and the request params.
+        Get the geometry column and the reference point of a nearest neighbours query.
 
-        And send the query to the database.
+        Return ``None`` if the request params do not define such a query.
+        """
+        from geoalchemy2.shape import from_shape
+        from shapely.geometry.point import Point
+
+        if "nearest" not in request.params or "lon" not in request.params or "lat" not in request.params:
+            return None
+        column_epsg = _get_col_epsg(self.mapped_class, self.geom_attr)
+        epsg = int(request.params.get("epsg", column_epsg))
+        point = from_shape(Point(float(request.params["lon"]), float(request.params["lat"])), srid=epsg)
+        # Transform the point rather than the column for the index to be used
+        if epsg != column_epsg:
+            point = func.ST_Transform(point, column_epsg)
+        return getattr(self.mapped_class, self.geom_attr), point
+
+    def _get_nearest_count(self, request: pyramid.request.Request) -> int | None:
+        """
+        Get the number of features of a nearest neighbours query.
+
+        The ``lon``/``lat`` params then define no filter, ``count()`` is
+        bounded by this number, as ``read()``.
+        """
+        if self._get_nearest(request) is None:
+            return None
+        return int(request.params["nearest"])
+
+    def _get_columns(
+        self, request: pyramid.request.Request
+    ) -> list[sqlalchemy.sql.expression.ColumnElement[Any]]:
+        """Get the columns to select in addition to the mapped class, based on the request params."""
+        columns = []
+        output_geom = self._get_output_geom(request)
+        if output_geom is not None:
+            columns.append(output_geom.label(OUTPUT_GEOM_LABEL))
+        nearest = self._get_nearest(request)
+        if nearest is not None:
+            columns.append(func.ST_Distance(*nearest).label("distance"))
+        return columns
+
+    def _get_pk_filter(self, id: str) -> sqlalchemy.sql.expression.ColumnElement[bool]:  # pylint: disable=redefined-builtin
+        """Get the filter on the primary key of the mapped class, it cannot be composite."""
+        primary_key = class_mapper(self.mapped_class).primary_key
+        if len(primary_key) != 1:
+            raise HTTPBadRequest("The features have a composite primary key, they cannot be read by id")
+        return primary_key[0] == id  # type: ignore[no-any-return]
+
+    def _to_feature(self, obj: Any, request: pyramid.request.Request) -> geojson.Feature:
+        """
+        Convert a mapped object into a feature, filtered according to the request params.
+
+        ``obj`` can also be a row including the mapped object and the
+        additional columns returned by ``_get_columns()``.
         """
+        timings = self._get_timings(request)
+        with phase(timings, "geo"):
+            columns: list[tuple[str, Any]] = []
+            if isinstance(obj, Row):
+                columns = list(zip(obj._fields[1:], obj[1:], strict=True))
+                obj = obj[0]
+            feature = obj.__geo_interface__
+            properties = {}
+            for name, value in columns:
+                if name == OUTPUT_GEOM_LABEL:
+                    from geoalchemy2.shape import to_shape
+
+                    feature.geometry = (
+                        GeoJSON.to_instance(to_shape(value), strict=True) if value is not None else None
+                    )
+                else:
+                    properties[name] = value
+            with phase(timings, "attrs"):
+                feature = self._filter_attrs(feature, request)
+            feature.properties.update(properties)
+            return feature
+
+    def _get_limit_offset(self, request: pyramid.request.Request) -> tuple[int | None, int | None]:
+        """Get the limit and the offset, based on the request params."""
         limit = None
         offset = None
         if "maxfeatures" in request.params:
@@ -306,88 +1238,645 @@ class Protocol:
             limit = int(request.params["limit"])
         if "offset" in request.params:
             offset = int(request.params["offset"])
-        if filter is None:
-            filter = create_filter(request, self.mapped_class, self.geom_attr)
-        query = self.Session().query(self.mapped_class)
-        if filter is not None:
-            query = query.filter(filter)
-        order_by = self._get_order_by(request)
-        if order_by is not None:
-            query = query.order_by(order_by)
-        query = query.limit(limit).offset(offset)
-        return query.all()  # type: ignore[no-any-return]
+        if self.max_limit is not None:
+            if limit is None:
+                limit = self.max_limit
+            elif limit > self.max_limit:
+                raise HTTPRequestEntityTooLarge(f"The limit exceeds {self.max_limit}")
+        return limit, offset
 
-    def count(
+    def _filter_query(
         self,
+        query: Any,
         request: pyramid.request.Request,
         filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
-    ) -> int:
-        """Return the number of records matching the given filter."""
+    ) -> Any:
+        """
+        Apply the filter and the request params to a query.
+
+        The query can either be an ORM ``Query`` or a ``Select`` statement.
+        """
+        limit, offset = self._get_limit_offset(request)
         if filter is None:
-            filter = create_filter(request, self.mapped_class, self.geom_attr)
-        query = self.Session().query(self.mapped_class)
+            filter = self._create_filter(request)
         if filter is not None:
             query = query.filter(filter)
-        return query.count()  # type: ignore[no-any-return]
+        nearest = self._get_nearest(request)
+        if nearest is not None:
+            # K nearest neighbours, using the index through the distance operator
+            query = query.order_by(nearest[0].distance_centroid(nearest[1]))
+            # The pages stay within the nearest features
+            count = int(request.params["nearest"]) - (offset or 0)
+            limit = max(0, count if limit is None else min(limit, count))
+        else:
+            order_by = self._get_order_by(request)
+            if order_by is not None:
+                query = query.order_by(order_by)
+        return query.limit(limit).offset(offset)
 
-    def read(
+    def _query(
         self,
         request: pyramid.request.Request,
         filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
-        id: str | None = None,  # pylint: disable=redefined-builtin
-    ) -> Any:
+    ) -> list[Any]:
         """
-        Build a query based on the filter or the identifier.
+        Build a query based on the filter and the request params.
 
-        Send the query to the database, and return a Feature or a FeatureCollection.
+        And send the query to the database.
         """
-        ret = None
-        if id is not None:
-            o = self.Session().query(self.mapped_class).get(id)
-            if o is None:
-                return HTTPNotFound()
-            # FIXME: we return a Feature here, not a mapped object, do # pylint: disable=fixme
-            # we really want that?
-            ret = self._filter_attrs(o.__geo_interface__, request)
-        else:
-            objs = self._query(request, filter)
-            ret = FeatureCollection(
-                [self._filter_attrs(o.__geo_interface__, request) for o in objs if o is not None],
+        with self._start_span(
+            request, "papyrus.query", {"papyrus.filter": _get_filter_kind(request, filter)}
+        ) as span:
+            session = self._get_read_session(request)
+            query = self._filter_query(
+                session.query(self.mapped_class, *self._get_columns(request)), request, filter
             )
-        return ret
+            with phase(self._get_timings(request), "orm"), self._budget(request, session, query, "read"):
+                objs = query.all()
+            if span.is_recording():
+                span.set_attribute("papyrus.rows", len(objs))
+            return objs  # type: ignore[no-any-return]
 
-    def create(self, request: pyramid.request.Request) -> Any:
+    def _get_partitions(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None,  # pylint: disable=redefined-builtin
+    ) -> list[sqlalchemy.sql.expression.ColumnElement[bool]] | None:
         """
-        Read the GeoJSON feature collection from the request body.
+        Split the rows matching the filter into primary key ranges.
 
-        And create new objects in the database.
+        Return one filter per partition, or ``None`` if the result set should
+        not be partitioned.
         """
-        if self.readonly:
-            return HTTPMethodNotAllowed(headers={"Allow": "GET, HEAD"})
-        collection = loads(request.body, object_hook=GeoJSON.to_instance)
-        if not isinstance(collection, FeatureCollection):
-            return HTTPBadRequest()
-        session = self.Session()
-        objects = []
-        for feature in collection.features:
-            obj = None
-            if hasattr(feature, "id") and feature.id is not None:
-                obj = session.query(self.mapped_class).get(feature.id)
-            if self.before_create is not None:
-                self.before_create(request, feature, obj)
-            if obj is None:
-                obj = self.mapped_class(feature)
-                if self.before_insert is not None:
-                    self.before_insert(request, feature, obj)
-                session.add(obj)
-            else:
-                obj.__update__(feature)
-            objects.append(obj)
-        session.flush()
-        collection = FeatureCollection(objects) if len(objects) > 0 else None
+        if "offset" in request.params or "nearest" in request.params:
+            return None
+        primary_key = class_mapper(self.mapped_class).primary_key
+        if len(primary_key) != 1:
+            return None
+        pk = primary_key[0]
+        try:
+            if not issubclass(pk.type.python_type, int):
+                return None
+        except NotImplementedError:
+            return None
+        session = self._get_read_session(request)
+        query = session.query(func.count(pk), func.min(pk), func.max(pk))
+        if filter is not None:
+            query = query.filter(filter)
+        with phase(self._get_timings(request), "orm"), self._budget(request, session, query, "read"):
+            count, low, high = query.one()
+        if count == 0 or count < self.partition_threshold:
+            return None
+        step = (high - low) // self.partitions + 1
+        partitions = []
+        for start in range(low, high + 1, step):
+            partition = and_(pk >= start, pk < start + step)
+            partitions.append(partition if filter is None else and_(filter, partition))
+        return partitions
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Get the pool of threads reading the partitions, started on the first use."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.partitions)
+                weakref.finalize(self, self._executor.shutdown)
+            return self._executor
+
+    def close(self) -> None:
+        """Stop the threads reading the partitions, they are started again on the next partitioned read."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _read_partition(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool],  # pylint: disable=redefined-builtin
+    ) -> list[Any]:
+        """Read a partition, in a worker thread and with its own session."""
+        session = self._get_read_session_factory(request)()
+        try:
+            query = session.query(self.mapped_class, *self._get_columns(request))
+            query = self._filter_query(query, request, filter)
+            # The estimated cost is checked on the whole result set by _get_partitions()
+            self._apply_budget(session, None, "read")
+            return query.all()  # type: ignore[no-any-return]
+        finally:
+            session.close()
+
+    def _partitioned_query(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Iterator[Any]:
+        """
+        Read the objects matching the filter in parallel partitions.
+
+        Fall back to ``_query()`` for small result sets.
+        """
+        if filter is None:
+            filter = self._create_filter(request)
+        partitions = self._get_partitions(request, filter)
+        if partitions is None:
+            yield from self._query(request, filter)
+            return
+        executor = self._get_executor()
+        # With the context of the request, for its timings and slow query log
+        futures = [
+            executor.submit(contextvars.copy_context().run, self._read_partition, request, p)
+            for p in partitions
+        ]
+        limit, _ = self._get_limit_offset(request)
+        objs: Iterable[Any]
+        if self._get_order_by(request) is not None:
+            attr = request.params.get("sort", request.params.get("order_by"))
+
+            def key(obj: Any) -> tuple[Any, ...]:
+                value = getattr(obj[0] if isinstance(obj, Row) else obj, attr)
+                # NULLs last in ascending order, as in PostgreSQL
+                return (1,) if value is None else (0, value)
+
+            reverse = request.params.get("dir", "").upper() == "DESC"
+            objs = heapq.merge(*(f.result() for f in futures), key=key, reverse=reverse)
+        else:
+            objs = itertools.chain.from_iterable(f.result() for f in as_completed(futures))
+        yield from itertools.islice(objs, limit)
+
+    @_measured("count")
+    @_coalesced("count")
+    @_limited("count")
+    @_slow_logged
+    def count(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> int:
+        """Return the number of records matching the given filter."""
+        with self._start_span(
+            request, "papyrus.count", {"papyrus.filter": _get_filter_kind(request, filter)}
+        ) as span:
+            if filter is None:
+                filter = self._create_filter(request)
+            session = self._get_read_session(request)
+            query = session.query(self.mapped_class)
+            if filter is not None:
+                query = query.filter(filter)
+            nearest_count = self._get_nearest_count(request)
+            if nearest_count is not None:
+                # Counted in a subquery, not to scan more rows than read() returns
+                query = query.limit(nearest_count)
+            with (
+                _raise_canceled(),
+                phase(self._get_timings(request), "orm"),
+                self._budget(request, session, query, "count"),
+            ):
+                count = query.count()
+            span.set_attribute("papyrus.rows", count)
+            return count  # type: ignore[no-any-return]
+
+    @_measured("read")
+    @_coalesced("read")
+    @_limited("read")
+    @_slow_logged
+    def read(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+        id: str | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """
+        Build a query based on the filter or the identifier.
+
+        Send the query to the database, and return a Feature or a FeatureCollection.
+        """
+        ret = None
+        if id is not None:
+            columns = self._get_columns(request)
+            with phase(self._get_timings(request), "orm"):
+                if columns:
+                    pk_filter = self._get_pk_filter(id)
+                    query = self._get_read_session(request).query(self.mapped_class, *columns)
+                    o = query.filter(pk_filter).one_or_none()
+                else:
+                    o = self._get_read_session(request).query(self.mapped_class).get(id)
+            if o is None:
+                return HTTPNotFound()
+            # FIXME: we return a Feature here, not a mapped object, do # pylint: disable=fixme
+            # we really want that?
+            ret = self._to_feature(o, request)
+        else:
+            with _raise_canceled():
+                objs = (
+                    self._partitioned_query(request, filter)
+                    if self.partitions > 1
+                    else self._query(request, filter)
+                )
+                with self._start_span(request, "papyrus.decode") as span:
+                    ret = FeatureCollection([self._to_feature(o, request) for o in objs if o is not None])
+                    span.set_attribute("papyrus.features", len(ret.features))
+        return ret
+
+    @_measured("read")
+    @_limited("read")
+    @_slow_logged
+    def stream(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Iterator[geojson.Feature]:
+        """
+        Build a query based on the filter and the request params.
+
+        And yield the features as they are read from a server side cursor. The
+        rows are fetched by batches in a thread, with its own session, while
+        the previous batches are converted in the calling thread, and encoded
+        by the GeoJSON renderer when the iterator is returned by the view.
+        The estimated cost of the query is checked before the iterator is
+        returned, see ``max_cost``.
+        """
+        columns = self._get_columns(request)
+        stmt = self._filter_query(select(self.mapped_class, *columns), request, filter)
+        max_cost = _get_budget(self.max_cost, "read")
+        if max_cost is not None:
+            # Before the response is started, for the request to get a 413
+            with _raise_canceled():
+                plan = self._get_read_session(request).execute(_Explain(stmt)).scalar()
+            self._check_cost(plan, max_cost)
+        return self._stream(request, stmt, bool(columns))
+
+    def _stream(
+        self, request: pyramid.request.Request, stmt: Any, columns: bool
+    ) -> Iterator[geojson.Feature]:
+        """Fetch the rows of the statement in a thread, and yield the features."""
+        factory = self._get_read_session_factory(request)
+        batches: queue.Queue[list[Any] | BaseException | None] = queue.Queue(self.stream_queue_size)
+        stop = threading.Event()
+
+        def put(item: list[Any] | BaseException | None) -> bool:
+            # Give up when the consumer is gone, rather than blocking on the full queue
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch() -> None:
+            session = factory()
+            error = None
+            try:
+                with self._watch_slow_queries(request):
+                    # The cost is already checked, only set the statement timeout
+                    self._apply_budget(session, None, "read")
+                    result = session.execute(stmt.execution_options(yield_per=self.stream_batch_size))
+                    for rows in result.partitions():
+                        if not put(list(rows) if columns else [row[0] for row in rows]):
+                            return
+            except Exception as e:  # noqa: BLE001 # pylint: disable=broad-exception-caught
+                error = e
+            finally:
+                session.close()
+            # The end of the rows, or the error
+            put(error)
+
+        threading.Thread(target=fetch, daemon=True).start()
+        try:
+            with _raise_canceled():
+                while (batch := batches.get()) is not None:
+                    if isinstance(batch, BaseException):
+                        raise batch
+                    for o in batch:
+                        yield self._to_feature(o, request)
+        finally:
+            stop.set()
+
+    def _get_aggregates(self, request: pyramid.request.Request) -> list[tuple[str, str]]:
+        """
+        Get the aggregates requested with the ``aggregate`` param.
+
+        The param is a comma-separated list of ``attribute:function`` items,
+        for example ``population:sum,height:max``.
+        """
+        aggregates = []
+        column_keys = _get_column_keys(self.mapped_class)
+        for item in request.params.get("aggregate", "").split(","):
+            if not item:
+                continue
+            attr, _, function = item.partition(":")
+            if attr not in column_keys or function not in AGGREGATE_FUNCTIONS:
+                raise HTTPBadRequest(f"Invalid aggregate: {item}")
+            aggregates.append((attr, function))
+        return aggregates
+
+    def _build_cluster_query(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> sqlalchemy.orm.Query[Any]:
+        """Build the clustering query based on the filter and the request params, without session."""
+        if "resolution" not in request.params:
+            raise HTTPBadRequest("Missing resolution")
+        resolution = float(request.params["resolution"])
+        geom = getattr(self.mapped_class, self.geom_attr)
+        if "output_epsg" in request.params:
+            geom = func.ST_Transform(geom, int(request.params["output_epsg"]))
+        method = request.params.get("method", "grid")
+        if method == "grid":
+            key = func.ST_SnapToGrid(func.ST_Centroid(geom), resolution)
+        elif method == "dbscan":
+            key = func.ST_ClusterDBSCAN(geom, resolution, 1).over()
+        else:
+            raise HTTPBadRequest(f"Invalid clustering method: {method}")
+        aggregates = self._get_aggregates(request)
+        if filter is None:
+            filter = self._create_filter(request)
+        subquery = select(
+            geom.label("geom"),
+            key.label("cluster"),
+            *(
+                getattr(self.mapped_class, attr).label(attr)
+                for attr in dict.fromkeys(attr for attr, _ in aggregates)
+            ),
+        )
+        if filter is not None:
+            subquery = subquery.filter(filter)
+        cluster = subquery.subquery()
+        return sqlalchemy.orm.Query(
+            [
+                func.count().label("count"),
+                func.ST_Centroid(func.ST_Collect(cluster.c.geom)).label("geom"),
+                *(
+                    getattr(func, function)(cluster.c[attr]).label(f"{attr}_{function}")
+                    for attr, function in aggregates
+                ),
+            ]
+        ).group_by(cluster.c.cluster)
+
+    def _cluster_query(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> sqlalchemy.orm.Query[Any]:
+        """Build the clustering query based on the filter and the request params, with the read session."""
+        return self._build_cluster_query(request, filter).with_session(self._get_read_session(request))
+
+    @staticmethod
+    def _to_cluster_features(rows: Iterable[Any]) -> FeatureCollection:
+        """Convert the rows of the clustering query into point features."""
+        from geoalchemy2.shape import to_shape
+
+        features = []
+        for row in rows:
+            properties = row._asdict()
+            geom = properties.pop("geom")
+            features.append(
+                Feature(geometry=to_shape(geom) if geom is not None else None, properties=properties)
+            )
+        return FeatureCollection(features)
+
+    @_measured("cluster")
+    @_limited("cluster")
+    @_slow_logged
+    def cluster(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """
+        Cluster the features matching the filter in the database.
+
+        Return a FeatureCollection including one point feature per cluster,
+        with a ``count`` property and the aggregated attributes. The
+        ``resolution`` param gives the size of the grid cells, or the
+        maximum distance between clustered features with ``method=dbscan``,
+        in the units of the column SRID, or of ``output_epsg`` if specified.
+        The ``aggregate`` param is a comma-separated list of
+        ``attribute:function`` items (``sum``, ``avg``, ``min`` or ``max``),
+        the aggregated properties are named ``attribute_function``.
+        """
+        try:
+            query = self._cluster_query(request, filter)
+        except HTTPBadRequest as e:
+            return e
+        with _raise_canceled():
+            with (
+                phase(self._get_timings(request), "orm"),
+                self._budget(request, query.session, query, "cluster"),
+            ):
+                rows = query.all()
+            return self._to_cluster_features(rows)
+
+    def _build_aggregate_query(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> sqlalchemy.orm.Query[Any]:
+        """Build the grid aggregation query based on the filter and the request params, without session."""
+        from geoalchemy2.types import Geometry
+
+        if "size" not in request.params:
+            raise HTTPBadRequest("Missing size")
+        size = float(request.params["size"])
+        grid_function = GRID_FUNCTIONS.get(request.params.get("shape", "square"))
+        if grid_function is None:
+            raise HTTPBadRequest(f"Invalid grid shape: {request.params['shape']}")
+        aggregates = self._get_aggregates(request)
+        if filter is None:
+            filter = self._create_filter(request)
+        column_epsg = _get_col_epsg(self.mapped_class, self.geom_attr)
+        geom = getattr(self.mapped_class, self.geom_attr)
+        if "bbox" in request.params:
+            box = [float(x) for x in request.params["bbox"].split(",")]
+            epsg = int(request.params.get("epsg", column_epsg))
+            bounds = func.ST_MakeEnvelope(*box, epsg)
+            if epsg != column_epsg:
+                bounds = func.ST_Transform(bounds, column_epsg)
+        else:
+            extent = select(func.ST_SetSRID(func.ST_Extent(geom), column_epsg))
+            if filter is not None:
+                extent = extent.filter(filter)
+            bounds = extent.scalar_subquery()
+        grid = getattr(func, grid_function)(size, bounds).table_valued(
+            column("geom", Geometry(srid=column_epsg)), "i", "j"
+        )
+        cell = grid.c.geom
+        if "output_epsg" in request.params:
+            cell = func.ST_Transform(cell, int(request.params["output_epsg"]))
+        condition = func.ST_Intersects(grid.c.geom, geom)
+        if filter is not None:
+            condition = and_(condition, filter)
+        return (
+            sqlalchemy.orm.Query(
+                [
+                    cell.label("geom"),
+                    grid.c.i,
+                    grid.c.j,
+                    func.count().label("count"),
+                    *(
+                        getattr(func, function)(getattr(self.mapped_class, attr)).label(f"{attr}_{function}")
+                        for attr, function in aggregates
+                    ),
+                ]
+            )
+            .select_from(grid)
+            .join(self.mapped_class, condition)
+            .group_by(grid.c.geom, grid.c.i, grid.c.j)
+        )
+
+    def _aggregate_query(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> sqlalchemy.orm.Query[Any]:
+        """Build the grid aggregation query based on the filter and the request params, with the read session."""
+        return self._build_aggregate_query(request, filter).with_session(self._get_read_session(request))
+
+    @staticmethod
+    def _to_cell_feature(row: Any) -> geojson.Feature:
+        """Convert a row of the grid aggregation query into a polygon feature."""
+        from geoalchemy2.shape import to_shape
+
+        properties = row._asdict()
+        geom = properties.pop("geom")
+        return Feature(geometry=to_shape(geom), properties=properties)
+
+    @_measured("aggregate")
+    @_limited("aggregate")
+    @_slow_logged
+    def aggregate(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """
+        Compute statistics on the features matching the filter per grid cell, in the database.
+
+        Return a FeatureCollection including one polygon feature per non-empty
+        cell, with ``i``, ``j`` and ``count`` properties, and the aggregated
+        attributes. The ``size`` param gives the size of the cells in the
+        units of the column SRID, and the ``shape`` param their shape,
+        ``square`` (default) or ``hexagon``. The grid covers the ``bbox``
+        param, or the extent of the matching features. The ``aggregate``
+        param is the same as for ``cluster()``.
+        """
+        try:
+            query = self._aggregate_query(request, filter)
+        except HTTPBadRequest as e:
+            return e
+        with (
+            _raise_canceled(),
+            phase(self._get_timings(request), "orm"),
+            self._budget(request, query.session, query, "aggregate"),
+        ):
+            return FeatureCollection([self._to_cell_feature(row) for row in query.yield_per(1000)])
+
+    def _create_object(
+        self,
+        session: sqlalchemy.orm.session.Session,
+        request: pyramid.request.Request,
+        feature: geojson.Feature,
+    ) -> Any:
+        """Create a new object from the feature, or update the existing one."""
+        obj = None
+        if hasattr(feature, "id") and feature.id is not None:
+            obj = session.query(self.mapped_class).get(feature.id)
+        if self.before_create is not None:
+            self.before_create(request, feature, obj)
+        if obj is None:
+            obj = self.mapped_class(feature)
+            if self.before_insert is not None:
+                self.before_insert(request, feature, obj)
+            session.add(obj)
+        else:
+            obj.__update__(feature)
+        return obj
+
+    def _iter_body_features(self, request: pyramid.request.Request) -> Iterator[geojson.Feature] | None:
+        """
+        Read the features of the request body incrementally, if they are to be created by batches.
+
+        That is for the text sequences, and for the collections if
+        ``batch_size`` is set, ``None`` is returned otherwise.
+        """
+        separator = SEQ_SEPARATORS.get(getattr(request, "content_type", None) or "")
+        if separator is not None:
+            return iter_seq_features(request.body_file, separator)
+        if self.batch_size is not None:
+            return iter_features(request.body_file)
+        return None
+
+    def _create_batches(
+        self,
+        request: pyramid.request.Request,
+        features: Iterator[geojson.Feature],
+    ) -> int:
+        """
+        Read the features incrementally from an iterator.
+
+        And create the objects by batches of ``batch_size`` features, return
+        the number of created objects.
+        """
+        session = self.Session()
+        count = 0
+        try:
+            while True:
+                batch = list(itertools.islice(features, self.batch_size or CREATE_BATCH_SIZE))
+                if not batch:
+                    break
+                objects = [self._create_object(session, request, feature) for feature in batch]
+                session.flush()
+                # Not kept in the identity map, for the memory to be bounded by the batch size
+                for obj in objects:
+                    session.expunge(obj)
+                count += len(objects)
+        except ValueError as e:
+            # Raise rather than return the error for the transaction, that may
+            # already include previous batches, to be aborted.
+            raise HTTPBadRequest(str(e)) from e
+        return count
+
+    @_measured("create")
+    @_limited("create")
+    @_slow_logged
+    def create(self, request: pyramid.request.Request) -> Any:
+        """
+        Read the GeoJSON feature collection from the request body.
+
+        And create new objects in the database. The request body can also be
+        a GeoJSON text sequence (``application/geo+json-seq`` or
+        ``application/x-ndjson`` content type), which is read incrementally.
+        The text sequences, and the collections if ``batch_size`` is set, are
+        created by batches, and the response only includes the number of
+        created features.
+        """
+        if self.readonly:
+            return HTTPMethodNotAllowed(headers={"Allow": "GET, HEAD"})
+        features = self._iter_body_features(request)
+        if features is not None:
+            with self._start_span(request, "papyrus.flush") as span:
+                count = self._create_batches(request, features)
+                span.set_attribute("papyrus.rows", count)
+            response = Response(status_int=201, json_body={"count": count})
+            self._set_write_cookie(response)
+            return response
+        with self._start_span(request, "papyrus.decode", {"papyrus.payload_size": len(request.body)}):
+            collection = loads(request.body, object_hook=GeoJSON.to_instance)
+        if not isinstance(collection, FeatureCollection):
+            return HTTPBadRequest()
+        with self._start_span(request, "papyrus.flush", {"papyrus.rows": len(collection.features)}):
+            session = self.Session()
+            objects = [self._create_object(session, request, feature) for feature in collection.features]
+            session.flush()
+        collection = FeatureCollection(objects) if len(objects) > 0 else None
         request.response.status_int = 201
+        self._set_write_cookie(request.response)
         return collection
 
+    @_measured("update")
+    @_limited("update")
+    @_slow_logged
     def update(self, request: pyramid.request.Request, id: str) -> Any:  # pylint: disable=redefined-builtin
         """
         Read the GeoJSON feature from the request body.
@@ -400,16 +1889,22 @@ class Protocol:
         obj = session.query(self.mapped_class).get(id)
         if obj is None:
             return HTTPNotFound()
-        feature = loads(request.body, object_hook=GeoJSON.to_instance)
+        with self._start_span(request, "papyrus.decode", {"papyrus.payload_size": len(request.body)}):
+            feature = loads(request.body, object_hook=GeoJSON.to_instance)
         if not isinstance(feature, Feature):
             return HTTPBadRequest()
         if self.before_update is not None:
             self.before_update(request, feature, obj)
-        obj.__update__(feature)
-        session.flush()
+        with self._start_span(request, "papyrus.flush", {"papyrus.rows": 1}):
+            obj.__update__(feature)
+            session.flush()
         request.response.status_int = 200
+        self._set_write_cookie(request.response)
         return obj
 
+    @_measured("delete")
+    @_limited("delete")
+    @_slow_logged
     def delete(
         self,
         request: pyramid.request.Request,
@@ -424,5 +1919,650 @@ class Protocol:
             return HTTPNotFound()
         if self.before_delete is not None:
             self.before_delete(request, obj)
-        session.delete(obj)
-        return Response(status_int=204)
+        with self._start_span(request, "papyrus.delete", {"papyrus.rows": 1}):
+            session.delete(obj)
+        response = Response(status_int=204)
+        self._set_write_cookie(response)
+        return response
+
+
+_SYNC_ONLY_ARGUMENTS = {
+    "partitions": 1,
+    "limiter": None,
+    "coalesce": False,
+    "server_timing": False,
+    "timing_callback": None,
+    "metrics": None,
+    "tracer": None,
+    "slow_query_threshold": None,
+}
+"""The arguments of ``Protocol`` not supported by ``AsyncProtocol``, with their default values."""
+
+
+class AsyncProtocol(Protocol):
+    r"""
+    Asynchronous Protocol class.
+
+    Same as :py:class:`Protocol`, but relying on SQLAlchemy's asyncio
+    extension. The ``read()``, ``count()``, ``cluster()``, ``aggregate()``,
+    ``create()``, ``update()`` and ``delete()`` methods are coroutines, to be awaited from an asynchronous
+    view. The request parameters, the filters and the callbacks are the same
+    as for :py:class:`Protocol`.
+
+    Session
+        an SQLAlchemy ``async_sessionmaker`` or ``async_scoped_session``,
+        producing ``AsyncSession`` objects, for example bound to an
+        ``asyncpg`` engine. With an ``async_sessionmaker`` each call uses
+        its own session, closed at the end of the call, and the writes are
+        committed before returning. With an ``async_scoped_session`` (scoped
+        to the request) the sessions are committed and closed by the
+        application, as with :py:class:`Protocol`.
+
+    The created and updated objects are returned as features, serialized
+    before the commit. The mapped objects are serialized through ``__geo_interface__`` once
+    loaded, so the mapped class should not rely on lazy loaded relationships
+    (use eager loading instead).
+
+    The arguments measuring, limiting or splitting the requests
+    (``partitions``, ``limiter``, ``coalesce``, ``server_timing``,
+    ``timing_callback``, ``metrics``, ``tracer`` and
+    ``slow_query_threshold``) are not supported, a ``TypeError`` is raised
+    if they are set.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        unsupported = [
+            name for name, default in _SYNC_ONLY_ARGUMENTS.items() if getattr(self, name) != default
+        ]
+        if unsupported:
+            raise TypeError(f"AsyncProtocol does not support the {', '.join(unsupported)} arguments")
+
+    async def _query(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> list[Any]:
+        """
+        Build a select statement based on the filter and the request params.
+
+        And send it to the database.
+        """
+        columns = self._get_columns(request)
+        stmt = self._filter_query(select(self.mapped_class, *columns), request, filter)
+        async with self._read_session(request) as session:
+            with _raise_canceled():
+                async with self._budget(request, session, stmt, "read"):
+                    result = await session.execute(stmt)
+                    return list(result.all() if columns else result.scalars().all())
+
+    @contextlib.asynccontextmanager
+    async def _read_session(self, request: pyramid.request.Request) -> AsyncIterator[Any]:
+        """Get a session used for the reads of the request, closed on exit unless it is scoped."""
+        factory = self._get_read_session_factory(request)
+        if isinstance(factory, async_scoped_session):
+            yield factory()
+            return
+        async with factory() as session:
+            yield session
+
+    @contextlib.asynccontextmanager
+    async def _write_session(self) -> AsyncIterator[Any]:
+        """Get a session used for a write, committed and closed on exit unless it is scoped."""
+        if isinstance(self.Session, async_scoped_session):
+            yield self.Session()
+            return
+        async with self.Session() as session, session.begin():
+            yield session
+
+    async def _apply_budget(self, session: Any, query: Any, action: str) -> None:  # type: ignore[override]
+        """Set the statement timeout, and check the estimated cost of a read query."""
+        for budget_statement, max_cost in self._get_budget_statements(query, action):
+            result = await session.execute(budget_statement)
+            if max_cost is not None:
+                self._check_cost(result.scalar(), max_cost)
+
+    def _shares_write_transaction(self, request: pyramid.request.Request) -> bool:
+        """Return whether the reads of the request are done in the transaction of the writes."""
+        # With an async_sessionmaker each call has its own transaction
+        return isinstance(self.Session, async_scoped_session) and super()._shares_write_transaction(request)
+
+    @contextlib.asynccontextmanager
+    async def _budget(  # type: ignore[override]
+        self, request: pyramid.request.Request, session: Any, query: Any, action: str
+    ) -> AsyncIterator[None]:
+        """Run a read query within its budget, see :py:meth:`Protocol._budget`."""
+        previous = None
+        if _get_budget(self.statement_timeout, action) is not None and self._shares_write_transaction(
+            request
+        ):
+            previous = (await session.execute(_CURRENT_STATEMENT_TIMEOUT)).scalar()
+        try:
+            await self._apply_budget(session, query, action)
+            yield
+        except sqlalchemy.exc.DBAPIError:
+            # The transaction is aborted, and its statement timeout with it
+            previous = None
+            raise
+        finally:
+            if previous is not None:
+                await session.execute(_restore_statement_timeout(previous))
+
+    async def count(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> int:
+        """Return the number of records matching the given filter."""
+        if filter is None:
+            filter = self._create_filter(request)
+        stmt = select(func.count()).select_from(self.mapped_class)
+        if filter is not None:
+            stmt = stmt.filter(filter)
+        nearest_count = self._get_nearest_count(request)
+        if nearest_count is not None:
+            subquery = select(self.mapped_class)
+            if filter is not None:
+                subquery = subquery.filter(filter)
+            stmt = select(func.count()).select_from(subquery.limit(nearest_count).subquery())
+        async with self._read_session(request) as session:
+            with _raise_canceled():
+                async with self._budget(request, session, stmt, "count"):
+                    result = await session.execute(stmt)
+                    return result.scalar_one()  # type: ignore[no-any-return]
+
+    async def read(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+        id: str | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """
+        Build a query based on the filter or the identifier.
+
+        Send the query to the database, and return a Feature or a FeatureCollection.
+        """
+        if id is not None:
+            columns = self._get_columns(request)
+            async with self._read_session(request) as session:
+                if columns:
+                    stmt = select(self.mapped_class, *columns).filter(self._get_pk_filter(id))
+                    o = (await session.execute(stmt)).one_or_none()
+                else:
+                    o = await session.get(self.mapped_class, id)
+                if o is None:
+                    return HTTPNotFound()
+                return self._to_feature(o, request)
+        objs = await self._query(request, filter)
+        return FeatureCollection([self._to_feature(o, request) for o in objs if o is not None])
+
+    async def stream(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> AsyncIterator[geojson.Feature]:
+        """
+        Build a query based on the filter and the request params.
+
+        And yield the features as they are read from a server side cursor,
+        without loading the whole result set in memory.
+        """
+        columns = self._get_columns(request)
+        stmt = self._filter_query(select(self.mapped_class, *columns), request, filter)
+        async with self._read_session(request) as session:
+            with _raise_canceled():
+                async with self._budget(request, session, stmt, "read"):
+                    result = await (session.stream(stmt) if columns else session.stream_scalars(stmt))
+                    async for o in result:
+                        yield self._to_feature(o, request)
+
+    async def cluster(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """Cluster the features matching the filter in the database, see :py:meth:`Protocol.cluster`."""
+        try:
+            stmt = self._build_cluster_query(request, filter).statement
+        except HTTPBadRequest as e:
+            return e
+        async with self._read_session(request) as session:
+            with _raise_canceled():
+                async with self._budget(request, session, stmt, "cluster"):
+                    result = await session.execute(stmt)
+                    return self._to_cluster_features(result.all())
+
+    async def aggregate(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """Compute statistics per grid cell in the database, see :py:meth:`Protocol.aggregate`."""
+        try:
+            stmt = self._build_aggregate_query(request, filter).statement
+        except HTTPBadRequest as e:
+            return e
+        async with self._read_session(request) as session:
+            with _raise_canceled():
+                async with self._budget(request, session, stmt, "aggregate"):
+                    result = await session.stream(stmt)
+                    return FeatureCollection([self._to_cell_feature(row) async for row in result])
+
+    async def _create_object(  # type: ignore[override]
+        self,
+        session: Any,
+        request: pyramid.request.Request,
+        feature: geojson.Feature,
+    ) -> Any:
+        """Create a new object from the feature, or update the existing one."""
+        obj = None
+        if hasattr(feature, "id") and feature.id is not None:
+            obj = await session.get(self.mapped_class, feature.id)
+        if self.before_create is not None:
+            self.before_create(request, feature, obj)
+        if obj is None:
+            obj = self.mapped_class(feature)
+            if self.before_insert is not None:
+                self.before_insert(request, feature, obj)
+            session.add(obj)
+        else:
+            obj.__update__(feature)
+        return obj
+
+    async def _create_batches(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        features: Iterator[geojson.Feature],
+    ) -> int:
+        """Create the objects by batches, see :py:meth:`Protocol._create_batches`."""
+        count = 0
+        async with self._write_session() as session:
+            try:
+                while True:
+                    batch = list(itertools.islice(features, self.batch_size or CREATE_BATCH_SIZE))
+                    if not batch:
+                        break
+                    objects = [await self._create_object(session, request, feature) for feature in batch]
+                    await session.flush()
+                    # Not kept in the identity map, for the memory to be bounded by the batch size
+                    for obj in objects:
+                        session.expunge(obj)
+                    count += len(objects)
+            except ValueError as e:
+                # Raised for the transaction, that may already include previous batches, to be aborted
+                raise HTTPBadRequest(str(e)) from e
+        return count
+
+    async def create(self, request: pyramid.request.Request) -> Any:
+        """
+        Read the GeoJSON feature collection from the request body.
+
+        And create new objects in the database. As for
+        :py:meth:`Protocol.create`, the text sequences, and the collections if
+        ``batch_size`` is set, are created by batches.
+        """
+        if self.readonly:
+            return HTTPMethodNotAllowed(headers={"Allow": "GET, HEAD"})
+        features = self._iter_body_features(request)
+        if features is not None:
+            count = await self._create_batches(request, features)
+            response = Response(status_int=201, json_body={"count": count})
+            self._set_write_cookie(response)
+            return response
+        collection = loads(request.body, object_hook=GeoJSON.to_instance)
+        if not isinstance(collection, FeatureCollection):
+            return HTTPBadRequest()
+        async with self._write_session() as session:
+            objects = [
+                await self._create_object(session, request, feature) for feature in collection.features
+            ]
+            await session.flush()
+            # Serialized before the commit expires the objects
+            collection = (
+                FeatureCollection([o.__geo_interface__ for o in objects]) if len(objects) > 0 else None
+            )
+        request.response.status_int = 201
+        self._set_write_cookie(request.response)
+        return collection
+
+    async def update(self, request: pyramid.request.Request, id: str) -> Any:  # pylint: disable=redefined-builtin
+        """
+        Read the GeoJSON feature from the request body.
+
+        And update the corresponding object in the database.
+        """
+        if self.readonly:
+            return HTTPMethodNotAllowed(headers={"Allow": "GET, HEAD"})
+        async with self._write_session() as session:
+            obj = await session.get(self.mapped_class, id)
+            if obj is None:
+                return HTTPNotFound()
+            feature = loads(request.body, object_hook=GeoJSON.to_instance)
+            if not isinstance(feature, Feature):
+                return HTTPBadRequest()
+            if self.before_update is not None:
+                self.before_update(request, feature, obj)
+            obj.__update__(feature)
+            await session.flush()
+            updated = obj.__geo_interface__
+        request.response.status_int = 200
+        self._set_write_cookie(request.response)
+        return updated
+
+    async def delete(  # type: ignore[override]
+        self,
+        request: pyramid.request.Request,
+        id: str,  # pylint: disable=redefined-builtin
+    ) -> pyramid.response.Response:
+        """Remove the targeted feature from the database."""
+        if self.readonly:
+            return HTTPMethodNotAllowed(headers={"Allow": "GET, HEAD"})
+        async with self._write_session() as session:
+            obj = await session.get(self.mapped_class, id)
+            if obj is None:
+                return HTTPNotFound()
+            if self.before_delete is not None:
+                self.before_delete(request, obj)
+            await session.delete(obj)
+        response = Response(status_int=204)
+        self._set_write_cookie(response)
+        return response
+
+
+_ATTR_OPERATORS: dict[str, Callable[[Any, Any], bool]] = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+"""The attribute filter operators evaluated in memory, see ``create_attr_filter()``."""
+
+
+def _create_attr_test(op: str, value: str, type_: type | None) -> Callable[[Any], bool]:
+    """
+    Create the function testing an attribute value in memory.
+
+    The value of the param is converted to the Python type of the column,
+    as the database would do.
+    """
+    if op in ("like", "ilike"):
+        pattern = re.compile(
+            "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in value),
+            re.IGNORECASE | re.DOTALL if op == "ilike" else re.DOTALL,
+        )
+        return lambda v: pattern.fullmatch(str(v)) is not None
+    if type_ is not None and type_ is not str:
+        try:
+            if type_ is bool:
+                value = asbool(value)
+            elif hasattr(type_, "fromisoformat"):
+                value = type_.fromisoformat(value)
+            else:
+                value = type_(value)
+        # decimal.InvalidOperation is not a ValueError
+        except (ValueError, ArithmeticError):
+            raise HTTPBadRequest(f"Invalid value: {value}") from None
+    compare = _ATTR_OPERATORS[op]
+    return lambda v: compare(v, value)  # type: ignore[no-any-return]
+
+
+class _MemoryLayer:
+    """The features of a layer loaded in memory, with their geometries indexed in an ``STRtree``."""
+
+    def __init__(self, objs: Iterable[Any], mapped_class: Any, geom_attr: str) -> None:
+        from geoalchemy2.shape import to_shape
+        from shapely import STRtree
+
+        mapper = class_mapper(mapped_class)
+        pk_key = mapper.get_property_by_column(mapper.primary_key[0]).key
+        keys = [p.key for p in mapper.column_attrs if p.key != geom_attr]
+        self.types: dict[str, type | None] = {}
+        for key in keys:
+            try:
+                self.types[key] = mapper.get_property(key).columns[0].type.python_type
+            except NotImplementedError:
+                self.types[key] = None
+        self.features: list[geojson.Feature] = []
+        self.columns: dict[str, list[Any]] = {key: [] for key in keys}
+        self.positions: dict[Any, int] = {}
+        geometries = []
+        for obj in objs:
+            self.positions[getattr(obj, pk_key)] = len(self.features)
+            self.features.append(obj.__geo_interface__)
+            for key in keys:
+                self.columns[key].append(getattr(obj, key))
+            value = getattr(obj, geom_attr)
+            geometries.append(to_shape(value) if value is not None else None)
+        self.pk_type = self.types[pk_key]
+        self.tree = STRtree(geometries)
+        self.loaded_at = time.monotonic()
+
+
+class MemoryProtocol(Protocol):
+    r"""
+    Protocol class serving the reads from memory.
+
+    Same as :py:class:`Protocol`, but the features of the layer are loaded
+    once from the database, with their geometries indexed in an ``STRtree``
+    and their attributes stored by column. ``read()`` and ``count()`` then
+    evaluate the ``bbox``, ``lon``/``lat``, ``geometry`` and attribute
+    filters, the sort order and the pagination in memory. This is intended
+    for small read-mostly reference layers.
+
+    The requests that cannot be answered from memory are sent to the
+    database, as with :py:class:`Protocol`: the requests with a custom
+    ``filter``, a ``geometry_ref``, a ``nearest`` param, an ``epsg`` or
+    ``output_epsg`` param different from the SRID of the geometry column,
+    or filtering or sorting on attributes that are not mapped columns. All
+    the requests are sent to the database for the mapped classes with a
+    composite primary key.
+
+    The features are loaded again on the first read after ``invalidate()``,
+    which is called on ``create()``, ``update()`` and ``delete()`` and when
+    their transaction is committed. ``refresh()`` loads them right away, for
+    example after the table is updated by another process.
+
+    \\**kwargs
+        max_age
+          the maximum age of the loaded features, in seconds. Older
+          features are loaded again on the next read. Default is ``None``
+          (no expiration).
+
+    The other arguments are the same as for :py:class:`Protocol`.
+    """
+
+    def __init__(self, *args: Any, max_age: float | None = None, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_age = max_age
+        self._layer: _MemoryLayer | None = None
+        self._lock = threading.RLock()
+
+    def refresh(self) -> _MemoryLayer:
+        """Load the features from the database."""
+        with self._lock:
+            primary_key = class_mapper(self.mapped_class).primary_key
+            if self.ReadSession is None:
+                objs = self.Session().query(self.mapped_class).order_by(*primary_key).all()
+            else:
+                session = self.ReadSession()
+                try:
+                    objs = session.query(self.mapped_class).order_by(*primary_key).all()
+                finally:
+                    session.close()
+            self._layer = _MemoryLayer(objs, self.mapped_class, self.geom_attr)
+            return self._layer
+
+    def invalidate(self) -> None:
+        """Drop the loaded features, they are loaded again on the next read."""
+        self._layer = None
+
+    def _get_layer(self) -> _MemoryLayer:
+        """Get the loaded features, loading them if needed."""
+        layer = self._layer
+        if layer is None or self._expired(layer):
+            with self._lock:
+                # The features may have been loaded by another thread meanwhile
+                layer = self._layer
+                if layer is None or self._expired(layer):
+                    layer = self.refresh()
+        return layer
+
+    def _expired(self, layer: _MemoryLayer) -> bool:
+        """Return whether the loaded features are older than ``max_age``."""
+        return self.max_age is not None and time.monotonic() - layer.loaded_at > self.max_age
+
+    def _in_memory(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None,  # pylint: disable=redefined-builtin
+    ) -> bool:
+        """Return whether the request can be answered from memory, the features are loaded if needed."""
+        params = request.params
+        if filter is not None or "nearest" in params:
+            return False
+        # The loaded features are indexed by their primary key
+        if len(class_mapper(self.mapped_class).primary_key) != 1:
+            return False
+        if "geometry_ref" in params and not _has_filter_shape(request):
+            return False
+        column_epsg = _get_col_epsg(self.mapped_class, self.geom_attr)
+        for name in ("epsg", "output_epsg"):
+            if name in params and int(params[name]) != column_epsg:
+                return False
+        layer = self._get_layer()
+        if "queryable" in params:
+            queryable = params["queryable"].split(",")
+            for k in params:
+                if len(params[k]) <= 0 or "__" not in k:
+                    continue
+                col, op = k.split("__")
+                if (
+                    col in queryable
+                    and op in ("like", "ilike", *_ATTR_OPERATORS)
+                    and col not in layer.columns
+                ):
+                    return False
+        attr = params.get("sort", params.get("order_by"))
+        return attr is None or attr in layer.columns or not hasattr(self.mapped_class, attr)
+
+    def _match(self, request: pyramid.request.Request, layer: _MemoryLayer) -> list[int]:
+        """Get the positions of the features matching the filters of the request params."""
+        tolerance = float(request.params.get("tolerance", 0.0))
+        shape = _create_filter_shape(request, tolerance, self.max_filter_vertices, self.simplify_filter)
+        if shape is None:
+            positions = range(len(layer.features))
+        elif tolerance > 0:
+            positions = sorted(layer.tree.query(shape, predicate="dwithin", distance=tolerance).tolist())
+        else:
+            positions = sorted(layer.tree.query(shape, predicate="intersects").tolist())
+        if "queryable" in request.params:
+            queryable = request.params["queryable"].split(",")
+            for k in request.params:
+                if len(request.params[k]) <= 0 or "__" not in k:
+                    continue
+                col, op = k.split("__")
+                if col not in queryable or op not in ("like", "ilike", *_ATTR_OPERATORS):
+                    continue
+                test = _create_attr_test(op, request.params[k], layer.types[col])
+                values = layer.columns[col]
+                # NULL values never match, as in SQL
+                positions = [i for i in positions if values[i] is not None and test(values[i])]
+        return list(positions)
+
+    def _to_memory_feature(
+        self, request: pyramid.request.Request, layer: _MemoryLayer, position: int
+    ) -> geojson.Feature:
+        """Get a copy of a loaded feature, filtered according to the request params."""
+        import shapely
+
+        loaded = layer.features[position]
+        feature = Feature(id=loaded.id, geometry=loaded.geometry, properties=dict(loaded.properties))
+        geometry = layer.tree.geometries[position]
+        if asbool(request.params.get("clip", False)) and "bbox" in request.params and geometry is not None:
+            box = [float(x) for x in request.params["bbox"].split(",")]
+            tolerance = float(request.params.get("tolerance", 0.0))
+            geometry = shapely.clip_by_rect(
+                geometry, box[0] - tolerance, box[1] - tolerance, box[2] + tolerance, box[3] + tolerance
+            )
+            feature.geometry = GeoJSON.to_instance(geometry, strict=True)
+        return self._filter_attrs(feature, request)
+
+    @_measured("count")
+    def count(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+    ) -> int:
+        """Return the number of features matching the given filter."""
+        if not self._in_memory(request, filter):
+            return super().count(request, filter)
+        layer = self._get_layer()
+        self._count_cache_hit("memory")
+        return len(self._match(request, layer))
+
+    @_measured("read")
+    def read(
+        self,
+        request: pyramid.request.Request,
+        filter: sqlalchemy.sql.expression.ColumnElement[bool] | None = None,  # pylint: disable=redefined-builtin
+        id: str | None = None,  # pylint: disable=redefined-builtin
+    ) -> Any:
+        """Read the features from memory, or from the database if needed, see :py:meth:`Protocol.read`."""
+        if not self._in_memory(request, filter):
+            return super().read(request, filter, id)
+        layer = self._get_layer()
+        self._count_cache_hit("memory")
+        if id is not None:
+            try:
+                position = layer.positions.get(layer.pk_type(id) if layer.pk_type is not None else id)
+            except (ValueError, ArithmeticError):
+                position = None
+            if position is None:
+                return HTTPNotFound()
+            return self._to_memory_feature(request, layer, position)
+        positions = self._match(request, layer)
+        attr = request.params.get("sort", request.params.get("order_by"))
+        if attr in layer.columns:
+            values = layer.columns[attr]
+            # NULL values last in ascending order, as in PostgreSQL
+            positions.sort(
+                key=lambda i: (values[i] is None, values[i]),
+                reverse=request.params.get("dir", "").upper() == "DESC",
+            )
+        limit, offset = self._get_limit_offset(request)
+        start = offset or 0
+        positions = positions[start : None if limit is None else start + limit]
+        return FeatureCollection([self._to_memory_feature(request, layer, i) for i in positions])
+
+    def _invalidate_on_commit(self) -> None:
+        """Invalidate the loaded features now, and when the transaction of the session is committed."""
+        self.invalidate()
+        sqlalchemy.event.listen(self.Session(), "after_commit", lambda session: self.invalidate(), once=True)
+
+    def create(self, request: pyramid.request.Request) -> Any:
+        """Create the features in the database, see :py:meth:`Protocol.create`."""
+        ret = super().create(request)
+        # The batched creations return a 201 response
+        if not isinstance(ret, HTTPException):
+            self._invalidate_on_commit()
+        return ret
+
+    def update(self, request: pyramid.request.Request, id: str) -> Any:  # pylint: disable=redefined-builtin
+        """Update the feature in the database, see :py:meth:`Protocol.update`."""
+        ret = super().update(request, id)
+        if not isinstance(ret, Response):
+            self._invalidate_on_commit()
+        return ret
+
+    def delete(
+        self,
+        request: pyramid.request.Request,
+        id: str,  # pylint: disable=redefined-builtin
+    ) -> pyramid.response.Response:
+        """Delete the feature from the database, see :py:meth:`Protocol.delete`."""
+        ret = super().delete(request, id)
+        if ret.status_int == 204:
+            self._invalidate_on_commit()
+        return ret
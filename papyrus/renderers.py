@@ -1,14 +1,122 @@
-from collections.abc import Callable
+import hashlib
+import importlib
+import itertools
+import marshal
+import threading
+import weakref
+from collections.abc import Callable, Iterable, Iterator
 from io import BytesIO
-from typing import Any
-from xml.etree.ElementTree import TreeBuilder  # nosec
+from typing import TYPE_CHECKING, Any
 
 import geojson
-import pyramid.request
-import sqlalchemy.sql.expression
 
-from papyrus.geojsonencoder import dumps
-from papyrus.xsd import XSDGenerator
+from papyrus.geojsonencoder import SharedFeatureCollection, dumps
+from papyrus.metrics import METRICS_KEY, count_bytes
+from papyrus.timing import TIMINGS_KEY, phase
+from papyrus.tracing import TRACER_KEY, start_span
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from xml.etree.ElementTree import TreeBuilder  # nosec
+
+    import pyramid.request
+    import sqlalchemy.sql.expression
+
+# The XSD generator depends on SQLAlchemy and GeoAlchemy, it is only imported
+# when used.
+_LAZY_ATTRIBUTES = {"XSDGenerator": "papyrus.xsd"}
+
+
+def __getattr__(name: str) -> Any:
+    """Import the lazy attributes of the module on first access."""
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+SEQ_FORMATS = {
+    "geojsonseq": ("\x1e", "application/geo+json-seq"),
+    "ndjson": ("", "application/x-ndjson"),
+}
+"""The GeoJSON text sequence formats, as record separators and content types."""
+
+
+def _get_seq_format(request: "pyramid.request.Request") -> tuple[str, str] | None:
+    """Get the text sequence format requested by the client, if any."""
+    format_ = request.params.get("f")
+    if format_ is not None:
+        return SEQ_FORMATS.get(format_)
+    # The response depends on the Accept header, for the shared caches
+    vary = request.response.vary or ()
+    if "Accept" not in vary:
+        request.response.vary = (*vary, "Accept")
+    offers = request.accept.acceptable_offers(
+        ["application/geo+json", *(content_type for _, content_type in SEQ_FORMATS.values())],
+    )
+    for seq_format in SEQ_FORMATS.values():
+        if offers and offers[0][0] == seq_format[1]:
+            return seq_format
+    return None
+
+
+def _iter_seq(value: Any, separator: str) -> Iterator[bytes]:
+    """Encode a value as a text sequence, one record per feature (or geometry)."""
+    items: Iterable[Any] = [value]
+    if isinstance(value, Iterator):
+        items = value
+    elif isinstance(value, dict):
+        if value.get("type") == "FeatureCollection":
+            items = value["features"]
+        elif value.get("type") == "GeometryCollection":
+            items = value["geometries"]
+    for item in items:
+        yield f"{separator}{dumps(item)}\n".encode()
+
+
+def _iter_collection(features: Iterator[Any], buffer_size: int = 65536) -> Iterator[bytes]:
+    """Encode the features yielded by an iterator as a feature collection, in chunks of about ``buffer_size``."""
+    buffer = ['{"type": "FeatureCollection", "features": [']
+    size = 0
+    for index, feature in enumerate(features):
+        encoded = dumps(feature)
+        buffer.append(f", {encoded}" if index else encoded)
+        size += len(encoded)
+        if size >= buffer_size:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    buffer.append("]}")
+    yield "".join(buffer).encode()
+
+
+def _to_chunk(features: Iterable[Any]) -> bytes | list[dict[str, Any]]:
+    """
+    Convert features into plain dicts, to be sent to a worker process.
+
+    The chunk is marshalled when possible, as it is faster to load than a
+    pickle, the geometries are sent as their coordinates, already computed.
+    """
+    chunk = []
+    for feature in features:
+        feature = dict(getattr(feature, "__geo_interface__", feature))
+        geometry = feature.get("geometry")
+        if isinstance(geometry, dict):
+            feature["geometry"] = dict(geometry)
+        properties = feature.get("properties")
+        if isinstance(properties, dict):
+            feature["properties"] = dict(properties)
+        chunk.append(feature)
+    try:
+        return marshal.dumps(chunk)
+    except ValueError:
+        # For example decimals, dates, or nested GeoJSON objects
+        return chunk
+
+
+def _encode_chunk(chunk: bytes | list[dict[str, Any]]) -> str:
+    """Encode a chunk of features, in a worker process."""
+    features = marshal.loads(chunk) if isinstance(chunk, bytes) else chunk  # nosec
+    return ", ".join(dumps(feature) for feature in features)
 
 
 class GeoJSON:
@@ -57,27 +165,145 @@ class GeoJSON:
         config.add_renderer(
             'geojson', GeoJSON(collection_type='GeometryCollection')
 
+    The GeoJSON renderer also supports `GeoJSON Text Sequences
+    <https://www.rfc-editor.org/rfc/rfc8142>`_ (``application/geo+json-seq``)
+    and newline-delimited features (``application/x-ndjson``), selected
+    with the ``f=geojsonseq`` and ``f=ndjson`` request parameters, or by
+    the ``Accept`` request header. In that case each feature of a feature
+    collection is encoded in its own record, and the records are streamed
+    to the client as they are encoded.
+
+    Large feature collections can be encoded in parallel, by a pool of
+    ``processes`` worker processes. The features are sent to the workers in
+    chunks of ``chunk_size`` features, as plain dicts, and the encoded
+    chunks are concatenated in order. Only the collections including at
+    least ``parallel_threshold`` features are encoded in parallel. Sending
+    the features to the workers costs a fraction of their encoding, the
+    parallel encoding is therefore only worth it with several idle cores.
+    The workers are started with the ``forkserver`` (or ``spawn``) method,
+    not forked from the threads of the web server, and stopped by
+    :py:meth:`close`, or when the renderer is garbage collected or the
+    interpreter exits:
+
+    .. code-block:: python
+
+        config.add_renderer('geojson', GeoJSON(processes=4))
+
+    Iterators of features, for example returned by the ``stream`` method of
+    the MapFish protocol, are encoded as they are iterated, and streamed to
+    the client as a feature collection or a text sequence.
+
     """
 
     def __init__(
         self,
         jsonp_param_name: str = "callback",
         collection_type: type = geojson.factory.FeatureCollection,
+        processes: int | None = None,
+        parallel_threshold: int = 10000,
+        chunk_size: int = 1000,
     ) -> None:
         self.jsonp_param_name = jsonp_param_name
         if isinstance(collection_type, str):
             collection_type = getattr(geojson.factory, collection_type)
         self.collection_type = collection_type
+        self.processes = processes
+        self.parallel_threshold = parallel_threshold
+        self.chunk_size = chunk_size
+        self._executor: ProcessPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+
+    def _parallel_dumps(self, value: dict[str, Any]) -> str | None:
+        """
+        Encode a large feature collection in the worker processes.
+
+        Return ``None`` if the value is not a feature collection large enough.
+        """
+        if self.processes is None or not isinstance(value, dict) or value.get("type") != "FeatureCollection":
+            return None
+        features = value.get("features")
+        if not isinstance(features, list | tuple) or len(features) < self.parallel_threshold:
+            return None
+        chunks = (
+            _to_chunk(features[i : i + self.chunk_size]) for i in range(0, len(features), self.chunk_size)
+        )
+        encoded = ", ".join(c for c in self._get_executor().map(_encode_chunk, chunks) if c)
+        extra = dumps({k: v for k, v in value.items() if k not in ("type", "features")})[1:-1]
+        return f'{{"type": "FeatureCollection", "features": [{encoded}]{", " + extra if extra else ""}}}'
+
+    def _get_executor(self) -> "ProcessPoolExecutor":
+        """Get the pool of worker processes, started on the first use."""
+        with self._executor_lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Forking a multi-threaded web server may copy locks held by other threads
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context(method)
+                )
+                weakref.finalize(self, self._executor.shutdown)
+            return self._executor
+
+    def close(self) -> None:
+        """Stop the worker processes, they are started again on the next parallel encoding."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _dumps(self, value: dict[str, Any]) -> str:
+        """Encode a value, in parallel if it is a large feature collection."""
+        ret = self._parallel_dumps(value)
+        return dumps(value) if ret is None else ret
+
+    def _iter_collection(
+        self, features: Iterator[Any], request: "pyramid.request.Request | None"
+    ) -> Iterable[bytes]:
+        """Encode the features yielded by an iterator as a feature collection, streamed to the client."""
+        encoded = _iter_collection(features)
+        if request is not None:
+            response = request.response
+            if response.content_type == response.default_content_type:
+                callback = request.params.get(self.jsonp_param_name)
+                if callback is None:
+                    response.content_type = "application/geo+json"
+                else:
+                    response.content_type = "text/javascript"
+                    return itertools.chain([f"{callback}(".encode()], encoded, [b");"])
+        return encoded
 
     def __call__(self, info: str) -> Callable[[str, dict[str, str]], Any]:
         """Get the renderer function."""
         del info  # Unused
 
-        def _render(value: str, system: dict[str, pyramid.request.Request]) -> Any:
+        def _encode(value: Any, request: "pyramid.request.Request | None") -> Any:
             if isinstance(value, list | tuple):
                 value = self.collection_type(value)
-            ret = dumps(value)
-            request = system.get("request")
+            if request is not None:
+                response = request.response
+                seq_format = _get_seq_format(request)
+                if seq_format is not None and response.content_type == response.default_content_type:
+                    separator, response.content_type = seq_format
+                    return _iter_seq(value, separator)
+            if isinstance(value, Iterator):
+                return self._iter_collection(value, request)
+            tracer = request.environ.get(TRACER_KEY) if request is not None else None
+            features = getattr(value, "features", None)
+            with (
+                start_span(
+                    tracer,
+                    "papyrus.encode",
+                    {"papyrus.features": len(features) if isinstance(features, list) else None},
+                ) as span,
+                phase(request.environ.get(TIMINGS_KEY) if request is not None else None, "dumps"),
+            ):
+                if isinstance(value, SharedFeatureCollection):
+                    ret = value.encode(self._dumps)
+                else:
+                    ret = self._dumps(value)  # type: ignore[arg-type]
+                span.set_attribute("papyrus.payload_size", len(ret))
             if request is not None:
                 response = request.response
                 ct = response.content_type
@@ -90,6 +316,19 @@ class GeoJSON:
                         ret = f"{callback}({ret});"
             return ret
 
+        def _render(value: str, system: dict[str, "pyramid.request.Request"]) -> Any:
+            request = system.get("request")
+            ret = _encode(value, request)
+            measured = request.environ.get(METRICS_KEY) if request is not None else None
+            if measured is not None:
+                metrics, layer = measured
+                if isinstance(ret, str):
+                    # The response is encoded in UTF-8, isascii() does not scan the text
+                    metrics.bytes_rendered.inc(layer, value=len(ret) if ret.isascii() else len(ret.encode()))
+                else:
+                    ret = count_bytes(ret, metrics.bytes_rendered, layer)
+            return ret
+
         return _render
 
 
@@ -187,34 +426,73 @@ class XSD:
                         with tag(tb, 'readonly', {'value': 'true'}):
                             pass
         config.add_renderer('xsd', XSD(element_callback=callback))
+
+    The generated documents are cached per mapped class, and served with a
+    strong ``ETag`` header, so clients can revalidate them with
+    ``If-None-Match``. The documents of some classes can be generated when
+    the renderer is created, using the ``prepare`` argument:
+
+    .. code-block:: python
+
+        from papyrus.renderers import XSD
+        from myapp.models import Spot
+
+        config.add_renderer('xsd', XSD(prepare=[Spot]))
+
+    Pass ``cache=False`` if the callbacks produce documents that change
+    while the application is running, or call ``clear_cache()`` when they
+    do.
     """
 
     def __init__(
         self,
         include_primary_keys: bool = False,
         include_foreign_keys: bool = False,
-        sequence_callback: Callable[[TreeBuilder, type[Any]], None] | None = None,
-        element_callback: Callable[[TreeBuilder, sqlalchemy.sql.expression.ColumnElement[Any]], None]
-        | None = None,
+        sequence_callback: "Callable[[TreeBuilder, type[Any]], None] | None" = None,
+        element_callback: "Callable[[TreeBuilder, sqlalchemy.sql.expression.ColumnElement[Any]], None] | None" = None,
+        cache: bool = True,
+        prepare: Iterable[type[Any]] = (),
     ) -> None:
-        self.generator = XSDGenerator(
+        from papyrus.xsd import XSDGenerator
+
+        self.generator: XSDGenerator = XSDGenerator(
             include_primary_keys=include_primary_keys,
             include_foreign_keys=include_foreign_keys,
             sequence_callback=sequence_callback,
             element_callback=element_callback,
         )
+        self.cache = cache
+        self._documents: weakref.WeakKeyDictionary[type[Any], tuple[bytes, str]] = weakref.WeakKeyDictionary()
+        for cls in prepare:
+            self.get_xsd(cls)
+
+    def get_xsd(self, cls: type[Any]) -> tuple[bytes, str]:
+        """Get the XSD document of a mapped class, and its ETag."""
+        document = self._documents.get(cls)
+        if document is None:
+            xsd = self.generator.get_class_xsd(BytesIO(), cls).getvalue()
+            document = (xsd, hashlib.sha1(xsd, usedforsecurity=False).hexdigest())
+            if self.cache:
+                self._documents[cls] = document
+        return document
+
+    def clear_cache(self) -> None:
+        """Drop the cached documents."""
+        self._documents.clear()
 
     def __call__(self, table: str) -> Callable[[type[str], dict[str, str]], bytes | None]:
         """Get the renderer function."""
         del table  # Unused
 
-        def _render(cls: type[str], system: dict[str, pyramid.request.Request]) -> bytes | None:
+        def _render(cls: type[str], system: dict[str, "pyramid.request.Request"]) -> bytes | None:
             request = system.get("request")
             if request is not None:
                 response = request.response
                 response.content_type = "application/xml"
-                io = self.generator.get_class_xsd(BytesIO(), cls)
-                return io.getvalue()
+                xsd, etag = self.get_xsd(cls)
+                response.etag = etag
+                response.conditional_response = True
+                return xsd
             return None
 
         return _render
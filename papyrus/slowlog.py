@@ -0,0 +1,102 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from papyrus._engine_events import on_statement
+
+if TYPE_CHECKING:
+    import pyramid.request
+
+LOG = logging.getLogger(__name__)
+
+MAX_PENDING_EXPLAINS = 4
+"""The maximum number of slow queries waiting to be explained, the next ones are not explained."""
+
+
+class _Watch(NamedTuple):
+    threshold: float
+    explain: bool
+    layer: str
+    params: dict[str, str]
+
+
+_current: contextvars.ContextVar[_Watch | None] = contextvars.ContextVar("papyrus_slowlog", default=None)
+_pending = threading.BoundedSemaphore(MAX_PENDING_EXPLAINS)
+
+
+@contextlib.contextmanager
+def watch(
+    request: "pyramid.request.Request", layer: str, threshold: float, explain: bool = False
+) -> Iterator[None]:
+    """
+    Log the SQL statements slower than ``threshold`` seconds executed within the block.
+
+    The statements are logged with their parameters and the params of the
+    request. If ``explain`` is ``True`` the ``EXPLAIN (ANALYZE, BUFFERS)``
+    output of the slow PostgreSQL ``SELECT`` statements is logged too, once
+    captured in a background thread.
+    """
+    on_statement(_on_statement)
+    token = _current.set(_Watch(threshold, explain, layer, dict(getattr(request, "params", {}))))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def _on_statement(conn: Any, elapsed: float, statement: str, parameters: Any, executemany: bool) -> None:
+    current = _current.get()
+    if current is None:
+        return
+    if elapsed < current.threshold:
+        return
+    LOG.warning(
+        "Slow query on %s (%.3f s), request params %r:\n%s\nparameters: %r",
+        current.layer,
+        elapsed,
+        current.params,
+        statement,
+        parameters,
+    )
+    if (
+        current.explain
+        and not executemany
+        and conn.dialect.name == "postgresql"
+        and _is_select(statement)
+        # Not to overload the database when many queries are slow
+        and _pending.acquire(blocking=False)
+    ):
+        _get_executor().submit(_explain, conn.engine, statement, parameters, current.layer)
+
+
+def _is_select(statement: str) -> bool:
+    """Check that a statement is a ``SELECT``, maybe with common table expressions."""
+    words = statement.split(None, 1)
+    return bool(words) and words[0].upper() in ("SELECT", "WITH")
+
+
+def _explain(engine: Any, statement: str, parameters: Any, layer: str) -> None:
+    """Log the plan of a slow query, executed again in a read only transaction."""
+    import sqlalchemy.exc
+
+    try:
+        with engine.connect() as connection:
+            connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+            rows = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+            plan = "\n".join(row[0] for row in rows)
+    except sqlalchemy.exc.SQLAlchemyError:
+        LOG.exception("Failed to explain the slow query on %s", layer)
+        return
+    finally:
+        _pending.release()
+    LOG.warning("Plan of the slow query on %s:\n%s", layer, plan)
+
+
+@functools.cache
+def _get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="papyrus-explain")
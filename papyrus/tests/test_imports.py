@@ -0,0 +1,35 @@
+"""This module checks that the heavy dependencies are not imported on startup."""
+
+import subprocess
+import sys
+import unittest
+
+
+def _imported_modules(module, candidates):
+    """Import a module in a new interpreter, and return the candidate modules it imported."""
+    code = f"import sys\nimport {module}\nprint(','.join(m for m in {candidates!r} if m in sys.modules))\n"
+    output = subprocess.run(  # nosec
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout.strip()
+    return output.split(",") if output else []
+
+
+class Test_imports(unittest.TestCase):
+    def test_package(self):
+        assert _imported_modules("papyrus", ("pyramid.config", "sqlalchemy", "shapely")) == []
+
+    def test_renderers(self):
+        modules = ("sqlalchemy", "geoalchemy2", "shapely", "papyrus.xsd", "pyramid.config", "multiprocessing")
+        assert _imported_modules("papyrus.renderers", modules) == []
+
+    def test_protocol(self):
+        modules = ("geoalchemy2", "shapely")
+        assert _imported_modules("papyrus.protocol", modules) == []
+
+    def test_lazy_attributes(self):
+        from papyrus import renderers
+        from papyrus.xsd import XSDGenerator
+
+        assert renderers.XSDGenerator is XSDGenerator
+        with self.assertRaises(AttributeError):
+            renderers.unknown  # noqa: B018
@@ -129,3 +129,59 @@ class Test_add_papyrus_routes(unittest.TestCase):
         assert routes[5].name == "prefix_delete"
         assert routes[5].path == "/base_url/{id}"
         assert len(routes[5].predicates) == 1
+
+    def test_mapped_class(self):
+        from geoalchemy2.types import Geometry
+        from sqlalchemy import Column, types
+        from sqlalchemy.orm import declarative_base
+
+        from papyrus.geo_interface import GeoInterface, _get_plan
+        from papyrus.protocol import _get_col_epsg
+        from papyrus.renderers import XSD
+
+        Base = declarative_base(cls=GeoInterface, constructor=None)
+
+        class Spot(Base):
+            __tablename__ = "spots"
+            id = Column(types.Integer, primary_key=True)
+            name = Column(types.Unicode)
+            geom = Column(Geometry("POINT", 4326))
+
+        xsd = XSD()
+        config = self._makeOne(autocommit=False)
+        config.add_papyrus_routes("spots", "/spots", mapped_class=Spot, geom_attr="geom")
+        config.add_renderer("xsd", xsd)
+        config.commit()
+
+        assert _get_plan.cache_info().currsize > 0
+        assert _get_plan(Spot).read_properties == ["name"]
+        hits = _get_col_epsg.cache_info().hits
+        assert _get_col_epsg(Spot, "geom") == 4326
+        assert _get_col_epsg.cache_info().hits == hits + 1
+        assert Spot in xsd._documents
+
+    def test_mapped_class_deferred(self):
+        from sqlalchemy import Column, ForeignKey, types
+        from sqlalchemy.orm import declarative_base, relationship
+
+        from papyrus.protocol import _get_column_keys
+
+        Base = declarative_base()
+
+        class Spot(Base):
+            __tablename__ = "spots"
+            id = Column(types.Integer, primary_key=True)
+            owner_id = Column(types.Integer, ForeignKey("owners.id"))
+            owner = relationship("Owner")
+
+        config = self._makeOne(autocommit=False)
+        config.add_papyrus_routes("spots", "/spots", mapped_class=Spot)
+
+        # the related class is imported after the directive is called
+        class Owner(Base):
+            __tablename__ = "owners"
+            id = Column(types.Integer, primary_key=True)
+
+        config.commit()
+        assert _get_column_keys(Spot) == frozenset(["id", "owner_id"])
+        assert Spot.owner.property.mapper.class_ is Owner
@@ -0,0 +1,63 @@
+import threading
+import unittest
+
+from pyramid.httpexceptions import HTTPTooManyRequests
+
+from papyrus.limiter import ConcurrencyLimiter
+
+
+def _acquire(limiter, layer="spots", action="read"):
+    with limiter.acquire(layer, action):
+        pass
+
+
+class Test_ConcurrencyLimiter(unittest.TestCase):
+    def test_reject(self):
+        limiter = ConcurrencyLimiter(1, retry_after=5)
+        with limiter.acquire("spots", "read"):
+            with self.assertRaises(HTTPTooManyRequests) as cm:
+                _acquire(limiter)
+            assert cm.exception.headers["Retry-After"] == "5"
+            # the other layers and actions have their own limits
+            with limiter.acquire("spots", "count"), limiter.acquire("roads", "read"):
+                pass
+        with limiter.acquire("spots", "read"):
+            pass
+        stats = limiter.stats()[("spots", "read")]
+        assert stats["admitted"] == 2
+        assert stats["rejected"] == 1
+        assert stats["active"] == 0
+
+    def test_queue(self):
+        limiter = ConcurrencyLimiter(1, queue_size=1)
+        admitted = []
+
+        def worker():
+            with limiter.acquire("spots", "read"):
+                admitted.append(True)
+
+        with limiter.acquire("spots", "read"):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            while limiter.stats()[("spots", "read")]["waiting"] == 0:
+                pass
+            self.assertRaises(HTTPTooManyRequests, _acquire, limiter)
+        thread.join()
+        assert admitted == [True]
+        stats = limiter.stats()[("spots", "read")]
+        assert stats["waiting"] == 0
+        assert stats["wait_time"] > 0
+
+    def test_timeout(self):
+        limiter = ConcurrencyLimiter(1, queue_size=1, timeout=0.01)
+        with limiter.acquire("spots", "read"):
+            self.assertRaises(HTTPTooManyRequests, _acquire, limiter)
+        stats = limiter.stats()[("spots", "read")]
+        assert stats["rejected"] == 1
+        assert stats["max_wait_time"] >= 0.01
+
+    def test_limit_per_action(self):
+        limiter = ConcurrencyLimiter({"read": 1})
+        with limiter.acquire("spots", "create"), limiter.acquire("spots", "create"):
+            pass
+        assert list(limiter.stats()) == []
@@ -0,0 +1,45 @@
+import unittest
+
+from papyrus.metrics import MetricsRegistry, count_bytes
+
+
+class Test_MetricsRegistry(unittest.TestCase):
+    def test_render(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1))
+        metrics.requests.inc("spots", "read", "200")
+        metrics.requests.inc("spots", "read", "200")
+        metrics.requests.inc('sp"ots', "read", "404")
+        metrics.duration.observe("spots", "read", value=0.5)
+        metrics.duration.observe("spots", "read", value=5)
+        lines = metrics.render().splitlines()
+        assert lines[:5] == [
+            "# HELP papyrus_requests_total The number of requests.",
+            "# TYPE papyrus_requests_total counter",
+            'papyrus_requests_total{layer="spots",action="read",status="200"} 2',
+            'papyrus_requests_total{layer="sp\\"ots",action="read",status="404"} 1',
+            "# HELP papyrus_request_duration_seconds The duration of the requests, in seconds.",
+        ]
+        assert lines[6:11] == [
+            'papyrus_request_duration_seconds_bucket{layer="spots",action="read",le="0.1"} 0',
+            'papyrus_request_duration_seconds_bucket{layer="spots",action="read",le="1"} 1',
+            'papyrus_request_duration_seconds_bucket{layer="spots",action="read",le="+Inf"} 2',
+            'papyrus_request_duration_seconds_sum{layer="spots",action="read"} 5.5',
+            'papyrus_request_duration_seconds_count{layer="spots",action="read"} 2',
+        ]
+
+    def test_collect(self):
+        metrics = MetricsRegistry()
+        assert metrics.collect() == {}
+        metrics.cache_hits.inc("spots", "memory")
+        assert metrics.collect() == {"papyrus_cache_hits_total": {'{layer="spots",cache="memory"}': 1}}
+
+    def test_view(self):
+        metrics = MetricsRegistry(prefix="app")
+        response = metrics.view(None)
+        assert response.content_type == "text/plain"
+        assert b"# TYPE app_request_duration_seconds histogram" in response.body
+
+    def test_count_bytes(self):
+        metrics = MetricsRegistry()
+        assert list(count_bytes([b"ab", b"c"], metrics.bytes_rendered, "spots")) == [b"ab", b"c"]
+        assert metrics.bytes_rendered.values == {("spots",): 3}
@@ -26,6 +26,7 @@
 
 """This module includes unit tests for protocol.py."""
 
+import contextlib
 import unittest
 
 from pyramid import testing
@@ -186,6 +187,113 @@ class create_geom_filter_Tests(unittest.TestCase):
         assert params["ST_Transform_1"] == 900913
         assert params["ST_DWithin_1"] == 1
 
+    def test_polygon_filter_max_vertices(self):
+        from geojson import dumps
+        from pyramid.httpexceptions import HTTPBadRequest
+        from shapely import wkb
+        from shapely.geometry.polygon import Polygon
+
+        from papyrus.protocol import create_geom_filter
+
+        # almost straight edges, removed by the simplification
+        poly = Polygon(((1, 2), (1, 2.5), (1.01, 3), (1.5, 3.01), (2, 3), (2, 2), (1, 2)))
+        MappedClass = self._get_mapped_class()
+        request = testing.DummyRequest({"geometry": dumps(poly), "tolerance": "0.1"})
+        self.assertRaises(HTTPBadRequest, create_geom_filter, request, MappedClass, "geom", max_vertices=5)
+
+        filter = create_geom_filter(request, MappedClass, "geom", max_vertices=5, simplify=True)
+        params = filter.compile(self._get_engine()).params
+        simplified = wkb.loads(bytes(params["ST_GeomFromWKB_1"]))
+        assert simplified.equals(Polygon(((1, 2), (1.01, 3), (2, 3), (2, 2), (1, 2))))
+
+        request = testing.DummyRequest({"geometry": dumps(poly)})
+        self.assertRaises(
+            HTTPBadRequest, create_geom_filter, request, MappedClass, "geom", max_vertices=5, simplify=True
+        )
+
+    def test_polygon_filter_subdivide(self):
+        from geojson import dumps
+        from shapely.geometry.polygon import Polygon
+        from sqlalchemy import select
+
+        from papyrus.protocol import Protocol, create_geom_filter
+
+        poly = Polygon(((1, 2), (1, 3), (2, 3), (2, 2), (1, 2)))
+        MappedClass = self._get_mapped_class()
+        request = testing.DummyRequest({"geometry": dumps(poly), "tolerance": "1"})
+        filter = create_geom_filter(request, MappedClass, "geom", subdivide=5)
+        filter_str = _compiled_to_string(filter.compile(self._get_engine()))
+        assert filter_str.startswith(b"ST_DWithin(")
+
+        poly = Polygon(((1, 2), (1, 3), (1.5, 3.5), (2, 3), (2, 2), (1, 2)))
+        request = testing.DummyRequest({"geometry": dumps(poly), "tolerance": "1"})
+        filter = create_geom_filter(request, MappedClass, "geom", subdivide=5)
+        compiled_filter = select(MappedClass.id).where(filter).compile(self._get_engine())
+        filter_str = _compiled_to_string(compiled_filter)
+        assert filter_str == (
+            b'SELECT "table".id \nFROM "table" \n'
+            b'WHERE "table".id IN (SELECT table_1.id \nFROM "table" AS table_1 '
+            b"JOIN ST_Subdivide(ST_GeomFromWKB(%(ST_GeomFromWKB_1)s, 4326), %(ST_Subdivide_1)s) AS part(geom) "
+            b"ON ST_DWithin(table_1.geom, part.geom, %(ST_DWithin_1)s))"
+        )
+        assert compiled_filter.params["ST_Subdivide_1"] == 5
+
+        self.assertRaises(ValueError, create_geom_filter, request, MappedClass, "geom", subdivide=4)
+        self.assertRaises(ValueError, Protocol, None, MappedClass, "geom", subdivide_filter=4)
+
+    def test_within_filter_nearest(self):
+        from papyrus.protocol import create_geom_filter
+
+        request = testing.DummyRequest(params={"lon": "40", "lat": "5", "nearest": "10"})
+        MappedClass = self._get_mapped_class()
+        filter = create_geom_filter(request, MappedClass, "geom")
+        assert filter is None
+
+    def test_geometry_ref_filter(self):
+        from geoalchemy2.types import Geometry
+        from pyramid.httpexceptions import HTTPBadRequest
+        from sqlalchemy import Column, MetaData, types
+        from sqlalchemy.ext.declarative import declarative_base
+
+        from papyrus.protocol import create_geom_filter, register_layer
+
+        Base = declarative_base(metadata=MetaData())
+
+        class Municipality(Base):
+            __tablename__ = "municipality"
+            id = Column(types.Integer, primary_key=True)
+            geom = Column(Geometry(geometry_type="POLYGON", dimension=2, srid=2056))
+
+        register_layer("municipalities", Municipality, "geom")
+        MappedClass = self._get_mapped_class()
+
+        request = testing.DummyRequest(params={"geometry_ref": "municipalities:42", "tolerance": "1"})
+        filter = create_geom_filter(request, MappedClass, "geom")
+        compiled_filter = filter.compile(self._get_engine())
+        filter_str = _compiled_to_string(compiled_filter)
+        assert filter_str == (
+            b'ST_DWithin("table".geom, ST_Transform((SELECT municipality.geom AS geom \nFROM municipality \n'
+            b"WHERE municipality.id = %(id_1)s), %(ST_Transform_1)s), %(ST_DWithin_1)s)"
+        )
+        assert compiled_filter.params["id_1"] == "42"
+        assert compiled_filter.params["ST_Transform_1"] == 4326
+
+        request = testing.DummyRequest(params={"geometry_ref": "municipalities:42", "epsg": "2056"})
+        filter = create_geom_filter(request, MappedClass, "geom")
+        filter_str = _compiled_to_string(filter.compile(self._get_engine()))
+        assert filter_str.startswith(b'ST_DWithin(ST_Transform("table".geom, %(ST_Transform_1)s), (SELECT')
+
+        class Parcel(Base):
+            __tablename__ = "parcel"
+            municipality = Column(types.Integer, primary_key=True)
+            number = Column(types.Integer, primary_key=True)
+            geom = Column(Geometry(geometry_type="POLYGON", dimension=2, srid=2056))
+
+        register_layer("parcels", Parcel, "geom")
+        for geometry_ref in ("foo:42", "municipalities", "parcels:42"):
+            request = testing.DummyRequest(params={"geometry_ref": geometry_ref})
+            self.assertRaises(HTTPBadRequest, create_geom_filter, request, MappedClass, "geom")
+
     def test_geom_filter_no_params(self):
         from papyrus.protocol import create_geom_filter
 
@@ -324,6 +432,87 @@ class create_attr_filter_Tests(unittest.TestCase):
         assert filter is None
 
 
+class iter_features_Tests(unittest.TestCase):
+    def _callFUT(self, body, chunk_size=7):
+        from io import BytesIO
+
+        from papyrus._geojson_stream import iter_features
+
+        return list(iter_features(BytesIO(body.encode("utf-8")), chunk_size=chunk_size))
+
+    def test_features(self):
+        from geojson import Feature
+        from geojson.geometry import Point
+
+        features = self._callFUT(
+            '{"type": "FeatureCollection", "features": [{"type": "Feature", "id": 12345, "properties": {"text": "f\u00f6\u00f6"}, "geometry": {"type": "Point", "coordinates": [45, 5.5]}}, {"type": "Feature", "properties": {}, "geometry": null}], "crs": null}'  # NOQA
+        )
+        assert len(features) == 2
+        assert isinstance(features[0], Feature)
+        assert features[0].id == 12345
+        assert features[0].properties == {"text": "f\u00f6\u00f6"}
+        assert isinstance(features[0].geometry, Point)
+        assert features[0].geometry.coordinates == [45, 5.5]
+        assert features[1].geometry is None
+
+    def test_type_after_features(self):
+        features = self._callFUT(
+            '{"features": [{"type": "Feature", "properties": {}}], "type": "FeatureCollection"}'
+        )
+        assert len(features) == 1
+
+    def test_empty(self):
+        assert self._callFUT(' { "type" : "FeatureCollection" , "features" : [ ] } ') == []
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, '{"type": "Feature", "properties": {}}')
+        self.assertRaises(
+            ValueError, self._callFUT, '{"features": [{"type": "Point", "coordinates": [1, 2]}]}'
+        )
+        self.assertRaises(ValueError, self._callFUT, '{"features": []}')
+        self.assertRaises(ValueError, self._callFUT, '{"type": "FeatureCollection", "features": [{"type": ')
+
+
+class iter_seq_features_Tests(unittest.TestCase):
+    def _callFUT(self, body, separator=b"\x1e", chunk_size=65536):
+        from io import BytesIO
+
+        from papyrus._geojson_stream import iter_seq_features
+
+        return list(iter_seq_features(BytesIO(body), separator, chunk_size))
+
+    def test_geojsonseq(self):
+        features = self._callFUT(
+            b'\x1e{"type": "Feature", "id": 1, "properties": {}, "geometry": null}\n'
+            b'\x1e{"type": "Feature", "id": 2, "properties": {}, "geometry": {"type": "Point", "coordinates": [1, 2]}}\n'
+        )
+        assert [f.id for f in features] == [1, 2]
+        assert features[1].geometry.coordinates == [1, 2]
+
+    def test_geojsonseq_multiline(self):
+        body = (
+            b'\x1e{\n  "type": "Feature",\n  "id": 1,\n  "properties": {},\n  "geometry": null\n}\n'
+            b'\x1e{\n  "type": "Feature",\n  "id": 2,\n  "properties": {"text": "foo"},\n  "geometry": null\n}\n'
+        )
+        # with records spanning several chunks
+        for chunk_size in (65536, 7):
+            features = self._callFUT(body, chunk_size=chunk_size)
+            assert [f.id for f in features] == [1, 2]
+            assert features[1].properties == {"text": "foo"}
+
+    def test_ndjson(self):
+        features = self._callFUT(
+            b'{"type": "Feature", "id": 1, "properties": {}, "geometry": null}\r\n\n'
+            b'{"type": "Feature", "id": 2, "properties": {}, "geometry": null}',
+            separator=b"\n",
+        )
+        assert [f.id for f in features] == [1, 2]
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, b'{"type": "Point", "coordinates": [1, 2]}\n')
+        self.assertRaises(ValueError, self._callFUT, b'{"type": "Feature"}\n{"type": "Feature"}\n')
+
+
 class asbool_Tests(unittest.TestCase):
     def test_asbool(self):
         from papyrus.protocol import asbool
@@ -496,169 +685,277 @@ class Test_protocol(unittest.TestCase):
         assert b"ORDER BY" in query_to_str(query, engine)
         assert b"DESC" in query_to_str(query, engine)
 
-    def test_count(self):
-        from papyrus.protocol import Protocol
+    def test___query_output_epsg(self):
+        from unittest.mock import patch
 
-        try:
-            from unittest.mock import patch
-        except Exception:
-            from unittest.mock import patch
+        from papyrus.protocol import Protocol
 
         engine = self._get_engine()
         Session = self._get_session(engine)
-        MappedClass = self._get_mapped_class()
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
 
-        proto = Protocol(Session, MappedClass, "geom")
+        request = testing.DummyRequest(params={"output_epsg": "2056"})
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        assert b"ST_Transform" in query_to_str(query, engine)
+        assert b"papyrus_output_geom" in query_to_str(query, engine)
 
-        # We make Query.count return the query and just check it includes
-        # "SELECT". Yes, not so good!
-        request = testing.DummyRequest()
-        with patch("sqlalchemy.orm.query.Query.count", lambda q: q):
-            query = proto.count(request)
-        assert b"SELECT" in query_to_str(query, engine)
+        # no reprojection to the column SRID, or without geometries
+        for params in ({"output_epsg": "4326"}, {"output_epsg": "2056", "no_geom": "true"}):
+            with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+                query = proto._query(testing.DummyRequest(params=params))
+            assert b"ST_Transform" not in query_to_str(query, engine)
 
-    def test_read_id(self):
-        from geojson import Feature
-        from shapely.geometry import Point
+    def test___query_clip(self):
+        from unittest.mock import patch
 
         from papyrus.protocol import Protocol
 
-        class Session:
-            def query(self, mapped_class):
-                feature = Feature(id="a", geometry=Point(1, 2), properties=dict(text="foo"))
-                return {"a": mapped_class(feature)}
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
+
+        request = testing.DummyRequest(params={"bbox": "5,45,6,46", "clip": "true"})
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        sql = query_to_str(query, engine)
+        assert b'ST_ClipByBox2D("table".geom, ST_MakeEnvelope(' in sql
+        assert b"AS papyrus_output_geom" in sql
+
+        request = testing.DummyRequest(
+            params={
+                "bbox": "2600000,1200000,2601000,1201000",
+                "epsg": "2056",
+                "tolerance": "10",
+                "clip": "true",
+            }
+        )
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        sql = query_to_str(query, engine)
+        assert b'ST_ClipByBox2D("table".geom, ST_Transform(ST_Expand(ST_MakeEnvelope(' in sql
+
+        request = testing.DummyRequest(params={"bbox": "5,45,6,46", "clip": "true", "output_epsg": "2056"})
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        assert b'ST_Transform(ST_ClipByBox2D("table".geom, ' in query_to_str(query, engine)
+
+        # no clipping without bbox
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(testing.DummyRequest(params={"clip": "true"}))
+        assert b"ST_ClipByBox2D" not in query_to_str(query, engine)
 
+    def test___query_nearest(self):
+        from unittest.mock import patch
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
         proto = Protocol(Session, self._get_mapped_class(), "geom")
-        request = testing.DummyRequest()
 
-        feature = proto.read(request, id="a")
-        assert feature.id == "a"
-        assert feature.properties["text"] == "foo"
+        request = testing.DummyRequest(
+            params={"lon": "40", "lat": "5", "nearest": "10", "limit": "20", "queryable": "id", "id__gt": "1"}
+        )
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        sql = query_to_str(query, engine)
+        assert b'ST_Distance("table".geom, ST_GeomFromWKB(' in sql
+        assert b"AS distance" in sql
+        assert b"ST_DWithin" not in sql
+        assert b'WHERE "table".id > ' in sql
+        assert b'ORDER BY "table".geom <-> ST_GeomFromEWKT(' in sql
+        assert query._limit_clause.value == 10
+
+        # the pages stay within the nearest features
+        for offset, limit, expected in (("4", None, 6), ("4", "3", 3), ("8", "5", 2), ("12", "5", 0)):
+            params = {"lon": "40", "lat": "5", "nearest": "10", "offset": offset}
+            if limit is not None:
+                params["limit"] = limit
+            with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+                query = proto._query(testing.DummyRequest(params=params))
+            assert query._limit_clause.value == expected
+            assert query._offset_clause.value == int(offset)
+
+        request = testing.DummyRequest(params={"lon": "40", "lat": "5", "nearest": "10", "epsg": "2056"})
+        with patch("sqlalchemy.orm.query.Query.all", lambda q: q):
+            query = proto._query(request)
+        sql = query_to_str(query, engine)
+        assert b'ORDER BY "table".geom <-> ST_Transform(ST_GeomFromWKB(' in sql
 
-    def test_read_notfound(self):
-        from pyramid.httpexceptions import HTTPNotFound
+    def test_read_nearest(self):
+        from geojson import Feature
+        from sqlalchemy.engine.result import result_tuple
 
         from papyrus.protocol import Protocol
 
-        class Session:
-            def query(self, mapped_class):
-                return {"a": None}
+        MappedClass = self._get_mapped_class()
+        proto = Protocol(None, MappedClass, "geom")
+        row = result_tuple(["MappedClass", "distance"])
 
-        proto = Protocol(Session, self._get_mapped_class(), "geom")
-        request = testing.DummyRequest()
+        def _query(request, filter):
+            return [row((MappedClass(Feature(id=1, properties={"text": "foo"})), 12.5))]
 
-        resp = proto.read(request, id="a")
-        assert isinstance(resp, HTTPNotFound)
+        proto._query = _query
+        request = testing.DummyRequest(params={"lon": "40", "lat": "5", "nearest": "1", "attrs": "text"})
+        features = proto.read(request)
+        assert features.features[0].properties == {"text": "foo", "distance": 12.5}
 
-    def test_read_many(self):
-        from geojson import Feature, FeatureCollection
+    def test_read_output_epsg(self):
+        from geoalchemy2.shape import from_shape
+        from geojson import Feature
         from shapely.geometry import Point
+        from sqlalchemy.engine.result import result_tuple
 
         from papyrus.protocol import Protocol
 
-        engine = self._get_engine()
-        Session = self._get_session(engine)
         MappedClass = self._get_mapped_class()
-
-        proto = Protocol(Session, MappedClass, "geom")
+        proto = Protocol(None, MappedClass, "geom")
+        row = result_tuple(["MappedClass", "papyrus_output_geom"])
 
         def _query(request, filter):
-            f1 = Feature(geometry=Point(1, 2))
-            f2 = Feature(geometry=Point(2, 3))
-            return [MappedClass(f1), MappedClass(f2)]
+            return [
+                row((MappedClass(Feature(id=1, geometry=Point(7, 46))), from_shape(Point(2600000, 1200000)))),
+                row((MappedClass(Feature(id=2)), None)),
+            ]
 
         proto._query = _query
+        features = proto.read(testing.DummyRequest(params={"output_epsg": "2056"}))
+        assert features.features[0].id == 1
+        assert features.features[0].geometry.coordinates == [2600000.0, 1200000.0]
+        assert features.features[1].geometry is None
 
-        features = proto.read(testing.DummyRequest())
-        assert isinstance(features, FeatureCollection)
-        assert len(features.features) == 2
-
-    def test_create_forbidden(self):
-        from pyramid.testing import DummyRequest
+    def test_read_id_composite_primary_key(self):
+        from geoalchemy2.types import Geometry
+        from pyramid.httpexceptions import HTTPBadRequest
+        from sqlalchemy import Column, MetaData, types
+        from sqlalchemy.ext.declarative import declarative_base
 
         from papyrus.protocol import Protocol
 
-        engine = self._get_engine()
-        Session = self._get_session(engine)
-        MappedClass = self._get_mapped_class()
+        Base = declarative_base(metadata=MetaData())
 
-        proto = Protocol(Session, MappedClass, "geom", readonly=True)
-        # we need an actual Request object here, for body to do its job
-        request = DummyRequest({})
-        request.method = "POST"
-        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}]}'  # NOQA
-        response = proto.create(request)
-        assert response.headers.get("Allow") == "GET, HEAD"
-        assert response.status_int == 405
+        class Parcel(Base):
+            __tablename__ = "parcel"
+            municipality = Column(types.Integer, primary_key=True)
+            number = Column(types.Integer, primary_key=True)
+            geom = Column(Geometry(geometry_type="POLYGON", dimension=2, srid=2056))
 
-    def test_create_badrequest(self):
-        from pyramid.testing import DummyRequest
+        class MockSession:
+            def query(self, *args):
+                raise AssertionError("no query expected")
 
+        proto = Protocol(MockSession, Parcel, "geom")
+        request = testing.DummyRequest(params={"output_epsg": "4326"})
+        self.assertRaises(HTTPBadRequest, proto.read, request, id="42")
+
+    def test_count(self):
         from papyrus.protocol import Protocol
 
+        try:
+            from unittest.mock import patch
+        except Exception:
+            from unittest.mock import patch
+
         engine = self._get_engine()
         Session = self._get_session(engine)
         MappedClass = self._get_mapped_class()
 
         proto = Protocol(Session, MappedClass, "geom")
-        # we need an actual Request object here, for body to do its job
-        request = DummyRequest({})
-        request.method = "POST"
-        request.body = '{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}'  # NOQA
-        response = proto.create(request)
-        assert response.status_int == 400
 
-    def test_create(self):
-        from geoalchemy2.shape import to_shape
-        from pyramid.testing import DummyRequest
+        # We make Query.count return the query and just check it includes
+        # "SELECT". Yes, not so good!
+        request = testing.DummyRequest()
+        with patch("sqlalchemy.orm.query.Query.count", lambda q: q):
+            query = proto.count(request)
+        assert b"SELECT" in query_to_str(query, engine)
+
+    def test_count_nearest(self):
+        from unittest.mock import patch
 
         from papyrus.protocol import Protocol
 
         engine = self._get_engine()
-        Session = self._get_session(engine)
+        proto = Protocol(self._get_session(engine), self._get_mapped_class(), "geom")
+        request = testing.DummyRequest(
+            params={"nearest": "10", "lon": "1", "lat": "2", "queryable": "text", "text__eq": "foo"}
+        )
+        with patch("sqlalchemy.orm.query.Query.count", lambda q: q):
+            query = proto.count(request)
+        compiled = query.statement.compile(engine)
+        sql = str(compiled)
+        assert '"table".text = %(text_1)s' in sql
+        assert "ST_DWithin" not in sql
+        assert "LIMIT %(param_1)s" in sql
+        assert compiled.params["param_1"] == 10
+
+    def test_read_session(self):
+        from geojson import Feature
+
+        from papyrus.protocol import Protocol
+
         MappedClass = self._get_mapped_class()
+        sessions = []
 
-        class MockSession:
-            def add(self, o):
-                Session.add(o)
+        def session_factory(name):
+            class MockQuery:
+                def filter(self, filter):
+                    return self
 
-            def flush(self):
-                pass
+                def count(self):
+                    return name
 
-        # a before_update callback
-        def before_create(request, feature, obj):
-            if not hasattr(request, "_log"):
-                request._log = []
-            request._log.append(dict(feature=feature, obj=obj))
+                def get(self, id):
+                    return MappedClass(Feature(id=id))
 
-        proto = Protocol(MockSession, MappedClass, "geom", before_create=before_create)
+            class MockSession:
+                closed = False
 
-        # we need an actual Request object here, for body to do its job
-        request = DummyRequest({})
-        request.method = "POST"
-        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}]}'  # NOQA
-        proto.create(request)
-        assert len(Session.new) == 2
-        for obj in Session.new:
-            assert obj.text == "foo"
-            shape = to_shape(obj.geom)
-            assert shape.x == 45
-            assert shape.y == 5
-        Session.rollback()
+                def __init__(self):
+                    sessions.append((name, self))
 
-        # test before_create
-        assert hasattr(request, "_log")
-        assert len(request._log) == 2
-        assert request._log[0]["feature"].properties["text"] == "foo"
-        assert request._log[0]["obj"] is None
-        assert request._log[1]["feature"].properties["text"] == "foo"
-        assert request._log[1]["obj"] is None
+                def query(self, mapped_class):
+                    return MockQuery()
 
-        # test response status
-        assert request.response.status_int == 201
+                def delete(self, obj):
+                    pass
 
-    def test_create_empty(self):
-        from pyramid.testing import DummyRequest
+                def close(self):
+                    self.closed = True
+
+            return MockSession
+
+        proto = Protocol(
+            session_factory("writer"),
+            MappedClass,
+            "geom",
+            ReadSession=session_factory("reader"),
+            read_your_writes=10,
+        )
+
+        request = testing.DummyRequest()
+        assert proto.count(request) == "reader"
+        assert proto.count(request) == "reader"
+        assert [name for name, _ in sessions] == ["reader"]
+        assert proto.read(request, id=1).id == 1
+        assert len(sessions) == 1
+        request._process_finished_callbacks()
+        assert sessions[0][1].closed
+
+        response = proto.delete(testing.DummyRequest(), 1)
+        assert "papyrus_write=1" in response.headers["Set-Cookie"]
+        assert "Max-Age=10" in response.headers["Set-Cookie"]
+
+        request = testing.DummyRequest(cookies={"papyrus_write": "1"})
+        assert proto.count(request) == "writer"
+
+        proto.read_your_writes = None
+        assert proto.count(request) == "reader"
+
+    def test_count_max_filter_vertices(self):
+        from geojson import dumps
+        from pyramid.httpexceptions import HTTPBadRequest
+        from shapely.geometry.polygon import Polygon
 
         from papyrus.protocol import Protocol
 
@@ -666,43 +963,978 @@ class Test_protocol(unittest.TestCase):
         Session = self._get_session(engine)
         MappedClass = self._get_mapped_class()
 
-        proto = Protocol(Session, MappedClass, "geom")
+        proto = Protocol(Session, MappedClass, "geom", max_filter_vertices=4)
 
-        # we need an actual Request object here, for body to do its job
-        request = DummyRequest({})
-        request.method = "POST"
-        request.body = '{"type": "FeatureCollection", "features": []}'
-        resp = proto.create(request)
-        assert resp is None
+        poly = Polygon(((1, 2), (1, 3), (2, 3), (2, 2), (1, 2)))
+        request = testing.DummyRequest({"geometry": dumps(poly)})
+        self.assertRaises(HTTPBadRequest, proto.count, request)
 
-    def test_create_update(self):
-        from geoalchemy2.shape import to_shape
-        from geojson import Feature, FeatureCollection
-        from pyramid.testing import DummyRequest
+    def test_count_budget(self):
+        import sqlalchemy.exc
+        from pyramid.httpexceptions import HTTPRequestEntityTooLarge, HTTPServiceUnavailable
+        from sqlalchemy import select
 
         from papyrus.protocol import Protocol
 
+        engine = self._get_engine()
         MappedClass = self._get_mapped_class()
+        executed = []
+
+        class QueryCanceled(Exception):
+            pgcode = "57014"
+
+        class MockResult:
+            def __init__(self, value):
+                self.value = value
+
+            def scalar(self):
+                return self.value
+
+        class MockQuery:
+            statement = select(MappedClass.id)
+            canceled = False
+
+            def count(self):
+                if self.canceled:
+                    raise sqlalchemy.exc.OperationalError("SELECT", {}, QueryCanceled())
+                return 3
 
-        # a mock session specific to this test
         class MockSession:
+            query_ = MockQuery()
+
             def query(self, mapped_class):
-                return {"a": mapped_class(Feature(id="a")), "b": mapped_class(Feature(id="b"))}
+                return self.query_
+
+            def execute(self, statement):
+                compiled = statement.compile(engine)
+                executed.append((str(compiled), compiled.params))
+                if executed[-1][0].startswith("SELECT current_setting"):
+                    return MockResult("0")
+                return MockResult('[{"Plan": {"Total Cost": 1000.0}}]')
+
+        proto = Protocol(MockSession, MappedClass, "geom", statement_timeout={"count": 500}, max_cost=100)
+        self.assertRaises(HTTPRequestEntityTooLarge, proto.count, testing.DummyRequest())
+        # the reads are done with the writer session, the statement timeout is restored after them
+        assert [statement for statement, _ in executed] == [
+            "SELECT current_setting(%(current_setting_2)s) AS current_setting_1",
+            "SET LOCAL statement_timeout = 500",
+            'EXPLAIN (FORMAT JSON) SELECT "table".id \nFROM "table"',
+            "SELECT set_config(%(set_config_2)s, %(set_config_3)s, %(set_config_4)s) AS set_config_1",
+        ]
+        assert executed[3][1] == {
+            "set_config_2": "statement_timeout",
+            "set_config_3": "0",
+            "set_config_4": True,
+        }
+
+        del executed[:]
+        proto.max_cost = {"read": 100}
+        assert proto.count(testing.DummyRequest()) == 3
+        assert len(executed) == 3
+
+        # a canceled query aborts the transaction, and its statement timeout
+        del executed[:]
+        MockSession.query_.canceled = True
+        self.assertRaises(HTTPServiceUnavailable, proto.count, testing.DummyRequest())
+        assert len(executed) == 2
+
+        # not restored with a read session
+        del executed[:]
+        MockSession.query_.canceled = False
+        proto.ReadSession = type("MockReadSession", (MockSession,), {})
+        assert proto.count(testing.DummyRequest()) == 3
+        assert [statement for statement, _ in executed] == ["SET LOCAL statement_timeout = 500"]
+
+    def test_read_canceled(self):
+        import sqlalchemy.exc
+        from pyramid.httpexceptions import HTTPServiceUnavailable
 
-            def flush(self):
-                pass
+        from papyrus.protocol import Protocol
 
-        proto = Protocol(MockSession, MappedClass, "geom")
+        MappedClass = self._get_mapped_class()
 
-        # we need an actual Request object here, for body to do its job
-        request = DummyRequest({})
-        request.method = "POST"
-        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "id": "a", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "id": "b", "properties": {"text": "bar"}, "geometry": {"type": "Point", "coordinates": [46, 6]}}]}'  # NOQA
-        features = proto.create(request)
+        class QueryCanceled(Exception):
+            pgcode = "57014"
 
-        assert isinstance(features, FeatureCollection)
-        assert len(features.features) == 2
-        assert features.features[0].id == "a"
+        class MockQuery:
+            def limit(self, limit):
+                return self
+
+            def offset(self, offset):
+                return self
+
+            def all(self):
+                raise sqlalchemy.exc.OperationalError("SELECT", {}, QueryCanceled())
+
+        class MockSession:
+            def query(self, mapped_class):
+                return MockQuery()
+
+        proto = Protocol(MockSession, MappedClass, "geom")
+        self.assertRaises(HTTPServiceUnavailable, proto.read, testing.DummyRequest())
+
+    def test_max_limit(self):
+        from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+
+        from papyrus.protocol import Protocol
+
+        proto = Protocol(None, self._get_mapped_class(), "geom", max_limit=10)
+        assert proto._get_limit_offset(testing.DummyRequest()) == (10, None)
+        assert proto._get_limit_offset(testing.DummyRequest(params={"limit": "5", "offset": "2"})) == (5, 2)
+        request = testing.DummyRequest(params={"maxfeatures": "20"})
+        self.assertRaises(HTTPRequestEntityTooLarge, proto._get_limit_offset, request)
+
+    def test_limiter(self):
+        from pyramid.httpexceptions import HTTPTooManyRequests
+
+        from papyrus.limiter import ConcurrencyLimiter
+        from papyrus.protocol import Protocol
+
+        class MockQuery:
+            def filter(self, filter):
+                return self
+
+            def count(self):
+                return 3
+
+        class MockSession:
+            def query(self, mapped_class):
+                return MockQuery()
+
+        limiter = ConcurrencyLimiter(1)
+        proto = Protocol(MockSession, self._get_mapped_class(), "geom", name="spots", limiter=limiter)
+        assert proto.count(testing.DummyRequest()) == 3
+        with limiter.acquire("spots", "count"):
+            self.assertRaises(HTTPTooManyRequests, proto.count, testing.DummyRequest())
+        assert limiter.stats()[("spots", "count")]["admitted"] == 2
+
+    def test_coalesce(self):
+        import threading
+
+        from papyrus.geojsonencoder import SharedFeatureCollection
+        from papyrus.protocol import Protocol
+
+        waiting = threading.Event()
+        results = []
+        threads = []
+
+        class WaitEvent(threading.Event):
+            def wait(self, timeout=None):
+                waiting.set()
+                return super().wait(timeout)
+
+        def count_in_thread():
+            results.append(proto.count(testing.DummyRequest(params={"bbox": "1,2,3,4"})))
+
+        class MockQuery:
+            calls = 0
+
+            def filter(self, filter):
+                return self
+
+            def count(self):
+                MockQuery.calls += 1
+                # an identical request arrives while the query is running
+                (call,) = proto._single_flight._calls.values()
+                call.done = WaitEvent()
+                threads.append(threading.Thread(target=count_in_thread))
+                threads[0].start()
+                waiting.wait()
+                return 3
+
+            def limit(self, limit):
+                return self
+
+            def offset(self, offset):
+                return self
+
+            def all(self):
+                return []
+
+        class MockSession:
+            def query(self, *args):
+                return MockQuery()
+
+        MappedClass = self._get_mapped_class()
+        proto = Protocol(MockSession, MappedClass, "geom", coalesce=True)
+        count_in_thread()
+        threads[0].join()
+        assert results == [3, 3]
+        assert MockQuery.calls == 1
+        assert proto._single_flight._calls == {}
+
+        assert isinstance(proto.read(testing.DummyRequest()), SharedFeatureCollection)
+        assert not isinstance(
+            proto.read(testing.DummyRequest(), filter=MappedClass.id == 1), SharedFeatureCollection
+        )
+
+    def test_server_timing(self):
+        from pyramid.response import Response
+
+        from papyrus.protocol import Protocol
+
+        class MockQuery:
+            def filter(self, filter):
+                return self
+
+            def count(self):
+                return 3
+
+        class MockSession:
+            def query(self, mapped_class):
+                return MockQuery()
+
+        calls = []
+        proto = Protocol(
+            MockSession,
+            self._get_mapped_class(),
+            "geom",
+            server_timing=True,
+            timing_callback=lambda request, timings: calls.append(set(timings.durations)),
+        )
+        request = testing.DummyRequest()
+        assert proto.count(request) == 3
+        response = Response()
+        request._process_response_callbacks(response)
+        assert [p.split(";")[0] for p in response.headers["Server-Timing"].split(", ")] == ["filter", "orm"]
+        assert calls == [{"filter", "orm"}]
+
+    def test_metrics(self):
+        from geojson import Feature
+
+        from papyrus.metrics import MetricsRegistry
+        from papyrus.protocol import Protocol
+        from papyrus.renderers import GeoJSON
+
+        MappedClass = self._get_mapped_class()
+
+        class MockQuery:
+            def get(self, id):
+                return None
+
+        class MockSession:
+            def query(self, mapped_class):
+                return MockQuery()
+
+        metrics = MetricsRegistry()
+        proto = Protocol(MockSession, MappedClass, "geom", name="spots", metrics=metrics)
+        proto._query = lambda request, filter: [MappedClass(Feature(id=1)), MappedClass(Feature(id=2))]
+        request = testing.DummyRequest()
+        collection = proto.read(request)
+        rendered = GeoJSON()(None)(collection, {"request": request})
+        assert proto.read(testing.DummyRequest(), id=3).status_int == 404
+
+        samples = metrics.collect()
+        assert samples["papyrus_requests_total"] == {
+            '{layer="spots",action="read",status="200"}': 1,
+            '{layer="spots",action="read",status="404"}': 1,
+        }
+        assert samples["papyrus_request_duration_seconds_count"] == {'{layer="spots",action="read"}': 2}
+        assert samples["papyrus_rows_returned_total"] == {'{layer="spots",action="read"}': 2}
+        assert samples["papyrus_rendered_bytes_total"] == {'{layer="spots"}': len(rendered)}
+
+    def test_metrics_rows_written(self):
+        from io import BytesIO
+
+        from geojson import Feature
+        from pyramid.testing import DummyRequest
+
+        from papyrus.metrics import MetricsRegistry
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+
+        class MockSession:
+            def add(self, o):
+                pass
+
+            def flush(self):
+                pass
+
+            def expunge(self, o):
+                pass
+
+            def query(self, mapped_class):
+                return {"a": mapped_class(Feature())}
+
+            def delete(self, obj):
+                pass
+
+        def create(body, batch_size=None):
+            proto.batch_size = batch_size
+            request = DummyRequest({})
+            request.method = "POST"
+            request.body = body
+            request.body_file = BytesIO(body.encode())
+            return proto.create(request)
+
+        feature = '{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}'  # NOQA
+        metrics = MetricsRegistry()
+        proto = Protocol(MockSession, MappedClass, "geom", name="spots", metrics=metrics)
+        assert (
+            len(create(f'{{"type": "FeatureCollection", "features": [{feature}, {feature}]}}').features) == 2
+        )
+        assert create('{"type": "FeatureCollection", "features": []}') is None
+        assert create(feature).status_int == 400
+        assert create(
+            f'{{"type": "FeatureCollection", "features": [{feature}]}}', batch_size=10
+        ).json_body == {"count": 1}
+        assert proto.delete(testing.DummyRequest(), "a").status_int == 204
+        assert proto.delete(testing.DummyRequest(), "b").status_int == 404
+
+        samples = metrics.collect()
+        assert samples["papyrus_rows_written_total"] == {
+            '{layer="spots",action="create"}': 3,
+            '{layer="spots",action="delete"}': 1,
+        }
+
+    def test_tracing(self):
+        from geojson import Feature
+
+        from papyrus.protocol import Protocol
+        from papyrus.renderers import GeoJSON
+        from papyrus.tests.test_tracing import MockTracer
+
+        MappedClass = self._get_mapped_class()
+
+        class MockQuery:
+            def filter(self, filter):
+                return self
+
+            def count(self):
+                return 3
+
+            def all(self):
+                return [MappedClass(Feature(id=1)), MappedClass(Feature(id=2))]
+
+        class MockSession:
+            def query(self, *args):
+                return MockQuery()
+
+        tracer = MockTracer()
+        proto = Protocol(MockSession, MappedClass, "geom", name="spots", tracer=tracer)
+        proto._filter_query = lambda query, request, filter: query
+        assert proto.count(testing.DummyRequest(params={"bbox": "-180,-90,180,90"})) == 3
+        request = testing.DummyRequest()
+        GeoJSON()(None)(proto.read(request), {"request": request})
+        assert [span.name for span in tracer.spans] == [
+            "papyrus.count",
+            "papyrus.query",
+            "papyrus.decode",
+            "papyrus.encode",
+        ]
+        count, query, decode, encode = (span.attributes for span in tracer.spans)
+        assert count["papyrus.layer"] == "spots"
+        assert count["papyrus.filter"] == "bbox"
+        assert count["papyrus.rows"] == 3
+        assert query["papyrus.filter"] == "none"
+        assert query["papyrus.rows"] == 2
+        assert decode["papyrus.features"] == 2
+        assert encode["papyrus.features"] == 2
+        assert encode["papyrus.payload_size"] > 0
+
+        proto = Protocol(MockSession, MappedClass, "geom")
+        assert proto.count(testing.DummyRequest()) == 3
+
+    def test_slow_query_log(self):
+        from sqlalchemy import create_engine, text
+
+        from papyrus.protocol import Protocol
+
+        engine = create_engine("sqlite://")
+
+        class MockQuery:
+            def filter(self, filter):
+                return self
+
+            def count(self):
+                with engine.connect() as connection:
+                    return connection.execute(text("SELECT 3")).scalar()
+
+        class MockSession:
+            def query(self, mapped_class):
+                return MockQuery()
+
+        proto = Protocol(MockSession, self._get_mapped_class(), "geom", name="spots", slow_query_threshold=0)
+        with self.assertLogs("papyrus.slowlog") as logs:
+            assert proto.count(testing.DummyRequest(params={"queryable": "text", "text__eq": "a"})) == 3
+        assert len(logs.records) == 1
+        message = logs.records[0].getMessage()
+        assert message.startswith("Slow query on spots (")
+        assert "{'queryable': 'text', 'text__eq': 'a'}" in message
+        assert "SELECT 3" in message
+
+    def test_stream(self):
+        from geojson import Feature
+        from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+
+        from papyrus.protocol import Protocol, _Explain
+
+        MappedClass = self._get_mapped_class()
+        sessions = []
+
+        class MockPlan:
+            def scalar(self):
+                return '[{"Plan": {"Total Cost": 1000.0}}]'
+
+        class MockResult:
+            def partitions(self):
+                for start in range(0, 10, 3):
+                    yield [(MappedClass(Feature(id=i)),) for i in range(start, min(start + 3, 10))]
+
+        class MockSession:
+            closed = False
+
+            def __init__(self):
+                sessions.append(self)
+
+            def execute(self, stmt):
+                if isinstance(stmt, _Explain):
+                    return MockPlan()
+                assert stmt.get_execution_options()["yield_per"] == 3
+                if MockSession.error is not None:
+                    raise MockSession.error
+                return MockResult()
+
+            def close(self):
+                self.closed = True
+
+        MockSession.error = None
+        proto = Protocol(MockSession, MappedClass, "geom", stream_batch_size=3, stream_queue_size=1)
+        features = proto.stream(testing.DummyRequest())
+        assert [f.id for f in features] == list(range(10))
+        assert sessions[0].closed
+
+        features = proto.stream(testing.DummyRequest())
+        assert next(features).id == 0
+        features.close()
+
+        MockSession.error = ValueError("fetch error")
+        self.assertRaises(ValueError, list, proto.stream(testing.DummyRequest()))
+        # the request params are checked before the features are iterated
+        proto.max_limit = 5
+        self.assertRaises(
+            HTTPRequestEntityTooLarge, proto.stream, testing.DummyRequest(params={"limit": "10"})
+        )
+        # so is the estimated cost of the query
+        MockSession.error = None
+        proto.max_cost = 100
+        self.assertRaises(HTTPRequestEntityTooLarge, proto.stream, testing.DummyRequest())
+
+    def test_stream_limited(self):
+        from geojson import Feature
+        from pyramid.httpexceptions import HTTPTooManyRequests
+
+        from papyrus.limiter import ConcurrencyLimiter
+        from papyrus.metrics import MetricsRegistry
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+
+        class MockResult:
+            def partitions(self):
+                yield [(MappedClass(Feature(id=i)),) for i in range(3)]
+
+        class MockSession:
+            def execute(self, stmt):
+                return MockResult()
+
+            def close(self):
+                pass
+
+        limiter = ConcurrencyLimiter(1)
+        metrics = MetricsRegistry()
+        proto = Protocol(MockSession, MappedClass, "geom", name="spots", limiter=limiter, metrics=metrics)
+        features = proto.stream(testing.DummyRequest())
+        # the slot is kept until the features are consumed
+        self.assertRaises(HTTPTooManyRequests, proto.stream, testing.DummyRequest())
+        assert [f.id for f in features] == [0, 1, 2]
+        assert limiter.stats()[("spots", "read")]["active"] == 0
+
+        # or dropped
+        features = proto.stream(testing.DummyRequest())
+        del features
+        assert [f.id for f in proto.stream(testing.DummyRequest())] == [0, 1, 2]
+
+        samples = metrics.collect()
+        assert samples["papyrus_requests_total"] == {
+            '{layer="spots",action="read",status="200"}': 3,
+            '{layer="spots",action="read",status="429"}': 1,
+        }
+        assert samples["papyrus_rows_returned_total"] == {'{layer="spots",action="read"}': 6}
+
+    def test_read_id(self):
+        from geojson import Feature
+        from shapely.geometry import Point
+
+        from papyrus.protocol import Protocol
+
+        class Session:
+            def query(self, mapped_class):
+                feature = Feature(id="a", geometry=Point(1, 2), properties=dict(text="foo"))
+                return {"a": mapped_class(feature)}
+
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
+        request = testing.DummyRequest()
+
+        feature = proto.read(request, id="a")
+        assert feature.id == "a"
+        assert feature.properties["text"] == "foo"
+
+    def test_read_notfound(self):
+        from pyramid.httpexceptions import HTTPNotFound
+
+        from papyrus.protocol import Protocol
+
+        class Session:
+            def query(self, mapped_class):
+                return {"a": None}
+
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
+        request = testing.DummyRequest()
+
+        resp = proto.read(request, id="a")
+        assert isinstance(resp, HTTPNotFound)
+
+    def test_read_many(self):
+        from geojson import Feature, FeatureCollection
+        from shapely.geometry import Point
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        MappedClass = self._get_mapped_class()
+
+        proto = Protocol(Session, MappedClass, "geom")
+
+        def _query(request, filter):
+            f1 = Feature(geometry=Point(1, 2))
+            f2 = Feature(geometry=Point(2, 3))
+            return [MappedClass(f1), MappedClass(f2)]
+
+        proto._query = _query
+
+        features = proto.read(testing.DummyRequest())
+        assert isinstance(features, FeatureCollection)
+        assert len(features.features) == 2
+
+    def test__get_partitions(self):
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        MappedClass = self._get_mapped_class()
+        counts = {"count": 100, "low": 1, "high": 100}
+
+        class MockQuery:
+            def filter(self, filter):
+                return self
+
+            def one(self):
+                return counts["count"], counts["low"], counts["high"]
+
+        class MockSession:
+            def query(self, *entities):
+                return MockQuery()
+
+        proto = Protocol(MockSession, MappedClass, "geom", partitions=4, partition_threshold=50)
+        partitions = proto._get_partitions(testing.DummyRequest(), MappedClass.text == "foo")
+        assert len(partitions) == 4
+        sql = str(partitions[0].compile(engine))
+        assert '"table".text = ' in sql
+        assert '"table".id >= ' in sql
+        assert '"table".id < ' in sql
+
+        # no partitioning for small result sets and for offsets
+        counts["count"] = 10
+        assert proto._get_partitions(testing.DummyRequest(), None) is None
+        counts["count"] = 100
+        assert proto._get_partitions(testing.DummyRequest(params={"offset": "10"}), None) is None
+        # nor for empty result sets
+        proto.partition_threshold = 0
+        counts.update(count=0, low=None, high=None)
+        assert proto._get_partitions(testing.DummyRequest(), None) is None
+
+    def test__partitioned_query(self):
+        from geojson import Feature
+
+        from papyrus import timing
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+        proto = Protocol(None, MappedClass, "geom", partitions=3)
+        proto._get_partitions = lambda request, filter: ["a", "b", "c"]
+        data = {
+            "a": [
+                MappedClass(Feature(id=i, properties={"text": t})) for i, t in ((1, "a"), (2, "d"), (3, None))
+            ],
+            "b": [MappedClass(Feature(id=i, properties={"text": t})) for i, t in ((4, "b"), (5, "e"))],
+            "c": [MappedClass(Feature(id=i, properties={"text": t})) for i, t in ((6, "c"), (7, "f"))],
+        }
+        proto._read_partition = lambda request, filter: data[filter]
+
+        objs = list(proto._partitioned_query(testing.DummyRequest(), filter=MappedClass.id > 0))
+        assert sorted(o.id for o in objs) == [1, 2, 3, 4, 5, 6, 7]
+
+        request = testing.DummyRequest(params={"sort": "text"})
+        objs = list(proto._partitioned_query(request, filter=MappedClass.id > 0))
+        assert [o.text for o in objs] == ["a", "b", "c", "d", "e", "f", None]
+
+        data = {k: list(reversed(v)) for k, v in data.items()}
+        request = testing.DummyRequest(params={"sort": "text", "dir": "DESC", "limit": "3"})
+        objs = list(proto._partitioned_query(request, filter=MappedClass.id > 0))
+        assert [o.text for o in objs] == [None, "f", "e"]
+
+        # the partitions are read with the context of the request
+        timings = timing.Timings()
+        contexts = []
+
+        def _read_partition(request, filter):
+            contexts.append(timing._current.get())
+            return data[filter]
+
+        proto._read_partition = _read_partition
+        executor = proto._get_executor()
+        with timings.phase("orm"):
+            assert len(list(proto._partitioned_query(testing.DummyRequest(), filter=MappedClass.id > 0))) == 7
+        assert contexts == [timings] * 3
+        assert proto._get_executor() is executor
+        proto.close()
+        assert proto._executor is None
+
+    def test_read_many_partitioned(self):
+        from geojson import Feature, FeatureCollection
+
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+        proto = Protocol(None, MappedClass, "geom", partitions=2)
+
+        def _partitioned_query(request, filter):
+            yield MappedClass(Feature(id=1))
+            yield MappedClass(Feature(id=2))
+
+        proto._partitioned_query = _partitioned_query
+        features = proto.read(testing.DummyRequest())
+        assert isinstance(features, FeatureCollection)
+        assert [f.id for f in features.features] == [1, 2]
+
+    def test__cluster_query(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
+
+        request = testing.DummyRequest(
+            params={"resolution": "10", "aggregate": "id:max", "bbox": "0,0,100,100"}
+        )
+        sql = query_to_str(proto._cluster_query(request), engine)
+        assert b"count(*) AS count" in sql
+        assert b"ST_Centroid(ST_Collect(anon_1.geom))) AS geom" in sql
+        assert b"max(anon_1.id) AS id_max" in sql
+        assert b"ST_SnapToGrid(ST_Centroid(" in sql
+        assert b"ST_DWithin" in sql
+        assert b"GROUP BY anon_1.cluster" in sql
+
+        request = testing.DummyRequest(params={"resolution": "10", "method": "dbscan", "output_epsg": "2056"})
+        sql = query_to_str(proto._cluster_query(request), engine)
+        assert b"ST_ClusterDBSCAN(ST_Transform(" in sql
+        assert b"OVER ()" in sql
+
+        for params in (
+            {},
+            {"resolution": "10", "method": "foo"},
+            {"resolution": "10", "aggregate": "id:foo"},
+            {"resolution": "10", "aggregate": "foo:sum"},
+        ):
+            self.assertRaises(HTTPBadRequest, proto._cluster_query, testing.DummyRequest(params=params))
+
+    def test_cluster(self):
+        from geoalchemy2.shape import from_shape
+        from shapely.geometry import Point
+        from sqlalchemy.engine.result import result_tuple
+
+        from papyrus.protocol import Protocol
+
+        proto = Protocol(None, self._get_mapped_class(), "geom")
+        row = result_tuple(["count", "geom", "id_max"])
+
+        class MockQuery:
+            session = None
+
+            def all(self):
+                return [row((3, from_shape(Point(1, 2)), 7)), row((1, from_shape(Point(3, 4)), 8))]
+
+        proto._cluster_query = lambda request, filter: MockQuery()
+        collection = proto.cluster(testing.DummyRequest(params={"resolution": "10"}))
+        assert len(collection.features) == 2
+        assert collection.features[0].properties == {"count": 3, "id_max": 7}
+        assert collection.features[0].geometry.coordinates == [1.0, 2.0]
+
+        proto = Protocol(None, self._get_mapped_class(), "geom")
+        assert proto.cluster(testing.DummyRequest()).status_int == 400
+
+    def test__aggregate_query(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        proto = Protocol(Session, self._get_mapped_class(), "geom")
+
+        request = testing.DummyRequest(params={"size": "10", "aggregate": "id:avg", "bbox": "0,0,100,100"})
+        sql = query_to_str(proto._aggregate_query(request), engine)
+        assert b"FROM ST_SquareGrid(" in sql
+        assert b"ST_MakeEnvelope(" in sql
+        assert b"count(*) AS count" in sql
+        assert b'avg("table".id) AS id_avg' in sql
+        assert b'JOIN "table" ON ST_Intersects(anon_1.geom, "table".geom) AND ST_DWithin(' in sql
+        assert b"GROUP BY anon_1.geom, anon_1.i, anon_1.j" in sql
+
+        request = testing.DummyRequest(params={"size": "10", "shape": "hexagon", "output_epsg": "2056"})
+        sql = query_to_str(proto._aggregate_query(request), engine)
+        assert b"FROM ST_HexagonGrid(" in sql
+        assert b"ST_Extent(" in sql
+        assert b"ST_Transform(anon_1.geom" in sql
+
+        for params in ({}, {"size": "10", "shape": "foo"}, {"size": "10", "aggregate": "foo:sum"}):
+            self.assertRaises(HTTPBadRequest, proto._aggregate_query, testing.DummyRequest(params=params))
+
+    def test_aggregate(self):
+        from geoalchemy2.shape import from_shape
+        from shapely.geometry import box
+        from sqlalchemy.engine.result import result_tuple
+
+        from papyrus.protocol import Protocol
+
+        proto = Protocol(None, self._get_mapped_class(), "geom")
+        row = result_tuple(["geom", "i", "j", "count", "id_avg"])
+
+        class MockQuery:
+            session = None
+
+            def yield_per(self, count):
+                return iter([row((from_shape(box(0, 0, 10, 10)), 0, 0, 3, 2.5))])
+
+        proto._aggregate_query = lambda request, filter: MockQuery()
+        collection = proto.aggregate(testing.DummyRequest(params={"size": "10"}))
+        assert len(collection.features) == 1
+        assert collection.features[0].properties == {"i": 0, "j": 0, "count": 3, "id_avg": 2.5}
+        assert collection.features[0].geometry.type == "Polygon"
+
+        proto = Protocol(None, self._get_mapped_class(), "geom")
+        assert proto.aggregate(testing.DummyRequest()).status_int == 400
+
+    def test_create_forbidden(self):
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        MappedClass = self._get_mapped_class()
+
+        proto = Protocol(Session, MappedClass, "geom", readonly=True)
+        # we need an actual Request object here, for body to do its job
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}]}'  # NOQA
+        response = proto.create(request)
+        assert response.headers.get("Allow") == "GET, HEAD"
+        assert response.status_int == 405
+
+    def test_create_badrequest(self):
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        MappedClass = self._get_mapped_class()
+
+        proto = Protocol(Session, MappedClass, "geom")
+        # we need an actual Request object here, for body to do its job
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}'  # NOQA
+        response = proto.create(request)
+        assert response.status_int == 400
+
+    def test_create(self):
+        from geoalchemy2.shape import to_shape
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        MappedClass = self._get_mapped_class()
+
+        class MockSession:
+            def add(self, o):
+                Session.add(o)
+
+            def flush(self):
+                pass
+
+        # a before_update callback
+        def before_create(request, feature, obj):
+            if not hasattr(request, "_log"):
+                request._log = []
+            request._log.append(dict(feature=feature, obj=obj))
+
+        proto = Protocol(MockSession, MappedClass, "geom", before_create=before_create)
+
+        # we need an actual Request object here, for body to do its job
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}]}'  # NOQA
+        proto.create(request)
+        assert len(Session.new) == 2
+        for obj in Session.new:
+            assert obj.text == "foo"
+            shape = to_shape(obj.geom)
+            assert shape.x == 45
+            assert shape.y == 5
+        Session.rollback()
+
+        # test before_create
+        assert hasattr(request, "_log")
+        assert len(request._log) == 2
+        assert request._log[0]["feature"].properties["text"] == "foo"
+        assert request._log[0]["obj"] is None
+        assert request._log[1]["feature"].properties["text"] == "foo"
+        assert request._log[1]["obj"] is None
+
+        # test response status
+        assert request.response.status_int == 201
+
+    def test_create_batches(self):
+        from io import BytesIO
+
+        from pyramid.httpexceptions import HTTPBadRequest
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+        log = []
+
+        class MockSession:
+            def add(self, o):
+                log.append(o.text)
+
+            def flush(self):
+                log.append("flush")
+
+            def expunge(self, o):
+                log.append(f"expunge {o.text}")
+
+        proto = Protocol(MockSession, MappedClass, "geom", batch_size=2)
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body_file = BytesIO(
+            b'{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "a"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "properties": {"text": "b"}, "geometry": null}, {"type": "Feature", "properties": {"text": "c"}, "geometry": null}]}'  # NOQA
+        )
+        response = proto.create(request)
+        assert response.status_int == 201
+        assert response.json_body == {"count": 3}
+        assert log == ["a", "b", "flush", "expunge a", "expunge b", "c", "flush", "expunge c"]
+
+        request.body_file = BytesIO(b'{"type": "Feature", "properties": {"text": "a"}}')
+        self.assertRaises(HTTPBadRequest, proto.create, request)
+
+    def test_create_seq(self):
+        from io import BytesIO
+        from unittest.mock import patch
+
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+        log = []
+
+        class MockSession:
+            def add(self, o):
+                log.append(o.text)
+
+            def flush(self):
+                log.append("flush")
+
+            def expunge(self, o):
+                pass
+
+        proto = Protocol(MockSession, MappedClass, "geom")
+        request = DummyRequest({})
+        request.method = "POST"
+        request.content_type = "application/geo+json-seq"
+        request.body_file = BytesIO(
+            b'\x1e{"type": "Feature", "properties": {"text": "a"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}\n'
+            b'\x1e{"type": "Feature", "properties": {"text": "b"}, "geometry": null}\n'
+        )
+        response = proto.create(request)
+        assert response.json_body == {"count": 2}
+        assert log == ["a", "b", "flush"]
+        assert response.status_int == 201
+
+        # without batch_size the text sequences are created by batches of CREATE_BATCH_SIZE features
+        del log[:]
+        with patch("papyrus.protocol.CREATE_BATCH_SIZE", 1):
+            request.body_file.seek(0)
+            assert proto.create(request).json_body == {"count": 2}
+        assert log == ["a", "flush", "b", "flush"]
+
+    def test_create_empty(self):
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        engine = self._get_engine()
+        Session = self._get_session(engine)
+        MappedClass = self._get_mapped_class()
+
+        proto = Protocol(Session, MappedClass, "geom")
+
+        # we need an actual Request object here, for body to do its job
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "FeatureCollection", "features": []}'
+        resp = proto.create(request)
+        assert resp is None
+
+    def test_create_update(self):
+        from geoalchemy2.shape import to_shape
+        from geojson import Feature, FeatureCollection
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import Protocol
+
+        MappedClass = self._get_mapped_class()
+
+        # a mock session specific to this test
+        class MockSession:
+            def query(self, mapped_class):
+                return {"a": mapped_class(Feature(id="a")), "b": mapped_class(Feature(id="b"))}
+
+            def flush(self):
+                pass
+
+        proto = Protocol(MockSession, MappedClass, "geom")
+
+        # we need an actual Request object here, for body to do its job
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "id": "a", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "id": "b", "properties": {"text": "bar"}, "geometry": {"type": "Point", "coordinates": [46, 6]}}]}'  # NOQA
+        features = proto.create(request)
+
+        assert isinstance(features, FeatureCollection)
+        assert len(features.features) == 2
+        assert features.features[0].id == "a"
         assert features.features[0].text == "foo"
         shape_0 = to_shape(features.features[0].geom)
         assert shape_0.x == 45
@@ -868,3 +2100,544 @@ class Test_protocol(unittest.TestCase):
         # test before_delete
         assert hasattr(request, "_log")
         assert isinstance(request._log["obj"], MappedClass)
+
+
+class AsyncMockSession:
+    """A mock ``AsyncSession``, recording whether it was committed and closed."""
+
+    committed = False
+    closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        yield
+        self.committed = True
+
+
+class Test_async_protocol(unittest.TestCase):
+    _get_engine = Test_protocol._get_engine
+    _get_mapped_class = Test_protocol._get_mapped_class
+
+    def _run(self, coro):
+        import asyncio
+
+        return asyncio.run(coro)
+
+    def test__query(self):
+        from papyrus.protocol import AsyncProtocol
+
+        engine = self._get_engine()
+        MappedClass = self._get_mapped_class()
+        statements = []
+
+        class Result:
+            def scalars(self):
+                return self
+
+            def all(self):
+                return []
+
+        class MockSession(AsyncMockSession):
+            async def execute(self, stmt):
+                statements.append(stmt)
+                return Result()
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+        request = testing.DummyRequest(
+            params={"queryable": "id", "id__eq": "1", "limit": "2", "sort": "text"}
+        )
+        assert self._run(proto._query(request)) == []
+        sql = str(statements[0].compile(engine))
+        assert "WHERE" in sql
+        assert "ORDER BY" in sql
+        assert "LIMIT" in sql
+
+    def test_count(self):
+        from papyrus.protocol import AsyncProtocol
+
+        engine = self._get_engine()
+        statements = []
+
+        class Result:
+            def scalar_one(self):
+                return 3
+
+        class MockSession(AsyncMockSession):
+            async def execute(self, stmt):
+                statements.append(stmt)
+                return Result()
+
+        proto = AsyncProtocol(MockSession, self._get_mapped_class(), "geom")
+        request = testing.DummyRequest(params={"bbox": "-180,-90,180,90"})
+        assert self._run(proto.count(request)) == 3
+        sql = str(statements[0].compile(engine))
+        assert "count(*)" in sql
+        assert "ST_DWithin" in sql
+
+        request = testing.DummyRequest(params={"nearest": "10", "lon": "1", "lat": "2"})
+        assert self._run(proto.count(request)) == 3
+        sql = str(statements[1].compile(engine))
+        assert "count(*)" in sql
+        assert "LIMIT" in sql
+
+    def test_read_id(self):
+        from geojson import Feature
+        from pyramid.httpexceptions import HTTPNotFound
+        from shapely.geometry import Point
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+
+        class MockSession(AsyncMockSession):
+            async def get(self, mapped_class, id):
+                if id == "a":
+                    return mapped_class(Feature(id="a", geometry=Point(1, 2), properties={"text": "foo"}))
+                return None
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+        request = testing.DummyRequest(params={"attrs": "text"})
+        feature = self._run(proto.read(request, id="a"))
+        assert feature.id == "a"
+        assert feature.properties == {"text": "foo"}
+        assert isinstance(self._run(proto.read(request, id="b")), HTTPNotFound)
+
+    def test_read_many(self):
+        from geojson import Feature, FeatureCollection
+        from shapely.geometry import Point
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        proto = AsyncProtocol(None, MappedClass, "geom")
+
+        async def _query(request, filter):
+            return [MappedClass(Feature(geometry=Point(1, 2))), MappedClass(Feature(geometry=Point(2, 3)))]
+
+        proto._query = _query
+        features = self._run(proto.read(testing.DummyRequest()))
+        assert isinstance(features, FeatureCollection)
+        assert len(features.features) == 2
+
+    def test_stream(self):
+        from geojson import Feature
+        from shapely.geometry import Point
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+
+        class AsyncResult:
+            def __init__(self, objs):
+                self.objs = objs
+
+            async def __aiter__(self):
+                for o in self.objs:
+                    yield o
+
+        class MockSession(AsyncMockSession):
+            async def stream_scalars(self, stmt):
+                return AsyncResult(
+                    [
+                        MappedClass(Feature(id=i, geometry=Point(i, i), properties={"text": "foo"}))
+                        for i in range(3)
+                    ]
+                )
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+
+        async def collect():
+            request = testing.DummyRequest(params={"no_geom": "true"})
+            return [f async for f in proto.stream(request)]
+
+        features = self._run(collect())
+        assert [f.id for f in features] == [0, 1, 2]
+        assert all(f.geometry is None for f in features)
+
+    def test_cluster(self):
+        from geoalchemy2.shape import from_shape
+        from shapely.geometry import Point
+        from sqlalchemy.engine.result import result_tuple
+
+        from papyrus.protocol import AsyncProtocol
+
+        engine = self._get_engine()
+        row = result_tuple(["count", "geom", "id_max"])
+        statements = []
+
+        class Result:
+            def all(self):
+                return [row((3, from_shape(Point(1, 2)), 7))]
+
+        class MockSession(AsyncMockSession):
+            async def execute(self, stmt):
+                statements.append(stmt)
+                return Result()
+
+        proto = AsyncProtocol(MockSession, self._get_mapped_class(), "geom")
+        request = testing.DummyRequest(params={"resolution": "10", "aggregate": "id:max"})
+        collection = self._run(proto.cluster(request))
+        assert collection.features[0].properties == {"count": 3, "id_max": 7}
+        assert collection.features[0].geometry.coordinates == [1.0, 2.0]
+        assert b"ST_SnapToGrid(ST_Centroid(" in _compiled_to_string(statements[0].compile(engine))
+
+        assert self._run(proto.cluster(testing.DummyRequest())).status_int == 400
+
+    def test_aggregate(self):
+        from geoalchemy2.shape import from_shape
+        from shapely.geometry import box
+        from sqlalchemy.engine.result import result_tuple
+
+        from papyrus.protocol import AsyncProtocol
+
+        engine = self._get_engine()
+        row = result_tuple(["geom", "i", "j", "count", "id_avg"])
+        statements = []
+
+        class AsyncResult:
+            async def __aiter__(self):
+                yield row((from_shape(box(0, 0, 10, 10)), 0, 0, 3, 2.5))
+
+        class MockSession(AsyncMockSession):
+            async def stream(self, stmt):
+                statements.append(stmt)
+                return AsyncResult()
+
+        proto = AsyncProtocol(MockSession, self._get_mapped_class(), "geom")
+        request = testing.DummyRequest(params={"size": "10", "aggregate": "id:avg"})
+        collection = self._run(proto.aggregate(request))
+        assert collection.features[0].properties == {"i": 0, "j": 0, "count": 3, "id_avg": 2.5}
+        assert collection.features[0].geometry.type == "Polygon"
+        assert b"FROM ST_SquareGrid(" in _compiled_to_string(statements[0].compile(engine))
+
+        assert self._run(proto.aggregate(testing.DummyRequest())).status_int == 400
+
+    def test_create(self):
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        added = []
+
+        class MockSession(AsyncMockSession):
+            async def get(self, mapped_class, id):
+                return None
+
+            def add(self, o):
+                added.append(o)
+
+            async def flush(self):
+                pass
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+        request = DummyRequest({})
+        request.method = "POST"
+        request.body = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}, {"type": "Feature", "id": "a", "properties": {"text": "bar"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}]}'  # NOQA
+        collection = self._run(proto.create(request))
+        assert len(collection.features) == 2
+        assert [o.text for o in added] == ["foo", "bar"]
+        assert request.response.status_int == 201
+
+    def test_create_seq(self):
+        from io import BytesIO
+
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        log = []
+
+        class MockSession(AsyncMockSession):
+            async def get(self, mapped_class, id):
+                return None
+
+            def add(self, o):
+                log.append(o.text)
+
+            async def flush(self):
+                log.append("flush")
+
+            def expunge(self, o):
+                log.append("expunge")
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom", batch_size=1)
+        request = DummyRequest({})
+        request.method = "POST"
+        request.content_type = "application/x-ndjson"
+        request.body_file = BytesIO(
+            b'{"type": "Feature", "properties": {"text": "a"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}\n'
+            b'{"type": "Feature", "properties": {"text": "b"}, "geometry": null}\n'
+        )
+        response = self._run(proto.create(request))
+        assert response.status_int == 201
+        assert response.json_body == {"count": 2}
+        assert log == ["a", "flush", "expunge", "b", "flush", "expunge"]
+
+    def test_update_delete(self):
+        from geojson import Feature
+        from pyramid.testing import DummyRequest
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        deleted = []
+
+        class MockSession(AsyncMockSession):
+            async def get(self, mapped_class, id):
+                return mapped_class(Feature(id="a")) if id == "a" else None
+
+            async def flush(self):
+                pass
+
+            async def delete(self, obj):
+                deleted.append(obj)
+
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+        request = DummyRequest({})
+        request.method = "PUT"
+        request.body = '{"type": "Feature", "id": "a", "properties": {"text": "foo"}, "geometry": {"type": "Point", "coordinates": [45, 5]}}'  # NOQA
+        feature = self._run(proto.update(request, "a"))
+        assert feature.properties["text"] == "foo"
+        assert self._run(proto.update(request, "b")).status_int == 404
+
+        response = self._run(proto.delete(testing.DummyRequest(), "a"))
+        assert response.status_int == 204
+        assert len(deleted) == 1
+
+    def test_session_lifecycle(self):
+        from geojson import Feature
+        from sqlalchemy.ext.asyncio import async_scoped_session
+
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        sessions = []
+
+        class MockSession(AsyncMockSession):
+            def __init__(self):
+                sessions.append(self)
+
+            async def get(self, mapped_class, id):
+                return mapped_class(Feature(id=id))
+
+            async def flush(self):
+                pass
+
+        request = testing.DummyRequest()
+        request.body = '{"type": "Feature", "id": "a", "properties": {"text": "foo"}, "geometry": null}'
+        proto = AsyncProtocol(MockSession, MappedClass, "geom")
+        self._run(proto.read(request, id="a"))
+        self._run(proto.update(request, "a"))
+        assert [(s.committed, s.closed) for s in sessions] == [(False, True), (True, True)]
+
+        # The scoped sessions are committed and closed by the application
+        del sessions[:]
+        Session = async_scoped_session(MockSession, scopefunc=lambda: request)
+        proto = AsyncProtocol(Session, MappedClass, "geom")
+        self._run(proto.read(request, id="a"))
+        self._run(proto.update(request, "a"))
+        assert [(s.committed, s.closed) for s in sessions] == [(False, False)]
+
+    def test_readonly(self):
+        from papyrus.protocol import AsyncProtocol
+
+        proto = AsyncProtocol(None, self._get_mapped_class(), "geom", readonly=True)
+        request = testing.DummyRequest()
+        assert self._run(proto.create(request)).status_int == 405
+        assert self._run(proto.update(request, 1)).status_int == 405
+        assert self._run(proto.delete(request, 1)).status_int == 405
+
+    def test_unsupported_arguments(self):
+        from papyrus.metrics import MetricsRegistry
+        from papyrus.protocol import AsyncProtocol
+
+        MappedClass = self._get_mapped_class()
+        AsyncProtocol(None, MappedClass, "geom", partitions=1, coalesce=False)
+        with self.assertRaises(TypeError) as cm:
+            AsyncProtocol(None, MappedClass, "geom", coalesce=True, metrics=MetricsRegistry())
+        assert str(cm.exception) == "AsyncProtocol does not support the coalesce, metrics arguments"
+        self.assertRaises(TypeError, AsyncProtocol, None, MappedClass, "geom", partitions=4)
+
+
+class Test_memory_protocol(unittest.TestCase):
+    _get_mapped_class = Test_protocol._get_mapped_class
+
+    def _get_protocol(self, **kwargs):
+        from geojson import Feature
+        from shapely.geometry import Point, Polygon
+        from sqlalchemy import orm
+
+        from papyrus.protocol import MemoryProtocol
+
+        MappedClass = self._get_mapped_class()
+        loads = []
+
+        class MockSession(orm.Session):
+            def query(self, mapped_class):
+                class Query:
+                    def order_by(self, *args):
+                        return self
+
+                    def all(self):
+                        loads.append(mapped_class)
+                        return [
+                            mapped_class(Feature(id=1, geometry=Point(1, 1), properties={"text": "foo"})),
+                            mapped_class(Feature(id=2, geometry=Point(5, 5), properties={"text": "bar"})),
+                            mapped_class(
+                                Feature(id=3, geometry=Polygon(((0, 0), (0, 10), (10, 10), (0, 0)))),
+                            ),
+                        ]
+
+                    def get(self, id):
+                        return mapped_class(Feature(id=1)) if id == 1 else None
+
+                return Query()
+
+            def delete(self, obj):
+                pass
+
+        proto = MemoryProtocol(
+            orm.scoped_session(orm.sessionmaker(class_=MockSession)), MappedClass, "geom", **kwargs
+        )
+        return proto, loads
+
+    def test_read(self):
+        proto, loads = self._get_protocol()
+
+        features = proto.read(testing.DummyRequest())
+        assert [f.id for f in features.features] == [1, 2, 3]
+        assert features.features[0].properties == {"text": "foo"}
+
+        features = proto.read(testing.DummyRequest(params={"bbox": "0,0,2,2"}))
+        assert [f.id for f in features.features] == [1, 3]
+        features = proto.read(testing.DummyRequest(params={"lon": "6", "lat": "5", "tolerance": "1.5"}))
+        assert [f.id for f in features.features] == [2, 3]
+        features = proto.read(testing.DummyRequest(params={"lon": "9", "lat": "1"}))
+        assert [f.id for f in features.features] == []
+
+        params = {"queryable": "text", "text__eq": "foo", "attrs": "text", "no_geom": "true"}
+        features = proto.read(testing.DummyRequest(params=params))
+        assert [f.id for f in features.features] == [1]
+        assert features.features[0].geometry is None
+        features = proto.read(testing.DummyRequest(params={"queryable": "text", "text__ilike": "B%"}))
+        assert [f.id for f in features.features] == [2]
+        features = proto.read(testing.DummyRequest(params={"queryable": "id", "id__gte": "2"}))
+        assert [f.id for f in features.features] == [2, 3]
+
+        features = proto.read(testing.DummyRequest(params={"sort": "text"}))
+        assert [f.id for f in features.features] == [2, 1, 3]
+        features = proto.read(testing.DummyRequest(params={"sort": "text", "dir": "DESC", "limit": "2"}))
+        assert [f.id for f in features.features] == [3, 1]
+        features = proto.read(testing.DummyRequest(params={"offset": "1", "limit": "1"}))
+        assert [f.id for f in features.features] == [2]
+
+        features = proto.read(testing.DummyRequest(params={"bbox": "0,0,2,2", "clip": "true"}))
+        assert features.features[1].geometry.coordinates == [[[0.0, 0.0], [0.0, 2.0], [2.0, 2.0], [0.0, 0.0]]]
+        # the loaded feature is not modified
+        assert len(proto.read(testing.DummyRequest()).features[2].geometry.coordinates[0]) == 4
+
+        assert proto.read(testing.DummyRequest(), id="2").id == 2
+        assert proto.read(testing.DummyRequest(), id="4").status_int == 404
+        assert len(loads) == 1
+
+    def test_count(self):
+        proto, _ = self._get_protocol()
+        assert proto.count(testing.DummyRequest()) == 3
+        assert proto.count(testing.DummyRequest(params={"bbox": "4,4,6,6"})) == 2
+
+    def test_database_fallback(self):
+        from geojson import Feature
+
+        proto, _ = self._get_protocol()
+        queries = []
+
+        def _query(request, filter):
+            queries.append(filter)
+            return [proto.mapped_class(Feature(id=4))]
+
+        proto._query = _query
+        for params in ({"nearest": "1", "lon": "1", "lat": "1"}, {"epsg": "2056"}, {"output_epsg": "2056"}):
+            features = proto.read(testing.DummyRequest(params=params))
+            assert [f.id for f in features.features] == [4]
+        features = proto.read(testing.DummyRequest(), filter=proto.mapped_class.id == 4)
+        assert [f.id for f in features.features] == [4]
+        assert len(queries) == 4
+
+    def test_database_fallback_composite_primary_key(self):
+        from geoalchemy2.types import Geometry
+        from sqlalchemy import Column, MetaData, types
+        from sqlalchemy.ext.declarative import declarative_base
+
+        from papyrus.protocol import MemoryProtocol
+
+        Base = declarative_base(metadata=MetaData())
+
+        class Parcel(Base):
+            __tablename__ = "parcel"
+            municipality = Column(types.Integer, primary_key=True)
+            number = Column(types.Integer, primary_key=True)
+            geom = Column(Geometry(geometry_type="POLYGON", dimension=2, srid=2056))
+
+        class MockSession:
+            def query(self, *args):
+                raise AssertionError("the features are not loaded")
+
+        proto = MemoryProtocol(MockSession, Parcel, "geom")
+        proto._query = lambda request, filter: []
+        assert proto.read(testing.DummyRequest()).features == []
+
+    def test_attr_test_invalid_value(self):
+        from decimal import Decimal
+
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        from papyrus.protocol import _create_attr_test
+
+        assert _create_attr_test("eq", "1.5", Decimal)(Decimal("1.5"))
+        self.assertRaises(HTTPBadRequest, _create_attr_test, "eq", "abc", Decimal)
+        self.assertRaises(HTTPBadRequest, _create_attr_test, "eq", "abc", int)
+
+    def test_metrics(self):
+        from papyrus.metrics import MetricsRegistry
+
+        proto, _ = self._get_protocol(name="memory_spots", metrics=MetricsRegistry())
+        proto._query = lambda request, filter: []
+        proto.read(testing.DummyRequest())
+        proto.read(testing.DummyRequest(params={"epsg": "2056"}))
+        samples = proto.metrics.collect()
+        # the reads from the database are not counted twice
+        assert samples["papyrus_requests_total"] == {'{layer="memory_spots",action="read",status="200"}': 2}
+        assert samples["papyrus_cache_hits_total"] == {'{layer="memory_spots",cache="memory"}': 1}
+
+    def test_invalidate(self):
+        import time
+
+        proto, loads = self._get_protocol()
+        proto.read(testing.DummyRequest())
+        proto.invalidate()
+        proto.read(testing.DummyRequest())
+        assert len(loads) == 2
+
+        assert proto.delete(testing.DummyRequest(), 1).status_int == 204
+        proto.read(testing.DummyRequest())
+        assert len(loads) == 3
+        proto.Session().commit()
+        proto.read(testing.DummyRequest())
+        assert len(loads) == 4
+        assert proto.delete(testing.DummyRequest(), 2).status_int == 404
+        proto.read(testing.DummyRequest())
+        assert len(loads) == 4
+
+        proto, loads = self._get_protocol(max_age=60)
+        proto.read(testing.DummyRequest())
+        proto._layer.loaded_at = time.monotonic() - 61
+        proto.read(testing.DummyRequest())
+        assert len(loads) == 2
@@ -36,6 +36,22 @@ class Test_GeoJSON(unittest.TestCase):
         }  # NOQA
         assert request.response.content_type == "application/geo+json"
 
+    def test_shared(self):
+        from geojson import Feature
+        from shapely.geometry import Point
+
+        from papyrus.geojsonencoder import SharedFeatureCollection
+
+        renderer = self._callFUT()
+        collection = SharedFeatureCollection([Feature(id=1, geometry=Point(1, 2))])
+        result = renderer(collection, {"request": testing.DummyRequest()})
+        assert json.loads(result)["type"] == "FeatureCollection"
+        collection["features"] = []
+        # the encoded text is shared by the requests
+        assert renderer(collection, {"request": testing.DummyRequest()}) == result
+        request = testing.DummyRequest(params={"callback": "cb"})
+        assert renderer(collection, {"request": request}) == f"cb({result});"
+
     def test_geojson_content_type(self):
         renderer = self._callFUT()
         f = {
@@ -236,6 +252,148 @@ class Test_GeoJSON(unittest.TestCase):
         }  # NOQA
         assert request.response.content_type == "application/geo+json"
 
+    def test_geojsonseq(self):
+        from geojson import Feature, FeatureCollection
+
+        renderer = self._callFUT()
+        collection = FeatureCollection(
+            [Feature(id=1, properties={"a": 1}), Feature(id=2, properties={"a": 2})]
+        )
+        request = testing.DummyRequest(params={"f": "geojsonseq"})
+        result = b"".join(renderer(collection, {"request": request}))
+        records = result.split(b"\x1e")
+        assert records[0] == b""
+        assert [json.loads(r)["id"] for r in records[1:]] == [1, 2]
+        assert all(r.endswith(b"\n") for r in records[1:])
+        assert request.response.content_type == "application/geo+json-seq"
+
+    def test_ndjson(self):
+        renderer = self._callFUT()
+        f = {"type": "Feature", "id": 1, "geometry": None, "properties": {}}
+        request = testing.DummyRequest(params={"f": "ndjson"})
+        result = b"".join(renderer([f, f], {"request": request}))
+        lines = result.splitlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0]) == f
+        assert request.response.content_type == "application/x-ndjson"
+
+    def test_iterator(self):
+        renderer = self._callFUT()
+        features = [{"type": "Feature", "id": i, "geometry": None, "properties": {}} for i in range(3)]
+        request = testing.DummyRequest()
+        result = b"".join(renderer(iter(features), {"request": request}))
+        assert json.loads(result) == {"type": "FeatureCollection", "features": features}
+        assert request.response.content_type == "application/geo+json"
+
+        request = testing.DummyRequest(params={"callback": "cb"})
+        result = b"".join(renderer(iter([]), {"request": request}))
+        assert result == b'cb({"type": "FeatureCollection", "features": []});'
+        assert request.response.content_type == "text/javascript"
+
+        request = testing.DummyRequest(params={"f": "ndjson"})
+        result = b"".join(renderer(iter(features), {"request": request}))
+        assert [json.loads(line)["id"] for line in result.splitlines()] == [0, 1, 2]
+
+    def test_geojsonseq_accept(self):
+        from webob.acceptparse import create_accept_header
+
+        renderer = self._callFUT()
+        f = {"type": "Feature", "id": 1, "geometry": None, "properties": {}}
+        request = testing.DummyRequest()
+        request.accept = create_accept_header("application/geo+json-seq, application/json;q=0.5")
+        result = b"".join(renderer(f, {"request": request}))
+        assert result.startswith(b"\x1e")
+        assert request.response.content_type == "application/geo+json-seq"
+        assert request.response.vary == ("Accept",)
+
+        request = testing.DummyRequest()
+        request.accept = create_accept_header("*/*")
+        result = renderer(f, {"request": request})
+        assert json.loads(result) == f
+        assert request.response.content_type == "application/geo+json"
+        assert request.response.vary == ("Accept",)
+
+    def test_parallel(self):
+        import datetime
+        import decimal
+
+        from geojson import Feature, FeatureCollection
+        from shapely.geometry import Point
+
+        from papyrus.geojsonencoder import dumps
+        from papyrus.renderers import GeoJSON
+
+        factory = GeoJSON(processes=2, parallel_threshold=5, chunk_size=2)
+        renderer = factory({})
+        features = [
+            Feature(
+                id=i,
+                geometry=Point(i, -i) if i != 3 else None,
+                properties={"decimal": decimal.Decimal("0.5"), "date": datetime.date(2011, 5, 21)},
+            )
+            for i in range(7)
+        ]
+        request = testing.DummyRequest()
+        result = renderer(FeatureCollection(features, bbox=[0, -6, 6, 0]), {"request": request})
+        result_parsed = json.loads(result)
+        assert result_parsed["type"] == "FeatureCollection"
+        assert result_parsed["bbox"] == [0, -6, 6, 0]
+        assert [f["id"] for f in result_parsed["features"]] == list(range(7))
+        assert result_parsed["features"][1] == {
+            "type": "Feature",
+            "id": 1,
+            "geometry": {"type": "Point", "coordinates": [1.0, -1.0]},
+            "properties": {"decimal": 0.5, "date": "2011-05-21"},
+        }
+        assert result_parsed["features"][3]["geometry"] is None
+        assert request.response.content_type == "application/geo+json"
+
+        assert result_parsed == json.loads(dumps(FeatureCollection(features, bbox=[0, -6, 6, 0])))
+
+        # under the threshold the collection is encoded in process
+        factory.close()
+        assert factory._executor is None
+        result = renderer(features[:4], {"request": request})
+        assert len(json.loads(result)["features"]) == 4
+        assert factory._executor is None
+
+    def _get_polygons(self, count):
+        from geojson import Feature
+        from shapely.geometry import Point
+
+        return [
+            Feature(
+                id=i, geometry=Point(i, i).buffer(1, 12), properties={"name": f"polygon {i}", "value": i / 2}
+            )
+            for i in range(count)
+        ]
+
+    def test_to_chunk(self):
+        import decimal
+        import marshal
+
+        from papyrus.geojsonencoder import dumps
+        from papyrus.renderers import _encode_chunk, _to_chunk
+
+        def plain(value):
+            if isinstance(value, dict):
+                return all(isinstance(k, str) and plain(v) for k, v in value.items())
+            if isinstance(value, list | tuple):
+                return all(plain(v) for v in value)
+            return value is None or isinstance(value, str | int | float)
+
+        features = self._get_polygons(3)
+        chunk = _to_chunk(features)
+        # The geometries are sent as their coordinates, without Shapely objects
+        assert isinstance(chunk, bytes)
+        assert plain(marshal.loads(chunk))
+        assert _encode_chunk(chunk) == ", ".join(dumps(f) for f in features)
+
+        features[1].properties["value"] = decimal.Decimal("0.5")
+        chunk = _to_chunk(features)
+        assert isinstance(chunk, list)
+        assert _encode_chunk(chunk) == ", ".join(dumps(f) for f in features)
+
 
 class Test_XSD(unittest.TestCase):
     def setUp(self):
@@ -468,6 +626,52 @@ class Test_XSD(unittest.TestCase):
         assert enumerations[0].attrib == {"value": "male"}
         assert enumerations[1].attrib == {"value": "female"}
 
+    def test_cache(self):
+        from unittest.mock import patch
+
+        from sqlalchemy import Column, types
+        from webob import Request
+
+        from papyrus.renderers import XSD
+        from papyrus.xsd import XSDGenerator
+
+        class C(self.base):
+            __tablename__ = "table"
+            _id = Column(types.Integer, primary_key=True)
+            column = Column(types.Integer)
+
+        get_class_xsd = XSDGenerator.get_class_xsd
+        calls = []
+
+        def _get_class_xsd(generator, io, cls):
+            calls.append(cls)
+            return get_class_xsd(generator, io, cls)
+
+        with patch.object(XSDGenerator, "get_class_xsd", _get_class_xsd):
+            xsd = XSD(prepare=[C])
+            assert calls == [C]
+            renderer = xsd({})
+            first = renderer(C, {"request": testing.DummyRequest()})
+            request = testing.DummyRequest()
+            second = renderer(C, {"request": request})
+            assert first == second
+            assert calls == [C]
+            etag = request.response.etag
+            assert etag
+
+            request.response.body = second
+            conditional_request = Request.blank("/", headers={"If-None-Match": f'"{etag}"'})
+            assert conditional_request.get_response(request.response).status_int == 304
+
+            xsd.clear_cache()
+            renderer(C, {"request": testing.DummyRequest()})
+            assert calls == [C, C]
+
+            renderer = XSD(cache=False)({})
+            renderer(C, {"request": testing.DummyRequest()})
+            renderer(C, {"request": testing.DummyRequest()})
+            assert calls == [C, C, C, C]
+
     def test_element_callback(self):
         from geoalchemy2.types import Geometry
         from sqlalchemy import Column, types
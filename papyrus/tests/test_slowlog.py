@@ -0,0 +1,65 @@
+import contextlib
+import unittest
+
+from pyramid import testing
+
+from papyrus import slowlog
+
+
+class Test_watch(unittest.TestCase):
+    def test_watch(self):
+        from sqlalchemy import create_engine, text
+
+        engine = create_engine("sqlite://")
+        request = testing.DummyRequest(params={"queryable": "name"})
+        with engine.connect() as connection, self.assertLogs("papyrus.slowlog") as logs:
+            with slowlog.watch(request, "spots", 0):
+                connection.execute(text("SELECT :value"), {"value": 1})
+            with slowlog.watch(request, "spots", 60):
+                connection.execute(text("SELECT 2"))
+            connection.execute(text("SELECT 3"))
+            slowlog.LOG.warning("end")
+        assert len(logs.records) == 2
+        message = logs.records[0].getMessage()
+        assert message.startswith("Slow query on spots (")
+        assert "{'queryable': 'name'}" in message
+        assert "SELECT ?" in message
+        assert "parameters: (1,)" in message
+
+    def test_is_select(self):
+        assert slowlog._is_select("SELECT 1")
+        assert slowlog._is_select("\n  select 1")
+        assert slowlog._is_select("WITH a AS (SELECT 1) SELECT * FROM a")
+        assert slowlog._is_select("WITH\na AS (SELECT 1) SELECT * FROM a")
+        assert not slowlog._is_select("INSERT INTO spots VALUES (1)")
+        assert not slowlog._is_select("SELECTED")
+        assert not slowlog._is_select("")
+
+    def test_explain(self):
+        statements = []
+
+        class MockConnection:
+            def exec_driver_sql(self, statement, parameters=None):
+                statements.append((statement, parameters))
+                return [("Seq Scan on spots",), ("Buffers: shared hit=1",)]
+
+        class MockEngine:
+            @contextlib.contextmanager
+            def connect(self):
+                yield MockConnection()
+
+        assert slowlog._pending.acquire(blocking=False)
+        with self.assertLogs("papyrus.slowlog") as logs:
+            slowlog._explain(MockEngine(), "SELECT %(id)s", {"id": 1}, "spots")
+        assert statements == [
+            ("SET TRANSACTION READ ONLY", None),
+            ("EXPLAIN (ANALYZE, BUFFERS) SELECT %(id)s", {"id": 1}),
+        ]
+        assert logs.records[0].getMessage() == (
+            "Plan of the slow query on spots:\nSeq Scan on spots\nBuffers: shared hit=1"
+        )
+        # The slot is released
+        for _ in range(slowlog.MAX_PENDING_EXPLAINS):
+            assert slowlog._pending.acquire(blocking=False)
+        for _ in range(slowlog.MAX_PENDING_EXPLAINS):
+            slowlog._pending.release()
@@ -0,0 +1,54 @@
+import time
+import unittest
+
+from pyramid import testing
+from pyramid.response import Response
+
+from papyrus.timing import Timings, get_timings, phase
+
+
+class Test_Timings(unittest.TestCase):
+    def test_phase(self):
+        timings = Timings()
+        with timings.phase("orm"):
+            time.sleep(0.01)
+            with timings.phase("geo"):
+                time.sleep(0.02)
+        with timings.phase("geo"):
+            pass
+        assert list(timings.durations) == ["geo", "orm"]
+        # the nested phases are not counted in the enclosing phase
+        assert 10 <= timings.durations["orm"] < timings.durations["geo"]
+        assert timings.server_timing().startswith("geo;dur=")
+
+        with phase(None, "geo"):
+            pass
+
+    def test_sql(self):
+        from sqlalchemy import create_engine, text
+
+        timings = get_timings(testing.DummyRequest())
+        engine = create_engine("sqlite://")
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            assert "sql" not in timings.durations
+            with timings.phase("orm"):
+                connection.execute(text("SELECT 1"))
+        assert set(timings.durations) == {"orm", "sql"}
+
+    def test_get_timings(self):
+        calls = []
+        request = testing.DummyRequest()
+        timings = get_timings(request, header=False, callback=lambda request, timings: calls.append(timings))
+        assert get_timings(request, header=False) is timings
+        response = Response()
+        request._process_response_callbacks(response)
+        assert "Server-Timing" not in response.headers
+        assert calls == [timings]
+
+        request = testing.DummyRequest()
+        with get_timings(request).phase("filter"):
+            pass
+        response = Response()
+        request._process_response_callbacks(response)
+        assert response.headers["Server-Timing"].startswith("filter;dur=")
@@ -0,0 +1,42 @@
+import contextlib
+import unittest
+
+from papyrus.tracing import start_span
+
+
+class MockSpan:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def is_recording(self):
+        return True
+
+
+class MockTracer:
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = MockSpan(name, attributes or {})
+        self.spans.append(span)
+        yield span
+
+
+class Test_start_span(unittest.TestCase):
+    def test_noop(self):
+        with start_span(None, "papyrus.query", {"papyrus.layer": "spots"}) as span:
+            span.set_attribute("papyrus.rows", 2)
+            assert not span.is_recording()
+
+    def test_tracer(self):
+        tracer = MockTracer()
+        with start_span(tracer, "papyrus.query", {"papyrus.layer": "spots", "papyrus.srid": None}) as span:
+            span.set_attribute("papyrus.rows", 2)
+        assert [(s.name, s.attributes) for s in tracer.spans] == [
+            ("papyrus.query", {"papyrus.layer": "spots", "papyrus.rows": 2})
+        ]
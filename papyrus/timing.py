@@ -0,0 +1,102 @@
+import contextlib
+import contextvars
+import functools
+import time
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING, Any
+
+from papyrus._engine_events import on_statement
+
+if TYPE_CHECKING:
+    import pyramid.request
+    import pyramid.response
+
+TIMINGS_KEY = "papyrus.timings"
+"""The key of the :class:`Timings` of a request in its WSGI environment."""
+
+_current: contextvars.ContextVar["Timings | None"] = contextvars.ContextVar("papyrus_timings", default=None)
+_null_phase = contextlib.nullcontext()
+
+
+class Timings:
+    """
+    The durations of the phases of a request, in milliseconds.
+
+    The durations of the nested phases are not counted in the enclosing
+    phases, the SQL statements executed within a phase are counted in the
+    ``sql`` phase.
+    """
+
+    def __init__(self) -> None:
+        self.durations: dict[str, float] = {}
+        self.callbacks: list[Callable[[pyramid.request.Request, Timings], Any]] = []
+        self.header = False
+        self._nested: list[float] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measure the duration of a phase."""
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        token = _current.set(self)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed - self._nested.pop(), elapsed)
+
+    def add(self, name: str, duration: float, elapsed: float | None = None) -> None:
+        """Add a duration in seconds to a phase, and remove it (or ``elapsed``) from the enclosing phase."""
+        self.durations[name] = self.durations.get(name, 0.0) + duration * 1000
+        if self._nested:
+            self._nested[-1] += duration if elapsed is None else elapsed
+
+    def server_timing(self) -> str:
+        """Get the value of the ``Server-Timing`` header."""
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in self.durations.items())
+
+
+def phase(timings: Timings | None, name: str) -> contextlib.AbstractContextManager[None]:
+    """Measure the duration of a phase, if the timings are enabled."""
+    return _null_phase if timings is None else timings.phase(name)
+
+
+def get_timings(
+    request: "pyramid.request.Request",
+    header: bool = True,
+    callback: Callable[["pyramid.request.Request", Timings], Any] | None = None,
+) -> Timings:
+    """
+    Get the timings of a request, created on the first call.
+
+    The ``Server-Timing`` header is set on the response if ``header`` is
+    ``True``, and ``callback`` is called with the request and the timings
+    once the response is rendered.
+    """
+    timings: Timings | None = request.environ.get(TIMINGS_KEY)
+    if timings is None:
+        # Measure the execution of the SQL statements, once the timings are used
+        on_statement(_on_statement)
+        timings = request.environ[TIMINGS_KEY] = Timings()
+        request.add_response_callback(functools.partial(_on_response, timings))
+    timings.header = timings.header or header
+    if callback is not None and callback not in timings.callbacks:
+        timings.callbacks.append(callback)
+    return timings
+
+
+def _on_response(
+    timings: Timings, request: "pyramid.request.Request", response: "pyramid.response.Response"
+) -> None:
+    if timings.header and timings.durations:
+        response.headers.add("Server-Timing", timings.server_timing())
+    for callback in timings.callbacks:
+        callback(request, timings)
+
+
+def _on_statement(conn: Any, elapsed: float, *args: Any) -> None:
+    del conn, args  # Unused
+    timings = _current.get()
+    if timings is not None:
+        timings.add("sql", elapsed)
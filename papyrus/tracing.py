@@ -0,0 +1,35 @@
+import contextlib
+from typing import Any
+
+TRACER_KEY = "papyrus.tracer"
+"""The key of the tracer of a request in its WSGI environment, used by the GeoJSON renderer."""
+
+
+class _NoopSpan:
+    """A span recording nothing, used when there is no tracer."""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Ignore the attribute."""
+        del key, value  # Unused
+
+    def is_recording(self) -> bool:
+        """Return ``False``, the span records nothing."""
+        return False
+
+
+_NOOP_SPAN = contextlib.nullcontext(_NoopSpan())
+
+
+def start_span(
+    tracer: Any, name: str, attributes: dict[str, Any] | None = None
+) -> contextlib.AbstractContextManager[Any]:
+    """
+    Start a span, as the current span, with an OpenTelemetry compatible tracer.
+
+    Return a span recording nothing if the tracer is ``None``. The attributes
+    with a ``None`` value are skipped, as OpenTelemetry does not accept them.
+    """
+    if tracer is None:
+        return _NOOP_SPAN
+    attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+    return tracer.start_as_current_span(name, attributes=attributes)  # type: ignore[no-any-return]